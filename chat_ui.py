@@ -1,6 +1,6 @@
 import streamlit as st
+import json
 import requests
-import time
 
 st.set_page_config(page_title="Mini-vLLM Chat", page_icon="⚡", layout="wide")
 
@@ -37,21 +37,21 @@ if prompt := st.chat_input("What is the future of AI?"):
         try:
             # Note: We are hitting our own API server
             api_url = "http://localhost:8000/v1/completions"
-            payload = {"prompt": prompt, "max_tokens": max_tokens}
+            payload = {"prompt": prompt, "max_tokens": max_tokens, "stream": True}
             
-            resp = requests.post(api_url, json=payload)
-            resp.raise_for_status()
-            
-            data = resp.json()
-            full_response = data["choices"][0]["text"]
-            
-            # Simulate streaming effect for UI polish (since our simple API is non-streaming for now)
-            displayed_response = ""
-            for char in full_response:
-                displayed_response += char
-                message_placeholder.markdown(displayed_response + "▌")
-                time.sleep(0.01)
-            message_placeholder.markdown(displayed_response)
+            with requests.post(api_url, json=payload, stream=True) as resp:
+                resp.raise_for_status()
+                # Server-Sent Events: one "data: {...}" line per chunk, then "data: [DONE]"
+                for line in resp.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data: "):
+                        continue
+                    data = line[len("data: "):]
+                    if data == "[DONE]":
+                        break
+                    for choice in json.loads(data)["choices"]:
+                        full_response += choice["text"]
+                    message_placeholder.markdown(full_response + "▌")
+            message_placeholder.markdown(full_response)
             
         except Exception as e:
             st.error(f"Error connecting to engine: {e}")
@@ -0,0 +1,293 @@
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from .llm_engine import LLMEngine
+from .metrics import render_metrics
+from .sampling_params import SamplingParams
+
+# Undelivered chunks kept per request before outputs start being merged
+STREAM_QUEUE_SIZE = 16
+# Prompts whose token ids are remembered by the TokenizerPool
+TOKENIZER_CACHE_SIZE = 1024
+
+class EngineDeadError(RuntimeError):
+    """The engine stopped after an error; its requests can never complete."""
+
+class RequestStream:
+    """
+    Engine outputs of one request that the client has not received yet.
+    The backlog is bounded: once STREAM_QUEUE_SIZE chunks are waiting, new
+    outputs are merged into the newest chunk. A slow client then gets fewer,
+    larger chunks instead of an ever-growing queue, and the engine never
+    blocks on it. A chunk belongs to one choice ("index") of the request;
+    outputs are only merged into the newest chunk of their own choice.
+    Only touched from the event loop.
+    """
+    def __init__(self, max_pending: int = STREAM_QUEUE_SIZE):
+        self.request_id: Optional[str] = None
+        self.max_pending = max_pending
+        self._chunks: Deque[dict] = deque()
+        self._ready = asyncio.Event()
+        self._error: Optional[Exception] = None
+
+    def put(self, output: dict):
+        chunk = None
+        if len(self._chunks) >= self.max_pending:
+            chunk = next((c for c in reversed(self._chunks) if c["index"] == output["index"]), None)
+        if chunk is not None:
+            chunk["text"] += output["text"]
+            if output["finished"] and chunk is not self._chunks[-1]:
+                # The chunk that finishes the request must come last
+                self._chunks.remove(chunk)
+                self._chunks.append(chunk)
+        else:
+            chunk = {"index": output["index"], "text": output["text"], "token_ids": [], "logprobs": []}
+            self._chunks.append(chunk)
+        if output["token_id"] is not None:
+            chunk["token_ids"].append(output["token_id"])
+            chunk["logprobs"].append(output["logprobs"])
+        for key in ("finished", "finish_reason", "prompt_tokens", "completion_tokens", "spec_decode"):
+            chunk[key] = output[key]
+        self._ready.set()
+
+    def fail(self, error: Exception):
+        """Ends the stream: get() raises error once the waiting chunks are taken."""
+        self._error = error
+        self._ready.set()
+
+    async def get(self) -> dict:
+        while not self._chunks:
+            if self._error is not None:
+                raise self._error
+            self._ready.clear()
+            await self._ready.wait()
+        return self._chunks.popleft()
+
+class TokenizerPool:
+    """
+    Tokenizes prompts off the event loop. Handlers await encode(); a worker
+    thread takes every prompt queued since its last pass and encodes them
+    with one batched call of the fast tokenizer, whose Rust backend runs
+    without the GIL. Recent prompts are kept in an LRU cache, so repeated
+    prompts and templates skip the tokenizer entirely. Cached token ids
+    are shared: callers must not modify them.
+    """
+    def __init__(self, tokenizer, cache_size: int = TOKENIZER_CACHE_SIZE):
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, List[int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending: Deque[Tuple[str, asyncio.Future]] = deque()
+        self._wakeup = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self.num_cache_hits = 0
+        self.num_batches = 0
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="tokenizer", daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    async def encode(self, prompt: str) -> List[int]:
+        with self._lock:
+            token_ids = self._cache.get(prompt)
+            if token_ids is not None:
+                self._cache.move_to_end(prompt)
+                self.num_cache_hits += 1
+                return token_ids
+            future = self._loop.create_future()
+            self._pending.append((prompt, future))
+        self._wakeup.set()
+        return await future
+
+    def _run(self):
+        while self._running:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            with self._lock:
+                batch, self._pending = self._pending, deque()
+            if not batch:
+                continue
+
+            # Concurrent arrivals of the same prompt are encoded once
+            prompts = list(dict.fromkeys(prompt for prompt, _ in batch))
+            try:
+                encoded = dict(zip(prompts, self.tokenizer(prompts)["input_ids"]))
+            except Exception as e:
+                for _, future in batch:
+                    self._loop.call_soon_threadsafe(_set_future, future, None, ValueError(f"Tokenization failed: {e}"))
+                continue
+            self.num_batches += 1
+
+            with self._lock:
+                for prompt, token_ids in encoded.items():
+                    self._cache[prompt] = token_ids
+                    self._cache.move_to_end(prompt)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            for prompt, future in batch:
+                self._loop.call_soon_threadsafe(_set_future, future, encoded[prompt], None)
+
+class AsyncLLMEngine:
+    """
+    Runs an LLMEngine in a dedicated thread so model forwards never block
+    the asyncio event loop.
+    Prompts are tokenized by a TokenizerPool before they reach the engine.
+    New requests and aborts go through locked queues that the engine thread
+    drains between steps; the thread sleeps on an Event while it has no work.
+    Each step's outputs are handed back to the loop in one callback.
+    If a step raises, the thread stops, records the error and fails every
+    open stream and queued request with EngineDeadError.
+    """
+    def __init__(self, engine: LLMEngine):
+        self.engine = engine
+        self.tokenizer = engine.tokenizer
+        self.tokenizer_pool = TokenizerPool(engine.tokenizer)
+        self.model_name = engine.model_name
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        # Set once the engine thread died; the server then reports itself unhealthy
+        self.error: Optional[str] = None
+
+        self._lock = threading.Lock()
+        self._new_requests: Deque[Tuple[Optional[str], SamplingParams, List[int], dict, RequestStream,
+                                        asyncio.Future]] = deque()
+        self._aborts: Deque[Tuple[str, str]] = deque()
+        self._wakeup = threading.Event()
+        # Owned by the engine thread
+        self._streams: Dict[str, RequestStream] = {}
+
+    def start(self):
+        """Starts the engine thread; outputs are delivered to the running event loop."""
+        self._loop = asyncio.get_running_loop()
+        self.tokenizer_pool.start()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="engine", daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.tokenizer_pool.shutdown()
+
+    async def add_request(self, prompt: Optional[str], sampling_params: Optional[SamplingParams] = None,
+                          prompt_token_ids: Optional[List[int]] = None,
+                          priority: int = 0, tenant: Optional[str] = None) -> RequestStream:
+        """
+        Queues a request for the engine thread and returns its output stream.
+        prompt is tokenized off the loop unless prompt_token_ids are given.
+        Raises ValueError if the engine rejects the request, EngineDeadError
+        if the engine thread died.
+        """
+        if prompt_token_ids is None:
+            prompt_token_ids = await self.tokenizer_pool.encode(prompt)
+        stream = RequestStream()
+        future = self._loop.create_future()
+        scheduling = {"priority": priority, "tenant": tenant}
+        with self._lock:
+            if self.error is not None:
+                raise EngineDeadError(self.error)
+            self._new_requests.append((prompt, sampling_params, prompt_token_ids, scheduling, stream, future))
+        self._wakeup.set()
+        return await future
+
+    def abort_request(self, request_id: str, finish_reason: str = "abort"):
+        """
+        Asks the engine thread to stop the request and free its KV blocks
+        before the next step. The stream gets a final chunk with
+        finish_reason. Safe to call from any thread, and for finished requests.
+        """
+        with self._lock:
+            self._aborts.append((request_id, finish_reason))
+        self._wakeup.set()
+
+    def render_metrics(self) -> str:
+        """Prometheus text of a snapshot of the engine's metrics, taken between its metric updates."""
+        return render_metrics([({}, self.engine.get_metrics_snapshot())])
+
+    def _run(self):
+        print("[Server] Engine thread started.")
+        try:
+            while self._running:
+                self._add_new_requests()
+                self._abort_requests()
+                if not self.engine.has_unfinished_requests():
+                    self._wakeup.wait()
+                    self._wakeup.clear()
+                    continue
+                self._route(self.engine.step())
+        except Exception as e:
+            print(f"[Server] Engine thread failed: {type(e).__name__}: {e}")
+            self._fail_requests(f"{type(e).__name__}: {e}")
+
+    def _fail_requests(self, error: str):
+        with self._lock:
+            self.error = error
+            new_requests, self._new_requests = self._new_requests, deque()
+        for *_, future in new_requests:
+            self._loop.call_soon_threadsafe(_set_future, future, None, EngineDeadError(error))
+        streams, self._streams = list(self._streams.values()), {}
+        self._loop.call_soon_threadsafe(_fail_streams, streams, EngineDeadError(error))
+
+    def _route(self, outputs: List[dict]):
+        if not outputs:
+            return
+        routed = []
+        for out in outputs:
+            stream = self._streams.get(out["req_id"])
+            if stream is not None:
+                routed.append((stream, out))
+            if out["finished"]:
+                self._streams.pop(out["req_id"], None)
+        self._loop.call_soon_threadsafe(_deliver, routed)
+
+    def _abort_requests(self):
+        with self._lock:
+            aborts, self._aborts = self._aborts, deque()
+        for request_id, finish_reason in aborts:
+            self._route(self.engine.abort_request(request_id, finish_reason))
+
+    def _add_new_requests(self):
+        with self._lock:
+            new_requests, self._new_requests = self._new_requests, deque()
+        for prompt, sampling_params, prompt_token_ids, scheduling, stream, future in new_requests:
+            try:
+                stream.request_id = self.engine.add_request(prompt, sampling_params, prompt_token_ids, **scheduling)
+            except ValueError as e:
+                self._loop.call_soon_threadsafe(_set_future, future, None, e)
+                continue
+            self._streams[stream.request_id] = stream
+            self._loop.call_soon_threadsafe(_set_future, future, stream, None)
+
+def _deliver(routed: List[Tuple[RequestStream, dict]]):
+    for stream, out in routed:
+        stream.put(out)
+
+def _fail_streams(streams: List[RequestStream], error: Exception):
+    for stream in streams:
+        stream.fail(error)
+
+def _set_future(future: asyncio.Future, result, exception: Optional[Exception]):
+    # The waiting handler may have been cancelled in the meantime
+    if future.done():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
@@ -1,91 +1,519 @@
-from typing import List, Dict
+from typing import List, Dict, Tuple, Optional, Union
+from collections import OrderedDict
+from enum import Enum
+
+import numpy as np
+
+# Token ids as a list or a sequence's token buffer
+TokenIds = Union[List[int], np.ndarray]
+
+class BlockTier(Enum):
+    """Where a sequence's KV blocks live."""
+    DEVICE = "device"
+    # Swap space in host RAM
+    HOST = "host"
+    # Swap space in a memory-mapped file, for when host RAM should not hold it
+    DISK = "disk"
 
 class PhysicalTokenBlock:
-    """Represents a physical block of memory on the GPU."""
-    def __init__(self, device: str, block_number: int, block_size: int):
+    """Represents a physical block of memory on the GPU. Its ref_count lives in the allocator's array."""
+    __slots__ = ("device", "block_number", "block_size", "block_hash", "_ref_counts")
+
+    def __init__(self, device: str, block_number: int, block_size: int, ref_counts: np.ndarray):
         self.device = device
         self.block_number = block_number
         self.block_size = block_size
-        self.ref_count = 0
+        # Hash of the full token prefix ending in this block, once its KV is computed
+        self.block_hash: Optional[int] = None
+        self._ref_counts = ref_counts
+
+    @property
+    def ref_count(self) -> int:
+        return int(self._ref_counts[self.block_number])
+
+    @ref_count.setter
+    def ref_count(self, value: int):
+        self._ref_counts[self.block_number] = value
 
 class BlockAllocator:
     """
     Manages the free list of physical blocks.
+    Free block numbers are a stack in a preallocated array and reference
+    counts are one array, so n blocks are allocated or freed with a slice
+    and one vectorized update (allocate_n / free_n).
+    With caching enabled, full blocks are indexed by the hash of their token
+    prefix. A cached block whose ref_count drops to 0 keeps its contents and
+    moves to an LRU evictor instead of the free list, so a later request with
+    the same prefix can pick it up again.
     """
-    def __init__(self, num_blocks: int, block_size: int, device: str = "cuda"):
+    def __init__(self, num_blocks: int, block_size: int, device: str = "cuda", enable_caching: bool = False):
         self.num_blocks = num_blocks
         self.block_size = block_size
         self.device = device
-        
-        # Initialize all blocks as free
-        # We perform lazy allocation: we just track indices 0 to N-1
-        self.free_blocks: List[int] = list(range(num_blocks))
-        
+        self.enable_caching = enable_caching
+
+        self.ref_counts = np.zeros(num_blocks, dtype=np.int32)
+        self.blocks: List[PhysicalTokenBlock] = [
+            PhysicalTokenBlock(device, i, block_size, self.ref_counts) for i in range(num_blocks)
+        ]
+        # Free block numbers are free_stack[:num_free]; the top is allocated first
+        self.free_stack = np.arange(num_blocks, dtype=np.int32)
+        self.num_free = num_blocks
+        self.cached_blocks: Dict[int, int] = {}  # prefix hash -> block number
+        self.evictor: "OrderedDict[int, None]" = OrderedDict()  # unreferenced cached blocks, LRU first
+
     def allocate(self) -> int:
-        if not self.free_blocks:
+        return int(self.allocate_n(1)[0])
+
+    def allocate_n(self, n: int) -> np.ndarray:
+        """n blocks with a reference each: free blocks first, then evicted cached blocks."""
+        if n > self.get_num_free_blocks():
             raise ValueError("Out of memory! No free blocks available.")
-        return self.free_blocks.pop()
-    
+        num_from_stack = min(n, self.num_free)
+        block_numbers = self.free_stack[self.num_free - num_from_stack:self.num_free][::-1].copy()
+        self.num_free -= num_from_stack
+        if num_from_stack < n:
+            evicted = []
+            for _ in range(n - num_from_stack):
+                block_number, _ = self.evictor.popitem(last=False)
+                block = self.blocks[block_number]
+                del self.cached_blocks[block.block_hash]
+                block.block_hash = None
+                evicted.append(block_number)
+            block_numbers = np.concatenate([block_numbers, np.array(evicted, dtype=np.int32)])
+        self.ref_counts[block_numbers] = 1
+        return block_numbers
+
+    def allocate_cached(self, block_hash: int) -> Optional[int]:
+        """Takes a reference on the block holding this prefix, if any."""
+        block_number = self.cached_blocks.get(block_hash)
+        if block_number is None:
+            return None
+        if self.ref_counts[block_number] == 0:
+            del self.evictor[block_number]
+        self.ref_counts[block_number] += 1
+        return block_number
+
+    def incref(self, block_number: int):
+        """Adds a reference to a block that is already in use (forked sequences)."""
+        self.ref_counts[block_number] += 1
+
+    def incref_n(self, block_numbers: np.ndarray):
+        """incref for each entry of block_numbers (repeats add up)."""
+        np.add.at(self.ref_counts, block_numbers, 1)
+
+    def lookup(self, block_hash: int) -> Optional[PhysicalTokenBlock]:
+        block_number = self.cached_blocks.get(block_hash)
+        return None if block_number is None else self.blocks[block_number]
+
+    def register(self, block_number: int, block_hash: int):
+        """Publishes a computed full block under its prefix hash."""
+        if not self.enable_caching or block_hash in self.cached_blocks:
+            return
+        self.blocks[block_number].block_hash = block_hash
+        self.cached_blocks[block_hash] = block_number
+
     def free(self, block_number: int):
-        if block_number < 0 or block_number >= self.num_blocks:
-            raise ValueError(f"Invalid block number {block_number}")
-        self.free_blocks.append(block_number)
-        
+        self.free_n(np.array([block_number]))
+
+    def free_n(self, block_numbers: np.ndarray):
+        """Drops one reference from each of these distinct blocks."""
+        if len(block_numbers) == 0:
+            return
+        if block_numbers.min() < 0 or block_numbers.max() >= self.num_blocks:
+            raise ValueError(f"Invalid block number in {block_numbers.tolist()}")
+        if (self.ref_counts[block_numbers] <= 0).any():
+            raise ValueError(f"Double free of a block in {block_numbers.tolist()}")
+        self.ref_counts[block_numbers] -= 1
+        released = block_numbers[self.ref_counts[block_numbers] == 0]
+        if self.enable_caching:
+            uncached = []
+            for block_number in released.tolist():
+                if self.blocks[block_number].block_hash is not None:
+                    self.evictor[block_number] = None
+                else:
+                    uncached.append(block_number)
+            released = np.array(uncached, dtype=np.int32)
+        self.free_stack[self.num_free:self.num_free + len(released)] = released
+        self.num_free += len(released)
+
     def get_num_free_blocks(self) -> int:
-        return len(self.free_blocks)
+        # Evictable cached blocks can be reclaimed at any time
+        return self.num_free + len(self.evictor)
+
+class BlockTableArray:
+    """
+    The block tables of all sequences as rows of one contiguous
+    [num_rows, max_blocks] array, with each row's length alongside.
+    Entries past a row's length are 0, so any set of rows can be handed to
+    the model as a zero-padded batch table with one fancy index. Rows and
+    columns double when they run out.
+    """
+    def __init__(self, num_rows: int = 64, max_blocks: int = 16):
+        self.tables = np.zeros((num_rows, max_blocks), dtype=np.int32)
+        self.lens = np.zeros(num_rows, dtype=np.int32)
+        self.free_rows: List[int] = list(range(num_rows - 1, -1, -1))
+
+    def allocate_row(self) -> int:
+        if not self.free_rows:
+            num_rows = len(self.lens)
+            self.tables = np.concatenate([self.tables, np.zeros_like(self.tables)])
+            self.lens = np.concatenate([self.lens, np.zeros_like(self.lens)])
+            self.free_rows = list(range(2 * num_rows - 1, num_rows - 1, -1))
+        return self.free_rows.pop()
+
+    def free_row(self, row: int):
+        self.tables[row, :self.lens[row]] = 0
+        self.lens[row] = 0
+        self.free_rows.append(row)
+
+    def append(self, row: int, block_numbers: np.ndarray):
+        start = self.lens[row]
+        end = start + len(block_numbers)
+        if end > self.tables.shape[1]:
+            width = self.tables.shape[1]
+            while width < end:
+                width *= 2
+            grown = np.zeros((len(self.lens), width), dtype=np.int32)
+            grown[:, :self.tables.shape[1]] = self.tables
+            self.tables = grown
+        self.tables[row, start:end] = block_numbers
+        self.lens[row] = end
+
+    def get(self, row: int) -> np.ndarray:
+        """A view of the row's block numbers (valid until the array grows)."""
+        return self.tables[row, :self.lens[row]]
+
+    def gather(self, rows: List[int]) -> np.ndarray:
+        """The rows as one zero-padded [len(rows), longest] array."""
+        width = int(self.lens[rows].max()) if rows else 0
+        return self.tables[rows, :width]
 
 class BlockTable:
     """
     Maps logical blocks to physical blocks for a single sequence.
     Similar to a Virtual Memory Page Table.
+    tier says which pool the physical block numbers index. The block
+    numbers are a row of the BlockManager's BlockTableArray.
     """
-    def __init__(self, block_size: int, block_allocator: BlockAllocator):
+    __slots__ = ("block_size", "allocator", "tier", "storage", "row", "block_hashes")
+
+    def __init__(self, block_size: int, block_allocator: BlockAllocator, storage: BlockTableArray,
+                 tier: BlockTier = BlockTier.DEVICE):
         self.block_size = block_size
         self.allocator = block_allocator
-        self.physical_block_indices: List[int] = []
-        
-    def allocate_token_slot(self):
+        self.tier = tier
+        self.storage = storage
+        self.row = storage.allocate_row()
+        # Prefix hashes of the leading full, computed blocks
+        self.block_hashes: List[int] = []
+
+    @property
+    def block_numbers(self) -> np.ndarray:
+        return self.storage.get(self.row)
+
+    @property
+    def physical_block_indices(self) -> List[int]:
+        return self.block_numbers.tolist()
+
+    def get_num_blocks(self) -> int:
+        return int(self.storage.lens[self.row])
+
+    def append_blocks(self, block_numbers: np.ndarray):
+        self.storage.append(self.row, block_numbers)
+
+    def allocate_token_slot(self, num_tokens: int):
         """
-        Called when a new token is generated. 
-        Ensures there is space in the last block, or optimizes a new block.
+        Ensures the table has room for num_tokens tokens,
+        grabbing new physical blocks only when the last one is full.
         """
-        # Calculate current logical length capacity
-        current_capacity = len(self.physical_block_indices) * self.block_size
-        
-        # We rely on external tracker to know how many tokens we actually have.
-        # But here, let's assume this method is called *before* adding a token that would overflow.
-        # Actually simplest logic: "Do we need a new block?"
-        
-        # This function is meant to be called by the BlockManager which knows the seq len.
-        pass
+        num_new = (num_tokens + self.block_size - 1) // self.block_size - self.get_num_blocks()
+        if num_new > 0:
+            self.append_blocks(self.allocator.allocate_n(num_new))
 
     def add_block(self):
-        new_block = self.allocator.allocate()
-        self.physical_block_indices.append(new_block)
-        
+        self.append_blocks(self.allocator.allocate_n(1))
+
     def free(self):
-        for block_idx in self.physical_block_indices:
-            self.allocator.free(block_idx)
-        self.physical_block_indices = []
+        """Releases the blocks and the table's row; the table is unusable afterwards."""
+        self.allocator.free_n(self.block_numbers)
+        self.storage.free_row(self.row)
+        self.block_hashes = []
 
 class BlockManager:
     """
     High-level manager for PagedAttention memory.
-    Connects requests to their block tables.
+    Connects sequences (by seq_id) to their block tables.
+    All tables are rows of one BlockTableArray, so a batch's tables come out
+    as a single padded array (get_block_tables).
+    Sequences preempted by swapping keep a table over the host swap pool,
+    or over the disk swap pool once host swap is full. Swap copies address
+    both through swap slots: host blocks are slots [0, num_cpu_blocks) and
+    disk blocks follow them.
     """
-    def __init__(self, block_size: int, num_gpu_blocks: int, device: str = "cuda"):
+    def __init__(self, block_size: int, num_gpu_blocks: int, num_cpu_blocks: int = 0,
+                 device: str = "cuda", watermark: float = 0.01, enable_prefix_caching: bool = False,
+                 num_disk_blocks: int = 0):
         self.block_size = block_size
-        self.allocator = BlockAllocator(num_blocks=num_gpu_blocks, block_size=block_size, device=device)
-        self.block_tables: Dict[str, BlockTable] = {}
-        
-    def allocate(self, request_id: str):
-        # Create a new table for this request
-        self.block_tables[request_id] = BlockTable(self.block_size, self.allocator)
-        
-    def free(self, request_id: str):
-        if request_id in self.block_tables:
-            self.block_tables[request_id].free()
-            del self.block_tables[request_id]
+        self.enable_prefix_caching = enable_prefix_caching
+        self.allocator = BlockAllocator(
+            num_blocks=num_gpu_blocks, block_size=block_size, device=device,
+            enable_caching=enable_prefix_caching,
+        )
+        self.cpu_allocator = BlockAllocator(num_blocks=num_cpu_blocks, block_size=block_size, device="cpu")
+        self.disk_allocator = BlockAllocator(num_blocks=num_disk_blocks, block_size=block_size, device="disk")
+        self.allocators = {
+            BlockTier.DEVICE: self.allocator, BlockTier.HOST: self.cpu_allocator, BlockTier.DISK: self.disk_allocator,
+        }
+        self.table_array = BlockTableArray()
+        self.block_tables: Dict[int, BlockTable] = {}
+        # Keep a few blocks back at admission so running sequences can still grow
+        self.watermark_blocks = int(watermark * num_gpu_blocks)
+
+        # Prefix cache statistics, counted in full blocks
+        self.num_prefix_queries = 0
+        self.num_prefix_hits = 0
+
+    def get_num_required_blocks(self, num_tokens: int) -> int:
+        return (num_tokens + self.block_size - 1) // self.block_size
+
+    def hash_blocks(self, token_ids: TokenIds, start_block: int = 0,
+                    prev_hash: Optional[int] = None, num_blocks: Optional[int] = None) -> List[int]:
+        """
+        Chained hashes of full blocks: each one covers the whole prefix up to
+        the end of its block, so equal hashes mean equal KV contents.
+        """
+        if num_blocks is None:
+            num_blocks = len(token_ids) // self.block_size
+        # Hash raw int64 bytes, so lists and token buffers of the same ids hash alike
+        token_ids = np.asarray(token_ids[start_block * self.block_size:num_blocks * self.block_size], dtype=np.int64)
+        hashes = []
+        for idx in range(num_blocks - start_block):
+            block_tokens = token_ids[idx * self.block_size:(idx + 1) * self.block_size].tobytes()
+            prev_hash = hash((prev_hash, block_tokens))
+            hashes.append(prev_hash)
+        return hashes
+
+    def can_allocate(self, token_ids: TokenIds) -> bool:
+        return self.can_allocate_all([token_ids])
+
+    def can_allocate_all(self, token_ids_list: List[TokenIds]) -> bool:
+        """Whether all of these sequences can be allocated at once."""
+        num_required = sum(self._get_num_blocks_to_allocate(token_ids) for token_ids in token_ids_list)
+        return self.allocator.get_num_free_blocks() - num_required >= self.watermark_blocks
+
+    def _get_num_blocks_to_allocate(self, token_ids: TokenIds) -> int:
+        num_required = self.get_num_required_blocks(len(token_ids))
+        if self.enable_prefix_caching:
+            # Cached blocks already referenced by running sequences cost nothing
+            hashes = self.hash_blocks(token_ids)
+            for block_hash in hashes:
+                block = self.allocator.lookup(block_hash)
+                if block is None:
+                    break
+                if self.allocator.ref_counts[block.block_number] > 0:
+                    num_required -= 1
+            else:
+                # Fully cached prompt: its last block gets copied on write
+                num_required += int(bool(hashes))
+        return num_required
+
+    def can_ever_allocate(self, num_tokens: int, num_seqs: int = 1) -> bool:
+        """False if num_seqs sequences of num_tokens would not fit even with every block free."""
+        return num_seqs * self.get_num_required_blocks(num_tokens) <= self.allocator.num_blocks - self.watermark_blocks
+
+    def allocate(self, seq_id: int, token_ids: TokenIds) -> Tuple[int, List[Tuple[int, int]]]:
+        """
+        Creates the block table for a new (or recompute-preempted) sequence.
+        Leading full blocks found in the prefix cache are shared instead of
+        allocated. Returns the number of tokens whose KV can be skipped and the
+        (src, dst) block copies needed before the first write.
+        """
+        block_table = BlockTable(self.block_size, self.allocator, self.table_array)
+        if self.enable_prefix_caching:
+            hashes = self.hash_blocks(token_ids)
+            self.num_prefix_queries += len(hashes)
+            cached = []
+            for block_hash in hashes:
+                block_number = self.allocator.allocate_cached(block_hash)
+                if block_number is None:
+                    break
+                cached.append(block_number)
+                block_table.block_hashes.append(block_hash)
+            block_table.append_blocks(np.array(cached, dtype=np.int32))
+            self.num_prefix_hits += len(block_table.block_hashes)
+        block_table.allocate_token_slot(len(token_ids))
+        self.block_tables[seq_id] = block_table
+
+        # The last token is always recomputed to produce the next-token logits
+        num_cached_tokens = min(len(block_table.block_hashes) * self.block_size, len(token_ids) - 1)
+        return num_cached_tokens, self._copy_on_write(block_table, num_cached_tokens)
+
+    def can_append_slot(self, seq_id: int, num_tokens: int, write_start: int) -> bool:
+        return self.can_append_slots([(seq_id, num_tokens, write_start)])
+
+    def can_append_slots(self, slots: List[Tuple[int, int, int]]) -> bool:
+        """can_append_slot for several (seq_id, num_tokens, write_start) at once."""
+        num_required = 0
+        ref_counts = self.allocator.ref_counts
+        for seq_id, num_tokens, write_start in slots:
+            block_numbers = self.block_tables[seq_id].block_numbers
+            num_required += max(self.get_num_required_blocks(num_tokens) - len(block_numbers), 0)
+            # Shared blocks that will be written get copied
+            num_required += int(np.count_nonzero(ref_counts[block_numbers[write_start // self.block_size:]] > 1))
+        return num_required <= self.allocator.get_num_free_blocks()
+
+    def append_slot(self, seq_id: int, num_tokens: int, write_start: int) -> List[Tuple[int, int]]:
+        """
+        Grows the sequence's table so it can hold num_tokens tokens and makes
+        every block written from write_start on private to this sequence.
+        Returns the (src, dst) block copies that must run before the write.
+        """
+        block_table = self.block_tables[seq_id]
+        block_table.allocate_token_slot(num_tokens)
+        return self._copy_on_write(block_table, write_start)
+
+    def _copy_on_write(self, block_table: BlockTable, write_start: int) -> List[Tuple[int, int]]:
+        first_block = write_start // self.block_size
+        block_numbers = block_table.block_numbers
+        shared = first_block + np.flatnonzero(self.allocator.ref_counts[block_numbers[first_block:]] > 1)
+        # Hashes only describe blocks that are no longer written to
+        del block_table.block_hashes[first_block:]
+        if shared.size == 0:
+            return []
+        src_blocks = block_numbers[shared].copy()
+        dst_blocks = self.allocator.allocate_n(len(src_blocks))
+        # Still referenced by the other sequences, so nothing is released
+        self.allocator.free_n(src_blocks)
+        block_numbers[shared] = dst_blocks
+        return list(zip(src_blocks.tolist(), dst_blocks.tolist()))
+
+    def mark_blocks_computed(self, seq_id: int, token_ids: TokenIds, num_computed_tokens: int):
+        """Publishes the sequence's newly completed full blocks to the prefix cache."""
+        if not self.enable_prefix_caching:
+            return
+        block_table = self.block_tables[seq_id]
+        num_hashed = len(block_table.block_hashes)
+        prev_hash = block_table.block_hashes[-1] if num_hashed else None
+        new_hashes = self.hash_blocks(
+            token_ids, start_block=num_hashed, prev_hash=prev_hash,
+            num_blocks=num_computed_tokens // self.block_size,
+        )
+        block_numbers = block_table.block_numbers
+        for idx, block_hash in enumerate(new_hashes, start=num_hashed):
+            self.allocator.register(int(block_numbers[idx]), block_hash)
+            block_table.block_hashes.append(block_hash)
+
+    def get_prefix_cache_hit_rate(self) -> float:
+        if self.num_prefix_queries == 0:
+            return 0.0
+        return self.num_prefix_hits / self.num_prefix_queries
+
+    def fork(self, parent_seq_id: int, child_seq_id: int):
+        """
+        Gives a child sequence the parent's blocks by reference. Whichever of
+        them writes into a shared block first gets a private copy (see
+        append_slot), so blocks are only copied once the sequences diverge.
+        """
+        parent_table = self.block_tables[parent_seq_id]
+        child_table = BlockTable(self.block_size, parent_table.allocator, self.table_array, parent_table.tier)
+        child_table.append_blocks(parent_table.block_numbers)
+        child_table.block_hashes = list(parent_table.block_hashes)
+        parent_table.allocator.incref_n(child_table.block_numbers)
+        self.block_tables[child_seq_id] = child_table
+
+    def _get_unique_blocks(self, seq_ids: List[int]) -> int:
+        return len(np.unique(np.concatenate([self.block_tables[seq_id].block_numbers for seq_id in seq_ids])))
+
+    def _get_swap_tier(self, seq_ids: List[int]) -> Optional[BlockTier]:
+        """Host swap if the blocks fit there, else disk swap, else None."""
+        num_blocks = self._get_unique_blocks(seq_ids)
+        for tier in (BlockTier.HOST, BlockTier.DISK):
+            if num_blocks <= self.allocators[tier].get_num_free_blocks():
+                return tier
+        return None
+
+    def can_swap_out(self, seq_ids: List[int]) -> bool:
+        return self._get_swap_tier(seq_ids) is not None
+
+    def swap_out(self, seq_ids: List[int]) -> List[Tuple[int, int]]:
+        """Moves the sequences' tables to a swap tier. Returns (gpu_block, swap_slot) pairs to copy."""
+        return self._move(seq_ids, self._get_swap_tier(seq_ids))
+
+    def can_swap_in(self, seq_ids: List[int], seq_lens: List[int], write_starts: List[int]) -> bool:
+        num_required = self._get_num_swap_in_blocks(seq_ids, seq_lens, write_starts)
+        return self.allocator.get_num_free_blocks() - num_required >= self.watermark_blocks
+
+    def can_ever_swap_in(self, seq_ids: List[int], seq_lens: List[int], write_starts: List[int]) -> bool:
+        """False if the swapped sequences would not fit even with every block free."""
+        num_required = self._get_num_swap_in_blocks(seq_ids, seq_lens, write_starts)
+        return num_required <= self.allocator.num_blocks - self.watermark_blocks
+
+    def _get_num_swap_in_blocks(self, seq_ids: List[int], seq_lens: List[int], write_starts: List[int]) -> int:
+        """
+        Device blocks that swapping these sequences in and scheduling them
+        takes: their blocks, any block a sequence needs to grow to its current
+        length, and the copies of shared blocks written from write_start on
+        (counted per sequence, as in can_append_slots).
+        """
+        num_required = self._get_unique_blocks(seq_ids)
+        for seq_id, seq_len, write_start in zip(seq_ids, seq_lens, write_starts):
+            block_table = self.block_tables[seq_id]
+            block_numbers = block_table.block_numbers
+            num_required += max(self.get_num_required_blocks(seq_len) - len(block_numbers), 0)
+            ref_counts = block_table.allocator.ref_counts
+            num_required += int(np.count_nonzero(ref_counts[block_numbers[write_start // self.block_size:]] > 1))
+        return num_required
+
+    def swap_in(self, seq_ids: List[int]) -> List[Tuple[int, int]]:
+        """Moves swapped sequences back to the GPU pool. Returns (swap_slot, gpu_block) pairs to copy."""
+        return self._move(seq_ids, BlockTier.DEVICE)
+
+    def _get_slot_offset(self, tier: BlockTier) -> int:
+        """First swap slot of a tier's blocks (0 for the device pool, which has no slots)."""
+        return self.cpu_allocator.num_blocks if tier == BlockTier.DISK else 0
+
+    def _move(self, seq_ids: List[int], dst_tier: BlockTier) -> List[Tuple[int, int]]:
+        # Blocks shared by forked sequences are moved once and stay shared
+        dst_allocator = self.allocators[dst_tier]
+        dst_offset = self._get_slot_offset(dst_tier)
+        tables = [self.block_tables[seq_id] for seq_id in seq_ids]
+        src_slots = np.concatenate([
+            table.block_numbers.astype(np.int64) + self._get_slot_offset(table.tier) for table in tables
+        ])
+        # Destination blocks are handed out in order of first appearance
+        unique_slots, first_idx, inverse, counts = np.unique(
+            src_slots, return_index=True, return_inverse=True, return_counts=True)
+        order = np.argsort(first_idx)
+        dst_blocks = np.empty(len(unique_slots), dtype=np.int32)
+        dst_blocks[order] = dst_allocator.allocate_n(len(unique_slots))
+        dst_allocator.incref_n(np.repeat(dst_blocks, counts - 1))
+
+        start = 0
+        for seq_id, src_table in zip(seq_ids, tables):
+            end = start + src_table.get_num_blocks()
+            dst_table = BlockTable(self.block_size, dst_allocator, self.table_array, dst_tier)
+            dst_table.append_blocks(dst_blocks[inverse[start:end]])
+            src_table.free()
+            self.block_tables[seq_id] = dst_table
+            start = end
+        return [(int(unique_slots[i]), int(dst_blocks[i]) + dst_offset) for i in order]
+
+    def get_num_seqs(self, tier: BlockTier) -> int:
+        """Sequences whose blocks are in tier."""
+        return sum(1 for table in self.block_tables.values() if table.tier == tier)
+
+    def free(self, seq_id: int):
+        if seq_id in self.block_tables:
+            self.block_tables[seq_id].free()
+            del self.block_tables[seq_id]
             
-    def get_block_table(self, request_id: str) -> BlockTable:
-        return self.block_tables[request_id]
+    def get_block_table(self, seq_id: int) -> BlockTable:
+        return self.block_tables[seq_id]
+
+    def get_block_tables(self, seq_ids: List[int]) -> np.ndarray:
+        """The sequences' block tables as one zero-padded [len(seq_ids), max_blocks] array."""
+        return self.table_array.gather([self.block_tables[seq_id].row for seq_id in seq_ids])
+
+    def get_num_free_blocks(self) -> int:
+        return self.allocator.get_num_free_blocks()
@@ -0,0 +1,334 @@
+import asyncio
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from typing import Dict, List, Optional
+
+from transformers import AutoTokenizer
+
+from .async_llm_engine import EngineDeadError, RequestStream, TokenizerPool, _deliver, _fail_streams, _set_future
+from .llm_engine import DEFAULT_GPU_MEMORY_UTILIZATION
+from .metrics import EngineMetrics, render_metrics
+from .sampling_params import SamplingParams
+
+# Seconds between checks that replicas are still alive
+READY_POLL_INTERVAL = 1.0
+# Seconds between the metrics snapshots a replica sends to the router
+METRICS_INTERVAL = 1.0
+
+class DataParallelEngine:
+    """
+    N independent engine replicas, each in its own process with its own
+    model copy and KV pool, behind a router in the server process.
+    Every request goes to the replica with the fewest unfinished requests,
+    ties broken by the most free KV blocks. Outputs of all replicas come
+    back on one queue and are delivered to the event loop per step, like
+    AsyncLLMEngine.
+    A replica whose step raises, or whose process exits, is taken out of
+    the rotation and its requests fail with EngineDeadError; the engine as
+    a whole is dead once no replica is left.
+    """
+    def __init__(self, num_replicas: int, engine_kwargs: dict,
+                 cpu_cores: Optional[List[List[int]]] = None, pin_cores: bool = False):
+        self.num_replicas = num_replicas
+        # The replicas share the host's memory, so each sizes its KV pool from its share
+        utilization = engine_kwargs.get("gpu_memory_utilization", DEFAULT_GPU_MEMORY_UTILIZATION)
+        self.engine_kwargs = {**engine_kwargs, "gpu_memory_utilization": utilization / num_replicas}
+        self.model_name = engine_kwargs["model_name"]
+        # The router tokenizes prompts (off the loop) and decodes logprobs text
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        self.tokenizer_pool = TokenizerPool(self.tokenizer)
+
+        if cpu_cores is None and pin_cores:
+            cpu_cores = _split_cores(sorted(os.sched_getaffinity(0)), num_replicas)
+        if cpu_cores is not None and len(cpu_cores) != num_replicas:
+            raise ValueError(f"Expected {num_replicas} core sets, got {len(cpu_cores)}")
+        self.cpu_cores = cpu_cores
+
+        self._ctx = mp.get_context("spawn")
+        self._request_queues: List[mp.Queue] = []
+        self._output_queue: Optional[mp.Queue] = None
+        self._workers: List[mp.Process] = []
+        self._listener: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # Mirrors AsyncLLMEngine.error for the server's health check: set once every replica failed
+        self.error: Optional[str] = None
+        self._stopping = False
+
+        self._request_counter = itertools.count()
+        # Router state, only touched by the listener thread and under _lock
+        self._lock = threading.Lock()
+        self._pending: Dict[str, tuple] = {}            # request_id -> (stream, future) until accepted
+        self._streams: Dict[str, RequestStream] = {}
+        self._replica_of: Dict[str, int] = {}
+        self._num_unfinished = [0] * num_replicas
+        self._num_free_blocks = [0] * num_replicas
+        # Error of every replica that failed after startup; they get no more requests
+        self._replica_errors: List[Optional[str]] = [None] * num_replicas
+        # Latest metrics snapshot of every replica
+        self._metrics = [EngineMetrics() for _ in range(num_replicas)]
+
+    def start(self, wait: bool = True):
+        """
+        Spawns the replicas and, with wait, waits until every one has loaded
+        its model. Otherwise wait_until_ready must be called before serving
+        (e.g. from a thread, so the event loop stays responsive meanwhile).
+        """
+        self._loop = asyncio.get_running_loop()
+        self.tokenizer_pool.start()
+        self._output_queue = self._ctx.Queue()
+        for rank in range(self.num_replicas):
+            request_queue = self._ctx.Queue()
+            cores = self.cpu_cores[rank] if self.cpu_cores is not None else None
+            worker = self._ctx.Process(
+                target=_worker_main, name=f"engine-{rank}", daemon=True,
+                args=(rank, self.engine_kwargs, cores, request_queue, self._output_queue),
+            )
+            worker.start()
+            self._request_queues.append(request_queue)
+            self._workers.append(worker)
+        if wait:
+            self.wait_until_ready()
+
+    def wait_until_ready(self):
+        """
+        Blocks until every replica reported ready, then starts routing their
+        outputs. Raises RuntimeError if a replica dies while loading.
+        """
+        num_ready = 0
+        while num_ready < self.num_replicas:
+            try:
+                kind, rank, stats = self._output_queue.get(timeout=READY_POLL_INTERVAL)
+            except queue.Empty:
+                dead = [w.name for w in self._workers if not w.is_alive()]
+                if dead:
+                    raise RuntimeError(f"Engine replicas {dead} exited during startup")
+                continue
+            assert kind == "ready"
+            num_ready += 1
+            self._update_stats(rank, stats)
+        print(f"[Server] {self.num_replicas} engine replicas ready.")
+
+        self._listener = threading.Thread(target=self._listen, name="router", daemon=True)
+        self._listener.start()
+
+    def shutdown(self):
+        self._stopping = True
+        for request_queue in self._request_queues:
+            request_queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self._listener is not None:
+            self._output_queue.put(("shutdown", None, None))
+            self._listener.join()
+        self._workers, self._request_queues = [], []
+        self.tokenizer_pool.shutdown()
+
+    async def add_request(self, prompt: Optional[str], sampling_params: Optional[SamplingParams] = None,
+                          prompt_token_ids: Optional[List[int]] = None,
+                          priority: int = 0, tenant: Optional[str] = None) -> RequestStream:
+        """
+        Routes a request to the least-loaded live replica and returns its
+        output stream. Replicas receive token ids: prompts are tokenized here.
+        Raises EngineDeadError if every replica failed.
+        """
+        if prompt_token_ids is None:
+            prompt_token_ids = await self.tokenizer_pool.encode(prompt)
+        stream = RequestStream()
+        stream.request_id = f"cmpl-{next(self._request_counter)}"
+        future = self._loop.create_future()
+        with self._lock:
+            if self.error is not None:
+                raise EngineDeadError(self.error)
+            rank = min((r for r in range(self.num_replicas) if self._replica_errors[r] is None),
+                       key=lambda r: (self._num_unfinished[r], -self._num_free_blocks[r]))
+            self._num_unfinished[rank] += 1
+            self._replica_of[stream.request_id] = rank
+            self._pending[stream.request_id] = (stream, future)
+        scheduling = {"priority": priority, "tenant": tenant}
+        self._request_queues[rank].put(
+            ("add", (stream.request_id, prompt, sampling_params, prompt_token_ids, scheduling)))
+        return await future
+
+    def abort_request(self, request_id: str, finish_reason: str = "abort"):
+        """Stops the request on its replica, which frees its KV blocks and sends the final outputs."""
+        with self._lock:
+            rank = self._replica_of.get(request_id)
+        if rank is not None:
+            self._request_queues[rank].put(("abort", (request_id, finish_reason)))
+
+    def render_metrics(self) -> str:
+        """Prometheus text of every replica's metrics, labelled by replica."""
+        with self._lock:
+            replicas = [({"replica": str(rank)}, metrics) for rank, metrics in enumerate(self._metrics)]
+            return render_metrics(replicas)
+
+    def get_replica_loads(self) -> List[int]:
+        """Unfinished requests per replica."""
+        with self._lock:
+            return list(self._num_unfinished)
+
+    def _listen(self):
+        last_check = time.monotonic()
+        while True:
+            if time.monotonic() - last_check >= READY_POLL_INTERVAL:
+                # A replica killed outright (OOM killer, segfault) sends no "failed" message
+                last_check = time.monotonic()
+                for rank, worker in enumerate(self._workers):
+                    if not self._stopping and self._replica_errors[rank] is None and not worker.is_alive():
+                        self._fail_replica(rank, f"process exited with code {worker.exitcode}")
+            try:
+                kind, rank, payload = self._output_queue.get(timeout=READY_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if kind == "shutdown":
+                return
+            if self._replica_errors[rank] is not None:
+                # Late messages of a failed replica: its requests were failed already
+                continue
+            if kind == "failed":
+                self._fail_replica(rank, payload)
+            elif kind == "added":
+                request_id, error = payload
+                with self._lock:
+                    stream, future = self._pending.pop(request_id)
+                    if error is None:
+                        self._streams[request_id] = stream
+                    else:
+                        self._finish(request_id)
+                exception = ValueError(error) if error is not None else None
+                self._loop.call_soon_threadsafe(_set_future, future, stream, exception)
+            elif kind == "outputs":
+                outputs, stats = payload
+                routed = []
+                with self._lock:
+                    self._update_stats(rank, stats)
+                    for out in outputs:
+                        stream = self._streams.get(out["req_id"])
+                        if stream is None:
+                            continue
+                        routed.append((stream, out))
+                        if out["finished"]:
+                            del self._streams[out["req_id"]]
+                            self._finish(out["req_id"])
+                self._loop.call_soon_threadsafe(_deliver, routed)
+
+    def _fail_replica(self, rank: int, error: str):
+        """Stops routing to the replica and fails its accepted and pending requests."""
+        print(f"[Server] Engine replica {rank} failed: {error}")
+        exception = EngineDeadError(f"Engine replica {rank} failed: {error}")
+        with self._lock:
+            self._replica_errors[rank] = error
+            request_ids = [request_id for request_id, r in self._replica_of.items() if r == rank]
+            pending = [self._pending.pop(request_id) for request_id in request_ids if request_id in self._pending]
+            streams = [self._streams.pop(request_id) for request_id in request_ids if request_id in self._streams]
+            for request_id in request_ids:
+                self._finish(request_id)
+            if all(e is not None for e in self._replica_errors):
+                self.error = f"All {self.num_replicas} engine replicas failed"
+        for _, future in pending:
+            self._loop.call_soon_threadsafe(_set_future, future, None, exception)
+        self._loop.call_soon_threadsafe(_fail_streams, streams, exception)
+
+    def _update_stats(self, rank: int, stats: dict):
+        self._num_free_blocks[rank] = stats["num_free_blocks"]
+        if "metrics" in stats:
+            self._metrics[rank] = stats["metrics"]
+
+    def _finish(self, request_id: str):
+        rank = self._replica_of.pop(request_id)
+        self._num_unfinished[rank] -= 1
+
+def _split_cores(cores: List[int], num_replicas: int) -> List[List[int]]:
+    """Splits the available cores into contiguous, near-equal sets."""
+    if len(cores) < num_replicas:
+        raise ValueError(f"Cannot pin {num_replicas} replicas to {len(cores)} cores")
+    size, extra = divmod(len(cores), num_replicas)
+    sets, start = [], 0
+    for rank in range(num_replicas):
+        end = start + size + (rank < extra)
+        sets.append(cores[start:end])
+        start = end
+    return sets
+
+def _worker_main(rank: int, engine_kwargs: dict, cpu_cores: Optional[List[int]],
+                 request_queue: mp.Queue, output_queue: mp.Queue):
+    """Replica process: owns one LLMEngine and steps it until told to stop."""
+    import torch
+    from .llm_engine import LLMEngine
+
+    if cpu_cores is not None:
+        os.sched_setaffinity(0, cpu_cores)
+        torch.set_num_threads(len(cpu_cores))
+    print(f"[Engine] Replica {rank} starting (cores={cpu_cores})...")
+    engine = LLMEngine(**engine_kwargs)
+
+    last_metrics_time = 0.0
+
+    def stats() -> dict:
+        nonlocal last_metrics_time
+        result = {"num_free_blocks": engine.block_manager.get_num_free_blocks()}
+        # Metrics are pickled along at most every METRICS_INTERVAL seconds, and when idle
+        now = time.monotonic()
+        if now - last_metrics_time >= METRICS_INTERVAL or not engine.has_unfinished_requests():
+            # A copy: the queue pickles it later, in its feeder thread
+            result["metrics"] = engine.get_metrics_snapshot()
+            last_metrics_time = now
+        return result
+
+    output_queue.put(("ready", rank, stats()))
+
+    # Router request ids by engine request id, and the reverse
+    request_ids: Dict[str, str] = {}
+    engine_ids: Dict[str, str] = {}
+
+    def send_outputs(outputs: List[dict]):
+        for out in outputs:
+            if out["finished"]:
+                out["req_id"] = request_ids.pop(out["req_id"])
+                del engine_ids[out["req_id"]]
+            else:
+                out["req_id"] = request_ids[out["req_id"]]
+        output_queue.put(("outputs", rank, (outputs, stats())))
+    try:
+        while True:
+            # Block while idle, otherwise take whatever arrived since the last step
+            new_requests = []
+            try:
+                new_requests.append(request_queue.get(block=not engine.has_unfinished_requests()))
+                while True:
+                    new_requests.append(request_queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            aborted = []
+            for request in new_requests:
+                if request is None:
+                    return
+                kind, payload = request
+                if kind == "abort":
+                    request_id, finish_reason = payload
+                    if request_id in engine_ids:
+                        aborted.extend(engine.abort_request(engine_ids[request_id], finish_reason))
+                    continue
+                request_id, prompt, sampling_params, prompt_token_ids, scheduling = payload
+                try:
+                    engine_id = engine.add_request(prompt, sampling_params, prompt_token_ids, **scheduling)
+                    request_ids[engine_id], engine_ids[request_id] = request_id, engine_id
+                    error = None
+                except ValueError as e:
+                    error = str(e)
+                output_queue.put(("added", rank, (request_id, error)))
+            if aborted:
+                send_outputs(aborted)
+
+            if not engine.has_unfinished_requests():
+                continue
+            send_outputs(engine.step())
+    except Exception as e:
+        # The router fails this replica's requests and routes around it
+        print(f"[Engine] Replica {rank} failed: {type(e).__name__}: {e}")
+        output_queue.put(("failed", rank, f"{type(e).__name__}: {e}"))
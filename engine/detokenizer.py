@@ -0,0 +1,46 @@
+from typing import List
+
+from .scheduler import Sequence
+
+# How many prompt tokens to re-decode as context for the first generated
+# token, so leading spaces and merged byte sequences come out right.
+INITIAL_INCREMENTAL_DETOKENIZATION_OFFSET = 5
+
+class Detokenizer:
+    """
+    Incremental detokenization for all running sequences.
+    Each sequence keeps two offsets into its token ids: text before
+    read_offset has already been emitted, and decoding restarts at
+    prefix_offset so BPE merges across the boundary are seen. New text is
+    only emitted once it no longer ends in an incomplete UTF-8 character.
+    All sequences of a step are decoded with one batched tokenizer call.
+    """
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def init_sequence(self, seq: Sequence):
+        seq.read_offset = len(seq.prompt_token_ids)
+        seq.prefix_offset = max(seq.read_offset - INITIAL_INCREMENTAL_DETOKENIZATION_OFFSET, 0)
+
+    def decode_step(self, seqs: List[Sequence]) -> List[str]:
+        """Appends each sequence's newly stable text to seq.output_text and returns it."""
+        windows = []
+        for seq in seqs:
+            token_ids = seq.get_token_ids()
+            windows.append(token_ids[seq.prefix_offset:seq.read_offset].tolist())
+            windows.append(token_ids[seq.prefix_offset:].tolist())
+        texts = self.tokenizer.batch_decode(windows, skip_special_tokens=True)
+
+        deltas = []
+        for i, seq in enumerate(seqs):
+            prefix_text, full_text = texts[2 * i], texts[2 * i + 1]
+            if len(full_text) > len(prefix_text) and not full_text.endswith("�"):
+                delta = full_text[len(prefix_text):]
+                seq.prefix_offset = seq.read_offset
+                seq.read_offset = seq.get_len()
+            else:
+                # Incomplete character (or a skipped special token): wait for more tokens
+                delta = ""
+            seq.output_text += delta
+            deltas.append(delta)
+        return deltas
@@ -1,80 +1,820 @@
-from .scheduler import Scheduler
-from .block_manager import BlockManager, BlockAllocator
+from .scheduler import Scheduler, PreemptionMode, RequestStatus, Sequence, SequenceGroup
+from .block_manager import BlockManager, BlockTier
+from .policy import get_policy
+from .sampling_params import SamplingParams
+from .detokenizer import Detokenizer
+from .metrics import EngineMetrics, StepTimer
+from .stop_checker import StopChecker
+from .spec_decode import NGRAM_PROPOSER, DraftModelProposer, NgramProposer
+from model.memory_profiler import GiB, get_memory_budget
 from model.model_executor import ModelExecutor
+from model.quantization import DEFAULT_GROUP_SIZE
+from model.rejection_sampler import RejectionSampler
+from model.sampler import Sampler, get_logprobs
+from concurrent.futures import ThreadPoolExecutor
 from transformers import AutoTokenizer
+import copy
+import itertools
+import math
+import numpy as np
+import psutil
+import shutil
+import tempfile
+import threading
+import time
 import torch
+from typing import Dict, List, Optional, Tuple
+
+# Fraction of device memory (host RAM on CPU) the engine may fill when sizing its KV pool
+DEFAULT_GPU_MEMORY_UTILIZATION = 0.9
+# Swap space beyond this fraction of host RAM would leave too little for everything else
+MAX_SWAP_SPACE_FRACTION = 0.7
 
 class LLMEngine:
-    def __init__(self, model_name: str, block_size: int = 16, max_num_seqs: int = 16, max_total_tokens: int = 1024):
+    def __init__(self, model_name: str, block_size: int = 16, max_num_seqs: int = 16, max_total_tokens: int = 1024,
+                 num_gpu_blocks: Optional[int] = None, num_cpu_blocks: Optional[int] = None,
+                 preemption_mode: str = "recompute",
+                 enable_prefix_caching: bool = True, max_prefill_chunk_size: int = 512,
+                 num_speculative_tokens: int = 0, speculative_model: Optional[str] = None,
+                 scheduling_policy: str = "fcfs", tenant_weights: Optional[Dict[str, float]] = None,
+                 gpu_memory_utilization: float = DEFAULT_GPU_MEMORY_UTILIZATION,
+                 kv_cache_memory_gb: Optional[float] = None, swap_space_gb: float = 0.0,
+                 compile_decode: bool = False, compile_batch_sizes: Optional[List[int]] = None,
+                 compile_context_lens: Optional[List[int]] = None, compile_backend: str = "inductor",
+                 quantization: str = "fp32", quantization_group_size: int = DEFAULT_GROUP_SIZE,
+                 kv_cache_dtype: str = "auto", disk_swap_space_gb: float = 0.0, swap_dir: Optional[str] = None,
+                 warmup: bool = False):
+        """
+        The KV pool gets num_gpu_blocks blocks, or when that is None as many
+        as fit in kv_cache_memory_gb, or else in gpu_memory_utilization of the
+        device's memory once the weights and the peak activations of a
+        profiled worst-case batch are accounted for. The CPU swap pool gets
+        num_cpu_blocks blocks, or as many as fit in swap_space_gb. Once it is
+        full, swapped sequences go to disk_swap_space_gb of disk swap, a
+        memory-mapped file under swap_dir (default: the temp directory).
+        compile_decode runs decode steps through torch.compile'd graphs for
+        batches padded to compile_batch_sizes and contexts padded to
+        compile_context_lens (default: powers of 2 up to max_num_seqs and
+        powers of 4 blocks up to max_model_len), compiled at startup.
+        quantization picks the weight format of the target and draft models:
+        fp32, bf16, or (CPU only) int8_dynamic, int8 or int4 with groups of
+        quantization_group_size input channels.
+        kv_cache_dtype stores KV blocks in the model's dtype ("auto") or
+        quantized to int8 / fp8, which fits 2-4x more tokens in the same memory.
+        warmup runs a short request through every step phase before the
+        constructor returns, so the first real request does not pay for
+        lazy initialization. The duration of each startup phase is kept in
+        startup_timings and logged.
+        """
         self.model_name = model_name
         self.block_size = block_size
-        
-        print(f"[Engine] Initializing Scheduler (max_seqs={max_num_seqs})...")
-        self.scheduler = Scheduler(max_num_seqs=max_num_seqs, max_total_tokens=max_total_tokens)
-        
-        print(f"[Engine] Initializing BlockManager (block_size={block_size})...")
-        # TODO: Implement proper GPU memory profiling
-        num_gpu_blocks = 100 
-        self.block_allocator = BlockAllocator(num_blocks=num_gpu_blocks, block_size=block_size)
-        
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model_executor = ModelExecutor(model_name, device=self.device)
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        
+        self.startup_timings: Dict[str, float] = {}
+        startup_start = phase_start = time.perf_counter()
+
+        def mark(phase: str):
+            nonlocal phase_start
+            now = time.perf_counter()
+            self.startup_timings[phase] = now - phase_start
+            phase_start = now
+
+        def load_tokenizer():
+            start = time.perf_counter()
+            tokenizer = AutoTokenizer.from_pretrained(model_name)
+            self.startup_timings["load_tokenizer"] = time.perf_counter() - start
+            return tokenizer
+
+        # The tokenizer loads in parallel with the weights, so it is not part of the total
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            tokenizer_future = pool.submit(load_tokenizer)
+            self.model_executor = ModelExecutor(model_name, device=self.device, quantization=quantization,
+                                                group_size=quantization_group_size)
+            self.tokenizer = tokenizer_future.result()
+            mark("load_weights")
+        self.detokenizer = Detokenizer(self.tokenizer)
+        self.sampler = Sampler()
+        self.max_model_len = self.model_executor.model.config.max_position_embeddings
+        self.stop_checker = StopChecker(self.tokenizer.eos_token_id, self.max_model_len)
+
+        # Speculative decoding: a draft model, or prompt lookup ("[ngram]", the default).
+        # The draft is loaded before the KV pools are sized, so its weights are accounted for.
+        self.num_speculative_tokens = num_speculative_tokens
+        self.proposer = None
+        if num_speculative_tokens > 0:
+            if speculative_model is None or speculative_model == NGRAM_PROPOSER:
+                self.proposer = NgramProposer()
+            else:
+                self.proposer = DraftModelProposer(speculative_model, self.device, sampler=self.sampler,
+                                                   quantization=quantization, group_size=quantization_group_size)
+                draft_vocab = self.proposer.executor.model.config.vocab_size
+                if draft_vocab != self.model_executor.model.config.vocab_size:
+                    raise ValueError(f"Draft model vocab ({draft_vocab}) differs from the target's")
+                mark("load_draft_model")
+
+        executors = [self.model_executor]
+        if isinstance(self.proposer, DraftModelProposer):
+            executors.append(self.proposer.executor)
+        # Every block exists in each model's pool
+        block_nbytes = sum(executor.get_kv_block_nbytes(block_size, kv_cache_dtype) for executor in executors)
+        if num_gpu_blocks is None:
+            num_gpu_blocks = self._profile_num_gpu_blocks(executors, block_nbytes, max_num_seqs, max_total_tokens,
+                                                          gpu_memory_utilization, kv_cache_memory_gb)
+        mark("profile_memory")
+        if num_cpu_blocks is None:
+            num_cpu_blocks = self._get_num_cpu_blocks(block_nbytes, swap_space_gb)
+        num_disk_blocks = self._get_num_disk_blocks(block_nbytes, disk_swap_space_gb, swap_dir)
+        self.num_gpu_blocks = num_gpu_blocks
+        self.num_cpu_blocks = num_cpu_blocks
+        self.num_disk_blocks = num_disk_blocks
+        self.block_nbytes = block_nbytes
+        # How many requests of the maximum length the KV pool holds at once
+        self.max_concurrency = num_gpu_blocks * block_size / self.max_model_len
+        print(f"[Engine] KV cache: {num_gpu_blocks} blocks ({num_gpu_blocks * block_nbytes / 1024**2:.1f} MB), "
+              f"{num_cpu_blocks} swap blocks ({num_cpu_blocks * block_nbytes / 1024**2:.1f} MB), "
+              f"{num_disk_blocks} disk swap blocks ({num_disk_blocks * block_nbytes / 1024**2:.1f} MB); "
+              f"max concurrency {self.max_concurrency:.2f}x at {self.max_model_len} tokens per request")
+
+        for executor in executors:
+            executor.init_kv_cache(num_blocks=num_gpu_blocks, block_size=block_size, num_cpu_blocks=num_cpu_blocks,
+                                   kv_cache_dtype=kv_cache_dtype, num_disk_blocks=num_disk_blocks, swap_dir=swap_dir)
+        mark("allocate_kv_cache")
+
+        if compile_decode:
+            max_blocks = math.ceil(self.max_model_len / block_size)
+            batch_sizes = compile_batch_sizes or _geometric_buckets(max_num_seqs, 2)
+            block_buckets = ([math.ceil(n / block_size) for n in compile_context_lens] if compile_context_lens
+                             else _geometric_buckets(max_blocks, 4))
+            self.model_executor.enable_compile(batch_sizes, block_buckets, backend=compile_backend)
+            self.model_executor.warmup()
+            mark("compile")
+
+        print(f"[Engine] Initializing BlockManager (block_size={block_size})...")
+        self.block_manager = BlockManager(
+            block_size=block_size, num_gpu_blocks=num_gpu_blocks,
+            num_cpu_blocks=num_cpu_blocks, device=self.device,
+            enable_prefix_caching=enable_prefix_caching, num_disk_blocks=num_disk_blocks,
+        )
+
+        print(f"[Engine] Initializing Scheduler (max_seqs={max_num_seqs}, token_budget={max_total_tokens}, "
+              f"prefill_chunk={max_prefill_chunk_size}, preemption={preemption_mode}, "
+              f"policy={scheduling_policy})...")
+        policy_kwargs = {"weights": tenant_weights} if scheduling_policy == "fair" else {}
+        self.scheduler = Scheduler(
+            max_num_seqs=max_num_seqs, max_total_tokens=max_total_tokens,
+            block_manager=self.block_manager, preemption_mode=PreemptionMode(preemption_mode),
+            max_prefill_chunk_size=max_prefill_chunk_size,
+            policy=get_policy(scheduling_policy, **policy_kwargs),
+        )
+
+        if self.proposer is not None:
+            print(f"[Engine] Speculative decoding: {num_speculative_tokens} tokens from "
+                  f"{speculative_model or NGRAM_PROPOSER}")
+        self.rejection_sampler = RejectionSampler()
+
+        # Held while the engine updates its metrics, so get_metrics_snapshot sees whole steps
+        self._metrics_lock = threading.Lock()
+        self._reset_metrics()
         self.request_counter = 0
 
-    def add_request(self, prompt: str) -> str:
+        if warmup:
+            self._warmup()
+            mark("warmup")
+        self.startup_timings["total"] = time.perf_counter() - startup_start
+        print("[Engine] Startup: " + ", ".join(f"{phase} {seconds:.2f}s"
+                                               for phase, seconds in self.startup_timings.items()))
+
+    def _reset_metrics(self):
+        self.metrics = EngineMetrics()
+        self.metrics.num_gpu_blocks = self.num_gpu_blocks
+        self.metrics.num_cpu_blocks = self.num_cpu_blocks
+        self.metrics.num_disk_blocks = self.num_disk_blocks
+        self.metrics.max_concurrency = self.max_concurrency
+        # request_id -> [arrival time, time of its latest output], for the latency metrics
+        self._request_times: Dict[str, List] = {}
+
+    def _warmup(self, num_tokens: int = 8):
+        """
+        Generates num_tokens tokens from a short prompt so kernels, allocator
+        pools and thread pools are initialized before serving. The metrics
+        start from zero afterwards.
+        """
+        prompt_token_ids = [self.tokenizer.eos_token_id or 0] * num_tokens
+        self.add_request(None, SamplingParams(max_tokens=num_tokens, ignore_eos=True),
+                         prompt_token_ids=prompt_token_ids)
+        while self.has_unfinished_requests():
+            self.step()
+        self._reset_metrics()
+
+    def _profile_num_gpu_blocks(self, executors: List[ModelExecutor], block_nbytes: int, max_num_seqs: int,
+                                max_total_tokens: int, gpu_memory_utilization: float,
+                                kv_cache_memory_gb: Optional[float]) -> int:
+        """
+        Sizes the KV pool from an absolute budget, or from what is left of
+        the memory fraction after a worst-case batch (a full token budget over
+        max_num_seqs sequences) ran on every model. Blocks that max_num_seqs
+        requests of max_model_len tokens could never fill are not allocated.
+        """
+        if kv_cache_memory_gb is not None:
+            budget = int(kv_cache_memory_gb * GiB)
+        else:
+            peak = max(executor.profile_run(max_total_tokens, max_num_seqs) for executor in executors)
+            budget = get_memory_budget(self.device, gpu_memory_utilization) - peak
+            print(f"[Engine] Profiled peak activation memory: {peak / 1024**2:.1f} MB; "
+                  f"KV cache budget at {gpu_memory_utilization:.0%} utilization: {budget / GiB:.2f} GiB")
+        num_blocks = budget // block_nbytes
+        if num_blocks <= 0:
+            raise ValueError(
+                f"No memory left for the KV cache (budget {budget / GiB:.2f} GiB); raise "
+                f"gpu_memory_utilization or kv_cache_memory_gb, or lower max_total_tokens"
+            )
+        max_useful_blocks = max_num_seqs * math.ceil(self.max_model_len / self.block_size)
+        return min(num_blocks, max_useful_blocks)
+
+    def _get_num_cpu_blocks(self, block_nbytes: int, swap_space_gb: float) -> int:
+        swap_bytes = int(swap_space_gb * GiB)
+        total_ram = psutil.virtual_memory().total
+        if swap_bytes > MAX_SWAP_SPACE_FRACTION * total_ram:
+            raise ValueError(f"swap_space_gb={swap_space_gb} is more than {MAX_SWAP_SPACE_FRACTION:.0%} "
+                             f"of host RAM ({total_ram / GiB:.1f} GiB)")
+        return swap_bytes // block_nbytes
+
+    def _get_num_disk_blocks(self, block_nbytes: int, disk_swap_space_gb: float, swap_dir: Optional[str]) -> int:
+        swap_bytes = int(disk_swap_space_gb * GiB)
+        free_disk = shutil.disk_usage(swap_dir or tempfile.gettempdir()).free
+        if swap_bytes > free_disk:
+            raise ValueError(f"disk_swap_space_gb={disk_swap_space_gb} is more than the "
+                             f"{free_disk / GiB:.1f} GiB free in {swap_dir or tempfile.gettempdir()}")
+        return swap_bytes // block_nbytes
+
+    def add_request(self, prompt: Optional[str], sampling_params: Optional[SamplingParams] = None,
+                    prompt_token_ids: Optional[List[int]] = None,
+                    priority: int = 0, tenant: Optional[str] = None) -> str:
+        """
+        Queues a request; prompt is tokenized here unless its prompt_token_ids
+        are given (the async frontends tokenize off the event loop).
+        priority (lower runs first) and tenant are used by the scheduling policy.
+        Raises ValueError for prompts that can never run.
+        """
         req_id = str(self.request_counter)
         self.request_counter += 1
         
-        prompt_token_ids = self.tokenizer.encode(prompt)
-        self.scheduler.add_request(req_id, prompt, prompt_token_ids)
+        if prompt_token_ids is None:
+            prompt_token_ids = self.tokenizer.encode(prompt)
+        if not prompt_token_ids:
+            raise ValueError("Prompt is empty")
+        vocab_size = self.model_executor.model.config.vocab_size
+        if min(prompt_token_ids) < 0 or max(prompt_token_ids) >= vocab_size:
+            raise ValueError(f"Prompt token ids must be in [0, {vocab_size})")
+        if len(prompt_token_ids) >= self.max_model_len:
+            raise ValueError(
+                f"Prompt of {len(prompt_token_ids)} tokens leaves no room to generate "
+                f"(max_model_len={self.max_model_len})"
+            )
+        if sampling_params is not None and sampling_params.best_of > self.scheduler.max_num_seqs:
+            raise ValueError(
+                f"best_of={sampling_params.best_of} sequences can never run at once "
+                f"(max_num_seqs={self.scheduler.max_num_seqs})"
+            )
+        if not self.block_manager.can_ever_allocate(len(prompt_token_ids) + 1):
+            raise ValueError(
+                f"Prompt of {len(prompt_token_ids)} tokens does not fit in the KV cache "
+                f"({self.block_manager.allocator.num_blocks} blocks of {self.block_size} tokens)"
+            )
+        if sampling_params is not None and sampling_params.best_of > 1:
+            # Forked sequences only stop sharing blocks as they diverge, so budget each
+            # one at full length; a group that cannot run alone would preempt itself forever
+            max_len = min(len(prompt_token_ids) + sampling_params.max_tokens, self.max_model_len)
+            if not self.block_manager.can_ever_allocate(max_len, sampling_params.best_of):
+                raise ValueError(
+                    f"best_of={sampling_params.best_of} sequences of up to {max_len} tokens do not fit "
+                    f"in the KV cache ({self.block_manager.allocator.num_blocks} blocks of {self.block_size} tokens)"
+                )
+        generator = None
+        if sampling_params is not None and sampling_params.seed is not None:
+            generator = torch.Generator(device=self.device).manual_seed(sampling_params.seed)
+        group = self.scheduler.add_request(req_id, prompt or "", prompt_token_ids, sampling_params, generator,
+                                           priority, tenant)
+        for seq in group.get_seqs():
+            self.detokenizer.init_sequence(seq)
+        self._request_times[req_id] = [group.arrival_time, None]
         return req_id
 
+    def has_unfinished_requests(self) -> bool:
+        return self.scheduler.has_unfinished_requests()
+
+    def abort_request(self, req_id: str, finish_reason: str = "abort") -> List[dict]:
+        """
+        Stops a request wherever it is (waiting, running or swapped) and
+        frees its KV blocks immediately, e.g. when its client went away or
+        its deadline passed. Returns the outputs that finish its remaining
+        choices with finish_reason, or [] if the request already finished.
+        """
+        group = self.scheduler.abort_request(req_id)
+        if group is None:
+            return []
+        outputs = self._finish_outputs(group, finish_reason)
+        if not self.scheduler.has_unfinished_requests():
+            # Only finished groups are left in the queues: emptying them is free
+            self.scheduler.remove_finished_groups()
+        with self._metrics_lock:
+            self._record_finished(outputs[-1], time.time())
+            self._record_queue_state()
+        return outputs
+
+    def _finish_outputs(self, group: SequenceGroup, finish_reason: str) -> List[dict]:
+        """Outputs that end the remaining choices of a group stopped by the scheduler or an abort."""
+        params = group.sampling_params
+        outputs = []
+        for index in range(params.n):
+            seq = group.seqs[min(index, len(group.seqs) - 1)]
+            # Streamed choices that already finished were reported as such
+            if params.is_streamable and index < len(group.seqs) and seq.finish_reason is not None:
+                continue
+            output = self._make_output(group, seq, index, "", None, None)
+            output["finish_reason"] = finish_reason
+            outputs.append(output)
+        for seq in group.seqs:
+            seq.finish_reason = seq.finish_reason or finish_reason
+        for output in outputs[:-1]:
+            output["finished"] = False
+            output["spec_decode"] = None
+        return outputs
+
     def step(self):
         """
         Performs one decoding step.
-        1. Schedule sequences
-        2. Prepare batch inputs
+        1. Schedule sequences (admission, preemption, swaps)
+        2. Prefill chunks of new prompts, decode the newest token for the rest
         3. Run model inference
-        4. Update state
+        4. Sample (forking n / best_of requests on their first token, or
+           advancing beam search) and update state
         """
-        running_groups = self.scheduler.schedule()
-        if not running_groups:
-            return []
+        timer = StepTimer()
+        outputs = self._step(timer)
+        self._record_metrics(outputs, timer)
+        return outputs
 
-        # Prepare batch
-        # TODO: This naive preparation sends the full context every time.
-        # Future optimization: Send only new tokens and use KV cache.
-        input_ids = []
-        for group in running_groups:
-            seq = group.get_seqs()[0]
-            full_seq = seq.prompt_token_ids + seq.output_token_ids
-            input_ids.append(full_seq)
+    def _step(self, timer: StepTimer) -> List[dict]:
+        scheduler_outputs = self.scheduler.schedule()
+        timer.mark("schedule")
+        outputs = [out for group in scheduler_outputs.ignored_groups
+                   for out in self._finish_outputs(group, "length")]
+        scheduled = scheduler_outputs.scheduled_seqs
+        if not scheduled:
+            return outputs
+        groups = [group for group, _ in scheduled]
+        seqs = [seq for _, seq in scheduled]
 
-        logits = self.model_executor.forward(input_ids)
-        
-        # Greedy sampling
-        # logits shape: [batch_size, vocab_size]
-        next_token_ids = torch.argmax(logits, dim=-1).tolist()
-        
+        # Prefill chunks (prompt tokens past any prefix-cache hit) and single
+        # decode tokens are packed into one padding-free forward pass, kept
+        # within the scheduler's token budget.
+        chunk_sizes = scheduler_outputs.token_chunk_sizes
+        # Only a sequence whose whole context is cached after this step samples a token
+        sampled_idx = [
+            i for i, seq in enumerate(seqs) if seq.num_computed_tokens + chunk_sizes[i] == seq.get_len()
+        ]
+        blocks_to_copy = list(scheduler_outputs.blocks_to_copy)
+        num_spec_tokens = [0] * len(seqs)
+        if self.proposer is not None:
+            num_spec_tokens = self._reserve_spec_slots(groups, seqs, chunk_sizes, blocks_to_copy)
+
+        swaps = (scheduler_outputs.blocks_to_swap_in, scheduler_outputs.blocks_to_swap_out, blocks_to_copy)
+        swap_start = time.perf_counter()
+        self.model_executor.swap_blocks(*swaps)
+        if isinstance(self.proposer, DraftModelProposer):
+            self.proposer.swap_blocks(*swaps)
+        if scheduler_outputs.blocks_to_swap_in or scheduler_outputs.blocks_to_swap_out:
+            with self._metrics_lock:
+                self.metrics.record_swap(len(scheduler_outputs.blocks_to_swap_in) * self.block_nbytes,
+                                         len(scheduler_outputs.blocks_to_swap_out) * self.block_nbytes,
+                                         time.perf_counter() - swap_start)
+
+        input_ids = [
+            seq.get_token_ids()[seq.num_computed_tokens:seq.num_computed_tokens + size]
+            for seq, size in zip(seqs, chunk_sizes)
+        ]
+        start_positions = [seq.num_computed_tokens for seq in seqs]
+        block_tables = self.block_manager.get_block_tables([seq.seq_id for seq in seqs])
+        timer.num_scheduled_seqs = len(seqs)
+        timer.num_prefill_tokens = sum(
+            size for seq, size in zip(seqs, chunk_sizes)
+            if not (size == 1 and seq.get_output_len() and seq.num_computed_tokens + 1 == seq.get_len())
+        )
+        timer.mark("prepare")
+
+        drafts = [[] for _ in seqs]
+        draft_probs = [None] * len(seqs)
+        num_logits = None
+        if self.proposer is not None:
+            # Decoding sequences also feed their drafts; the target scores all of them at once
+            proposed, proposed_probs = self.proposer.propose(
+                [groups[i] for i in sampled_idx], [seqs[i] for i in sampled_idx],
+                [num_spec_tokens[i] for i in sampled_idx],
+                input_ids, start_positions, block_tables, sampled_idx,
+            )
+            for r, i in enumerate(sampled_idx):
+                drafts[i], draft_probs[i] = proposed[r], proposed_probs[r]
+            input_ids = [np.concatenate([ids, drafts[i]]) if drafts[i] else ids for i, ids in enumerate(input_ids)]
+            num_logits = [len(d) + 1 for d in drafts]
+
+        batch_logits = self.model_executor.execute_model(input_ids, start_positions, block_tables, num_logits)
+
+        for i, seq in enumerate(seqs):
+            seq.num_computed_tokens += chunk_sizes[i]
+            self.block_manager.mark_blocks_computed(seq.seq_id, seq.get_token_ids(), seq.num_computed_tokens)
+        timer.mark("forward")
+
+        if not sampled_idx:
+            return outputs
+
+        # Beam search advances all beams of a request at once; every other
+        # sequence samples its own row. An n / best_of request forks on its
+        # first token: the prompt's row is sampled once per sequence.
+        beam_rows: Dict[str, List[int]] = {}
+        rows, row_groups, row_seqs = [], [], []
+        for i in sampled_idx:
+            group, seq = groups[i], seqs[i]
+            params = group.sampling_params
+            if params.use_beam_search:
+                beam_rows.setdefault(group.request_id, []).append(i)
+                continue
+            new_seqs = [seq]
+            if params.best_of > 1 and seq.get_output_len() == 0 and len(group.seqs) == 1:
+                new_seqs += [self.scheduler.fork_seq(group, seq) for _ in range(params.best_of - 1)]
+            for new_seq in new_seqs:
+                rows.append(i)
+                row_groups.append(group)
+                row_seqs.append(new_seq)
+
+        # Row of each sequence's next-token logits (the last of its num_logits)
+        logit_rows = list(range(len(seqs)))
+        if num_logits is not None:
+            logit_rows = [end - 1 for end in itertools.accumulate(num_logits)]
+
+        for request_id, beam_idx in beam_rows.items():
+            outputs.extend(self._beam_search_step(
+                groups[beam_idx[0]], [seqs[i] for i in beam_idx], batch_logits[[logit_rows[i] for i in beam_idx]],
+                timer,
+            ))
+        if not rows:
+            timer.mark("sample")
+            return outputs
+
+        if self.proposer is None:
+            # Batched sampling with each request's own settings
+            # logits shape: [batch_size, vocab_size]
+            next_token_ids, logprobs = self.sampler(
+                batch_logits[[logit_rows[i] for i in rows]],
+                [group.sampling_params for group in row_groups],
+                [seq.prompt_token_ids for seq in row_seqs],
+                [seq.output_token_ids for seq in row_seqs],
+                [group.generator for group in row_groups],
+            )
+            new_token_ids = [[token_id] for token_id in next_token_ids]
+            new_logprobs = [[lp] for lp in logprobs]
+        else:
+            new_token_ids, new_logprobs = self._verify_drafts(
+                row_groups, row_seqs, batch_logits, num_logits, rows,
+                [drafts[i] for i in rows], [draft_probs[i] for i in rows],
+            )
+
+        timer.mark("sample")
+
+        # Sequences usually get one new token; with speculation they get several,
+        # which are appended, detokenized and stop-checked one round at a time
+        active = list(range(len(rows)))
+        token_idx = 0
+        while active:
+            timer.num_decode_tokens += len(active)
+            for r in active:
+                logprobs = new_logprobs[r][token_idx]
+                row_seqs[r].append_token_id(new_token_ids[r][token_idx], logprobs[0] if logprobs is not None else 0.0)
+            self.detokenizer.decode_step([row_seqs[r] for r in active])
+
+            still_active = []
+            for r in active:
+                group, seq = row_groups[r], row_seqs[r]
+                seq.finish_reason = self.stop_checker.check(seq, group.sampling_params)
+                if seq.finish_reason is not None:
+                    # Release the KV blocks right away so waiting requests can use them
+                    self._free_seq(group, seq)
+                elif token_idx + 1 < len(new_token_ids[r]):
+                    still_active.append(r)
+
+                if group.sampling_params.is_streamable:
+                    outputs.append(self._make_output(
+                        group, seq, group.seqs.index(seq), self.stop_checker.get_new_text(seq, group.sampling_params),
+                        new_token_ids[r][token_idx], new_logprobs[r][token_idx],
+                    ))
+                else:
+                    # Only the best n are returned, once all best_of are done
+                    seq.output_logprobs.append(new_logprobs[r][token_idx])
+                    if group.is_finished():
+                        outputs.extend(self._final_outputs(group))
+            active = still_active
+            token_idx += 1
+
+        if self.proposer is not None:
+            for r, seq in enumerate(row_seqs):
+                if seq.finish_reason is None and len(new_token_ids[r]) > 1:
+                    # Accepted drafts were already written to the KV cache by the verification pass
+                    seq.num_computed_tokens += len(new_token_ids[r]) - 1
+                    self.block_manager.mark_blocks_computed(seq.seq_id, seq.get_token_ids(), seq.num_computed_tokens)
+
+        timer.mark("detokenize")
+        return outputs
+
+    def get_metrics_snapshot(self) -> EngineMetrics:
+        """
+        A copy of the metrics that is safe to read or send from another
+        thread while the engine keeps stepping.
+        """
+        with self._metrics_lock:
+            return copy.deepcopy(self.metrics)
+
+    def _record_metrics(self, outputs: List[dict], timer: StepTimer):
+        # Once per step, so requests finishing together cost one pass over the queues
+        self.scheduler.remove_finished_groups()
+        with self._metrics_lock:
+            self._record_step_metrics(outputs, timer)
+
+    def _record_step_metrics(self, outputs: List[dict], timer: StepTimer):
+        metrics = self.metrics
+        metrics.record_step(timer)
+        now = time.time()
+        for out in outputs:
+            times = self._request_times.get(out["req_id"])
+            if times is None:
+                continue
+            arrival_time, last_output_time = times
+            if out["token_id"] is not None and last_output_time != now:
+                # One latency sample per request and step, however many tokens it got
+                if last_output_time is None:
+                    metrics.time_to_first_token.observe(now - arrival_time)
+                else:
+                    metrics.inter_token_latency.observe(now - last_output_time)
+                times[1] = now
+            if out["finished"]:
+                self._record_finished(out, now)
+        self._record_queue_state()
+
+    def _record_finished(self, out: dict, now: float):
+        metrics = self.metrics
+        arrival_time, _ = self._request_times.pop(out["req_id"])
+        metrics.e2e_request_latency.observe(now - arrival_time)
+        reason = out["finish_reason"]
+        metrics.num_finished_requests[reason] = metrics.num_finished_requests.get(reason, 0) + 1
+
+    def _record_queue_state(self):
+        metrics = self.metrics
+        scheduler = self.scheduler
+        metrics.num_waiting = len(scheduler.waiting)
+        metrics.num_running = len(scheduler.running)
+        metrics.num_swapped = len(scheduler.swapped)
+        metrics.num_swapped_seqs = {tier.value: self.block_manager.get_num_seqs(tier)
+                                    for tier in (BlockTier.HOST, BlockTier.DISK)}
+        metrics.num_preemptions = scheduler.num_preemptions
+        allocator = self.block_manager.allocator
+        metrics.kv_cache_usage = 1.0 - allocator.get_num_free_blocks() / allocator.num_blocks
+
+    def _free_seq(self, group: SequenceGroup, seq: Sequence):
+        self.scheduler.free_seq(seq)
+        if group.is_finished():
+            self.scheduler.free_finished_request(group.request_id)
+
+    @staticmethod
+    def _make_output(group: SequenceGroup, seq: Sequence, index: int, text: str, token_id: int, logprobs) -> dict:
+        finished = group.is_finished()
+        return {
+            "req_id": group.request_id,
+            "index": index,
+            "text": text,
+            "token_id": token_id,
+            "logprobs": logprobs,
+            "finished": finished,
+            "finish_reason": seq.finish_reason,
+            "prompt_tokens": len(seq.prompt_token_ids),
+            "completion_tokens": group.get_num_output_tokens(),
+            # Per-request speculation counts, on the final output only
+            "spec_decode": group.get_spec_decode_stats() if finished else None,
+        }
+
+    def _final_outputs(self, group: SequenceGroup) -> List[dict]:
+        """
+        The n best sequences of a finished best_of / beam search request,
+        replayed token by token; the first output of each carries its text.
+        """
+        params = group.sampling_params
+        if params.use_beam_search:
+            best = sorted(group.seqs, key=lambda s: _beam_score(s, params.length_penalty), reverse=True)
+        else:
+            best = sorted(group.seqs, key=lambda s: s.cumulative_logprob, reverse=True)
         outputs = []
-        for i, group in enumerate(running_groups):
-            seq = group.get_seqs()[0]
-            token_id = next_token_ids[i]
-            
-            seq.append_token_id(token_id)
-            text = self.tokenizer.decode([token_id])
-            
-            # Simple stop condition for MVP
-            is_finished = seq.get_len() > 50
-            if is_finished:
-                self.scheduler.free_finished_request(group.request_id)
-                
-            outputs.append({
-                "req_id": group.request_id, 
-                "text": text, 
-                "finished": is_finished
-            })
-            
+        for index, seq in enumerate(best[:params.n]):
+            text = self.stop_checker.get_new_text(seq, params)
+            for j, token_id in enumerate(seq.output_token_ids.tolist()):
+                output = self._make_output(group, seq, index, text if j == 0 else "", token_id,
+                                           seq.output_logprobs[j] if params.logprobs is not None else None)
+                output["finish_reason"] = None
+                outputs.append(output)
+            outputs[-1]["finish_reason"] = seq.finish_reason
+        for output in outputs[:-1]:
+            output["finished"] = False
+            output["spec_decode"] = None
         return outputs
+
+    def _beam_search_step(self, group: SequenceGroup, beams: List[Sequence], logits: torch.Tensor,
+                          timer: StepTimer) -> List[dict]:
+        """
+        Extends the request's beams by one token. The 2 * width best
+        (beam, token) extensions by cumulative logprob are taken in order:
+        ones that end the sequence (EOS, stop tokens) finish, the rest become
+        the next beams until width of them run. A beam with several
+        extensions is forked, one with none is dropped. The request finishes
+        when no running beam scores above the worst of the best_of finished
+        ones, or when every beam hit a limit.
+        """
+        params = group.sampling_params
+        # Beams that did not sample this step (mid re-prefill) keep their place
+        width = max(params.best_of - (len(group.get_unfinished_seqs()) - len(beams)), 1)
+        logits, logprobs = self.sampler.process_logits(
+            logits, [params] * len(beams), [b.prompt_token_ids for b in beams], [b.output_token_ids for b in beams],
+        )
+        beam_logprobs = torch.log_softmax(logits, dim=-1)
+        vocab_size = beam_logprobs.shape[-1]
+        cumulative = beam_logprobs + torch.tensor([b.cumulative_logprob for b in beams], device=logits.device)[:, None]
+        candidates = cumulative.flatten().topk(min(2 * width, cumulative.numel())).indices.tolist()
+
+        end_token_ids = set(params.stop_token_ids)
+        if not params.ignore_eos:
+            end_token_ids.add(self.stop_checker.eos_token_id)
+        extensions: Dict[int, List[int]] = {}
+        num_running = 0
+        for candidate in candidates:
+            b, token_id = divmod(candidate, vocab_size)
+            extensions.setdefault(b, []).append(token_id)
+            if token_id not in end_token_ids:
+                num_running += 1
+                if num_running == width:
+                    break
+
+        # Fork before appending: children start from their parent's state
+        extended = []
+        for b, beam in enumerate(beams):
+            token_ids = extensions.get(b)
+            if not token_ids:
+                self.scheduler.free_seq(beam)
+                group.seqs.remove(beam)
+                continue
+            children = [beam] + [self.scheduler.fork_seq(group, beam) for _ in token_ids[1:]]
+            extended.extend((child, b, token_id) for child, token_id in zip(children, token_ids))
+
+        token_logprobs = get_logprobs(
+            logprobs[[b for _, b, _ in extended]] if logprobs is not None else None,
+            torch.tensor([t for _, _, t in extended], device=logits.device),
+            [params] * len(extended),
+        )
+        timer.num_decode_tokens += len(extended)
+        for (seq, b, token_id), lp in zip(extended, token_logprobs):
+            seq.append_token_id(token_id, beam_logprobs[b, token_id].item())
+            seq.output_logprobs.append(lp)
+        self.detokenizer.decode_step([seq for seq, _, _ in extended])
+        for seq, _, _ in extended:
+            seq.finish_reason = self.stop_checker.check(seq, params)
+            if seq.finish_reason is not None:
+                self.scheduler.free_seq(seq)
+
+        # Keep the best_of best finished beams; stop once no running beam can beat them
+        finished = sorted(group.get_seqs(RequestStatus.FINISHED),
+                          key=lambda s: _beam_score(s, params.length_penalty), reverse=True)
+        for seq in finished[params.best_of:]:
+            group.seqs.remove(seq)
+        running = group.get_unfinished_seqs()
+        if running and len(finished) >= params.best_of:
+            worst_finished = _beam_score(finished[params.best_of - 1], params.length_penalty)
+            if max(_beam_score(s, params.length_penalty) for s in running) <= worst_finished:
+                for seq in running:
+                    self.scheduler.free_seq(seq)
+                    group.seqs.remove(seq)
+
+        if not group.is_finished():
+            return []
+        self.scheduler.free_finished_request(group.request_id)
+        return self._final_outputs(group)
+
+    def _reserve_spec_slots(self, groups: List[SequenceGroup], seqs: List[Sequence], chunk_sizes: List[int],
+                            blocks_to_copy: List[Tuple[int, int]]) -> List[int]:
+        """
+        Number of tokens to draft for each scheduled sequence, with KV slots
+        reserved for them. Only decoding sequences of single-sequence
+        requests speculate, never past max_tokens or the model's context,
+        and only if blocks are free.
+        Draft tokens are not charged to the scheduler's token budget.
+        """
+        num_spec_tokens = []
+        for group, seq, chunk_size in zip(groups, seqs, chunk_sizes):
+            num_tokens = 0
+            # The first token always comes from the prompt pass, cached or not
+            if (group.sampling_params.best_of == 1 and seq.get_output_len() and chunk_size == 1
+                    and seq.num_computed_tokens + 1 == seq.get_len()):
+                num_tokens = min(
+                    self.num_speculative_tokens,
+                    group.sampling_params.max_tokens - seq.get_output_len() - 1,
+                    self.max_model_len - seq.get_len() - 1,
+                )
+                total_len = seq.get_len() + num_tokens
+                if num_tokens > 0 and self.block_manager.can_append_slot(seq.seq_id, total_len, seq.num_computed_tokens):
+                    blocks_to_copy.extend(
+                        self.block_manager.append_slot(seq.seq_id, total_len, seq.num_computed_tokens)
+                    )
+                else:
+                    num_tokens = 0
+            num_spec_tokens.append(num_tokens)
+        return num_spec_tokens
+
+    def _verify_drafts(self, groups: List[SequenceGroup], seqs: List[Sequence], batch_logits: torch.Tensor,
+                       num_logits: List[int], sampled_idx: List[int], drafts: List[List[int]],
+                       draft_probs: List[Optional[torch.Tensor]]):
+        """
+        Rejection-samples each sequence's drafts against the target logits.
+        Row j of a sequence is the target distribution after its first j
+        drafts, so penalties see those drafts as already generated.
+        """
+        logits_starts = list(itertools.accumulate(num_logits, initial=0))
+        rows, row_params, row_prompts, row_outputs = [], [], [], []
+        for group, seq, i, seq_drafts in zip(groups, seqs, sampled_idx, drafts):
+            for j in range(len(seq_drafts) + 1):
+                rows.append(logits_starts[i] + j)
+                row_params.append(group.sampling_params)
+                row_prompts.append(seq.prompt_token_ids)
+                row_outputs.append(np.concatenate([seq.output_token_ids, np.array(seq_drafts[:j], dtype=np.int64)]))
+
+        probs, logprobs = self.sampler.get_probs(batch_logits[rows], row_params, row_prompts, row_outputs)
+        new_token_ids = self.rejection_sampler(probs, drafts, draft_probs, [g.generator for g in groups])
+
+        # Logprobs of every emitted token come from the row that produced it
+        emitted_rows = []
+        row_start = 0
+        for seq_drafts, token_ids in zip(drafts, new_token_ids):
+            emitted_rows.extend(range(row_start, row_start + len(token_ids)))
+            row_start += len(seq_drafts) + 1
+        flat_logprobs = get_logprobs(
+            logprobs[emitted_rows] if logprobs is not None else None,
+            torch.tensor(list(itertools.chain.from_iterable(new_token_ids)), device=probs.device),
+            [row_params[r] for r in emitted_rows],
+        )
+        new_logprobs = []
+        for token_ids in new_token_ids:
+            new_logprobs.append(flat_logprobs[:len(token_ids)])
+            flat_logprobs = flat_logprobs[len(token_ids):]
+
+        num_steps = num_draft_tokens = num_accepted_tokens = 0
+        for group, seq_drafts, token_ids in zip(groups, drafts, new_token_ids):
+            if not seq_drafts:
+                continue
+            group.num_spec_steps += 1
+            group.num_draft_tokens += len(seq_drafts)
+            group.num_accepted_tokens += len(token_ids) - 1
+            num_steps += 1
+            num_draft_tokens += len(seq_drafts)
+            num_accepted_tokens += len(token_ids) - 1
+        with self._metrics_lock:
+            self.metrics.num_spec_decode_steps += num_steps
+            self.metrics.num_draft_tokens += num_draft_tokens
+            self.metrics.num_accepted_tokens += num_accepted_tokens
+        return new_token_ids, new_logprobs
+
+    def get_spec_decode_metrics(self) -> Dict[str, float]:
+        """
+        Engine-wide speculation totals since the metrics were reset.
+        acceptance_rate: accepted / proposed draft tokens.
+        tokens_per_step: tokens a sequence emits per speculative step,
+        averaged over all of them (at most num_speculative_tokens + 1).
+        Per-request figures are in the "spec_decode" field of a request's
+        final output.
+        """
+        metrics = self.metrics
+        steps = metrics.num_spec_decode_steps
+        return {
+            "acceptance_rate": metrics.num_accepted_tokens / max(metrics.num_draft_tokens, 1),
+            "tokens_per_step": (metrics.num_accepted_tokens + steps) / max(steps, 1),
+            "num_draft_tokens": metrics.num_draft_tokens,
+            "num_accepted_tokens": metrics.num_accepted_tokens,
+        }
+
+    def get_prefix_cache_hit_rate(self) -> float:
+        """Fraction of full prompt blocks served from the prefix cache."""
+        return self.block_manager.get_prefix_cache_hit_rate()
+
+def _geometric_buckets(limit: int, factor: int) -> List[int]:
+    """1, factor, factor**2, ... below limit, then limit itself."""
+    buckets = [1]
+    while buckets[-1] * factor < limit:
+        buckets.append(buckets[-1] * factor)
+    if buckets[-1] < limit:
+        buckets.append(limit)
+    return buckets
+
+def _beam_score(seq: Sequence, length_penalty: float) -> float:
+    """Cumulative logprob normalized by output length, so beams of different lengths compare."""
+    return seq.cumulative_logprob / max(seq.get_output_len(), 1) ** length_penalty
@@ -0,0 +1,224 @@
+import bisect
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+# Histogram upper bounds in seconds
+REQUEST_LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1.0,
+                           2.5, 5.0, 7.5, 10.0, 20.0, 40.0, 80.0)
+STEP_TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                     0.1, 0.25, 0.5, 1.0, 2.5)
+# The phases of LLMEngine.step, in order
+STEP_PHASES = ("schedule", "prepare", "forward", "sample", "detokenize")
+# Window over which the token throughput gauges are averaged
+THROUGHPUT_WINDOW = 5.0
+
+METRIC_PREFIX = "minivllm_"
+
+class Histogram:
+    """Prometheus-style histogram; observe() is one bisect and three adds."""
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class StepTimer:
+    """Wall time of each phase of one engine step, plus its token counts."""
+    def __init__(self):
+        self.phase_times: Dict[str, float] = {}
+        self.num_prefill_tokens = 0
+        self.num_decode_tokens = 0
+        self.num_scheduled_seqs = 0
+        self._last = time.perf_counter()
+
+    def mark(self, phase: str):
+        """Charges the time since the previous mark to phase."""
+        now = time.perf_counter()
+        self.phase_times[phase] = self.phase_times.get(phase, 0.0) + now - self._last
+        self._last = now
+
+class EngineMetrics:
+    """
+    Counters, gauges and histograms of one engine, updated once per step by
+    the engine thread and rendered in the Prometheus text format on demand.
+    Everything is plain numbers and lists, so a replica can ship a copy to
+    the router. Updates are a handful of adds per step and per request, far
+    below the cost of the step itself.
+    """
+    def __init__(self):
+        self.time_to_first_token = Histogram(REQUEST_LATENCY_BUCKETS)
+        self.inter_token_latency = Histogram(REQUEST_LATENCY_BUCKETS)
+        self.e2e_request_latency = Histogram(REQUEST_LATENCY_BUCKETS)
+        self.step_phase_time = {phase: Histogram(STEP_TIME_BUCKETS) for phase in STEP_PHASES}
+
+        self.num_prefill_tokens = 0
+        self.num_decode_tokens = 0
+        self.num_finished_requests: Dict[str, int] = {}
+        self.num_preemptions = 0
+        self.swap_in_bytes = 0
+        self.swap_out_bytes = 0
+        self.swap_time = 0.0
+        # Speculative decoding: sequence steps that verified drafts, drafts proposed and accepted
+        self.num_spec_decode_steps = 0
+        self.num_draft_tokens = 0
+        self.num_accepted_tokens = 0
+
+        self.num_waiting = 0
+        self.num_running = 0
+        self.num_swapped = 0
+        # Swapped sequences per swap tier ("host", "disk")
+        self.num_swapped_seqs: Dict[str, int] = {}
+        # Bytes per second of the latest step that swapped
+        self.swap_bandwidth = 0.0
+        self.batch_size = 0
+        self.kv_cache_usage = 0.0
+        # KV pool sizing, fixed at startup
+        self.num_gpu_blocks = 0
+        self.num_cpu_blocks = 0
+        self.num_disk_blocks = 0
+        self.max_concurrency = 0.0
+        # (time.monotonic(), prefill, decode token totals) after the steps of the last
+        # THROUGHPUT_WINDOW seconds; the first entry is the baseline of the rates
+        self._token_history: Deque[Tuple[float, int, int]] = deque([(time.monotonic(), 0, 0)])
+
+    def record_step(self, timer: StepTimer):
+        for phase, seconds in timer.phase_times.items():
+            self.step_phase_time[phase].observe(seconds)
+        self.num_prefill_tokens += timer.num_prefill_tokens
+        self.num_decode_tokens += timer.num_decode_tokens
+        self.batch_size = timer.num_scheduled_seqs
+
+        now = time.monotonic()
+        history = self._token_history
+        history.append((now, self.num_prefill_tokens, self.num_decode_tokens))
+        while len(history) > 2 and history[1][0] <= now - THROUGHPUT_WINDOW:
+            history.popleft()
+
+    def get_throughput(self, now: Optional[float] = None) -> Tuple[float, float]:
+        """
+        Prefill and decode tokens per second over the THROUGHPUT_WINDOW
+        seconds before now (time.monotonic()); both fall to 0 once the
+        engine has been idle for a whole window.
+        """
+        now = time.monotonic() if now is None else now
+        start = now - THROUGHPUT_WINDOW
+        history = self._token_history
+        base = history[0]
+        for entry in history:
+            if entry[0] > start:
+                break
+            base = entry
+        _, prefill_total, decode_total = history[-1]
+        elapsed = min(THROUGHPUT_WINDOW, now - history[0][0])
+        if elapsed <= 0:
+            return 0.0, 0.0
+        return (prefill_total - base[1]) / elapsed, (decode_total - base[2]) / elapsed
+
+    def record_swap(self, swap_in_bytes: int, swap_out_bytes: int, seconds: float):
+        self.swap_in_bytes += swap_in_bytes
+        self.swap_out_bytes += swap_out_bytes
+        self.swap_time += seconds
+        if seconds > 0:
+            self.swap_bandwidth = (swap_in_bytes + swap_out_bytes) / seconds
+
+def render_metrics(replicas: List[Tuple[Dict[str, str], EngineMetrics]]) -> str:
+    """
+    Prometheus text exposition of one or more engines; labels (e.g. the
+    replica) tell their samples apart.
+    """
+    lines: List[str] = []
+
+    def family(name: str, kind: str, help_text: str):
+        lines.append(f"# HELP {METRIC_PREFIX}{name} {help_text}")
+        lines.append(f"# TYPE {METRIC_PREFIX}{name} {kind}")
+
+    def sample(name: str, labels: Dict[str, str], value: float):
+        label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+        lines.append(f"{METRIC_PREFIX}{name}{{{label_text}}} {value}" if label_text
+                     else f"{METRIC_PREFIX}{name} {value}")
+
+    def histogram(name: str, labels: Dict[str, str], hist: Histogram):
+        cumulative = 0
+        for bound, count in zip(hist.buckets, hist.counts):
+            cumulative += count
+            sample(f"{name}_bucket", {**labels, "le": repr(bound)}, cumulative)
+        sample(f"{name}_bucket", {**labels, "le": "+Inf"}, hist.count)
+        sample(f"{name}_sum", labels, hist.sum)
+        sample(f"{name}_count", labels, hist.count)
+
+    histograms = [
+        ("time_to_first_token_seconds", "Time from arrival to the first output token.", "time_to_first_token"),
+        ("inter_token_latency_seconds", "Time between consecutive outputs of a request.", "inter_token_latency"),
+        ("e2e_request_latency_seconds", "Time from arrival to the last output.", "e2e_request_latency"),
+    ]
+    for name, help_text, attr in histograms:
+        family(name, "histogram", help_text)
+        for labels, metrics in replicas:
+            histogram(name, labels, getattr(metrics, attr))
+
+    family("step_phase_seconds", "histogram", "Engine step time per phase.")
+    for labels, metrics in replicas:
+        for phase in STEP_PHASES:
+            histogram("step_phase_seconds", {**labels, "phase": phase}, metrics.step_phase_time[phase])
+
+    counters = [
+        ("prefill_tokens_total", "Prompt tokens computed (prefill chunks, recomputation).", "num_prefill_tokens"),
+        ("decode_tokens_total", "Tokens generated.", "num_decode_tokens"),
+        ("preemptions_total", "Requests preempted.", "num_preemptions"),
+        ("kv_swap_in_bytes_total", "KV cache bytes copied back from swap space.", "swap_in_bytes"),
+        ("kv_swap_out_bytes_total", "KV cache bytes copied out to swap space.", "swap_out_bytes"),
+        ("kv_swap_seconds_total", "Time spent copying KV cache blocks to and from swap space.", "swap_time"),
+        ("spec_decode_steps_total", "Sequence steps that verified speculative drafts.", "num_spec_decode_steps"),
+        ("spec_decode_draft_tokens_total", "Draft tokens proposed for verification.", "num_draft_tokens"),
+        ("spec_decode_accepted_tokens_total", "Draft tokens accepted by the target model.", "num_accepted_tokens"),
+    ]
+    for name, help_text, attr in counters:
+        family(name, "counter", help_text)
+        for labels, metrics in replicas:
+            sample(name, labels, getattr(metrics, attr))
+
+    family("requests_finished_total", "counter", "Finished requests by finish reason.")
+    for labels, metrics in replicas:
+        for reason, count in sorted(metrics.num_finished_requests.items()):
+            sample("requests_finished_total", {**labels, "finish_reason": reason}, count)
+
+    gauges = [
+        ("requests_waiting", "Requests waiting to be scheduled.", "num_waiting"),
+        ("requests_running", "Requests running.", "num_running"),
+        ("requests_swapped", "Requests swapped out.", "num_swapped"),
+        ("batch_size", "Sequences in the last step's batch.", "batch_size"),
+        ("kv_cache_usage_ratio", "Fraction of KV cache blocks in use.", "kv_cache_usage"),
+        ("kv_cache_blocks", "KV cache blocks on the device.", "num_gpu_blocks"),
+        ("kv_cache_swap_blocks", "KV cache blocks of CPU swap space.", "num_cpu_blocks"),
+        ("kv_cache_disk_swap_blocks", "KV cache blocks of memory-mapped disk swap space.", "num_disk_blocks"),
+        ("kv_swap_bandwidth_bytes_per_second", "Swap copy bandwidth of the latest step that swapped.",
+         "swap_bandwidth"),
+        ("max_concurrency", "Requests of the maximum length the KV cache holds at once.", "max_concurrency"),
+    ]
+    for name, help_text, attr in gauges:
+        family(name, "gauge", help_text)
+        for labels, metrics in replicas:
+            sample(name, labels, getattr(metrics, attr))
+
+    # Computed at scrape time, so they fall to 0 while the engine is idle
+    now = time.monotonic()
+    throughputs = [(labels, metrics.get_throughput(now)) for labels, metrics in replicas]
+    family("prefill_throughput_tokens_per_second", "gauge", "Prefill tokens per second (recent average).")
+    for labels, (prefill, _) in throughputs:
+        sample("prefill_throughput_tokens_per_second", labels, prefill)
+    family("decode_throughput_tokens_per_second", "gauge", "Generated tokens per second (recent average).")
+    for labels, (_, decode) in throughputs:
+        sample("decode_throughput_tokens_per_second", labels, decode)
+
+    family("sequences_swapped", "gauge", "Sequences whose KV cache is in swap space, by tier.")
+    for labels, metrics in replicas:
+        for tier, count in sorted(metrics.num_swapped_seqs.items()):
+            sample("sequences_swapped", {**labels, "tier": tier}, count)
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,128 @@
+from collections import defaultdict
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    # The scheduler imports the policies
+    from .scheduler import SequenceGroup
+
+# Seconds of waiting that are worth one priority class (PriorityPolicy), or
+# that double a waiting job's response ratio (SJFPolicy)
+DEFAULT_AGING_INTERVAL = 10.0
+# Tokens of service a tenant must be ahead before its running requests are preempted
+DEFAULT_FAIRNESS_THRESHOLD = 512.0
+
+class Policy:
+    """
+    Decides the order in which the scheduler serves requests.
+    get_priority returns a sort key; smaller keys run first, and running
+    groups with the largest keys are the first to be preempted.
+    should_preempt lets a waiting group evict a running one even when
+    memory is not short; the base policy never does.
+    The hooks let stateful policies track requests and the service they get.
+    """
+    def get_priority(self, now: float, group: "SequenceGroup") -> Tuple:
+        raise NotImplementedError
+
+    def sort_by_priority(self, now: float, groups: Iterable["SequenceGroup"]) -> List["SequenceGroup"]:
+        return sorted(groups, key=lambda group: self.get_priority(now, group))
+
+    def should_preempt(self, now: float, waiting: "SequenceGroup", running: "SequenceGroup") -> bool:
+        return False
+
+    def on_add(self, group: "SequenceGroup"):
+        pass
+
+    def on_scheduled(self, group: "SequenceGroup", num_tokens: int):
+        pass
+
+    def on_finish(self, group: "SequenceGroup"):
+        pass
+
+class FCFSPolicy(Policy):
+    """First come, first served."""
+    def get_priority(self, now: float, group: "SequenceGroup") -> Tuple:
+        return (group.arrival_time,)
+
+class PriorityPolicy(Policy):
+    """
+    Priority classes (lower runs first), FCFS within a class. A request
+    moves up one class per aging_interval seconds of waiting, so low
+    classes cannot starve. Only a strictly higher class (before aging)
+    that is also ahead after aging preempts a running request.
+    """
+    def __init__(self, aging_interval: float = DEFAULT_AGING_INTERVAL):
+        self.aging_interval = aging_interval
+
+    def get_priority(self, now: float, group: "SequenceGroup") -> Tuple:
+        return (group.priority - (now - group.arrival_time) / self.aging_interval, group.arrival_time)
+
+    def should_preempt(self, now: float, waiting: "SequenceGroup", running: "SequenceGroup") -> bool:
+        return (waiting.priority < running.priority
+                and self.get_priority(now, waiting) < self.get_priority(now, running))
+
+class SJFPolicy(Policy):
+    """
+    Shortest expected job first: the tokens a request still has to
+    prefill and generate (up to max_tokens). The estimate is divided by
+    1 + waited / aging_interval (highest response ratio next), so long jobs
+    eventually run. Running jobs are never preempted for shorter ones:
+    their progress would be lost.
+    """
+    def __init__(self, aging_interval: float = DEFAULT_AGING_INTERVAL):
+        self.aging_interval = aging_interval
+
+    def get_priority(self, now: float, group: "SequenceGroup") -> Tuple:
+        seq = group.get_seqs()[0]
+        expected_tokens = (seq.get_len() - seq.num_computed_tokens
+                           + max(group.sampling_params.max_tokens - seq.get_output_len(), 0))
+        waited = max(now - group.arrival_time, 0.0)
+        return (expected_tokens / (1.0 + waited / self.aging_interval), group.arrival_time)
+
+class FairPolicy(Policy):
+    """
+    Weighted fair queuing across tenants (API keys), FCFS within a tenant.
+    Every scheduled token advances its tenant's virtual time by
+    1 / weight, and the tenant with the least virtual time goes first. A
+    tenant that becomes active starts at the least virtual time of the
+    active tenants, so idle periods are not banked. Running requests of a
+    tenant more than threshold tokens ahead of a waiting tenant are
+    preempted. Nothing starves: every waiting tenant's virtual time is
+    eventually the smallest.
+    """
+    def __init__(self, weights: Optional[Dict[str, float]] = None,
+                 threshold: float = DEFAULT_FAIRNESS_THRESHOLD):
+        self.weights = weights or {}
+        self.threshold = threshold
+        self.virtual_time: Dict[Optional[str], float] = defaultdict(float)
+        self.num_active: Dict[Optional[str], int] = defaultdict(int)
+
+    def get_priority(self, now: float, group: "SequenceGroup") -> Tuple:
+        return (self.virtual_time[group.tenant], group.arrival_time)
+
+    def should_preempt(self, now: float, waiting: "SequenceGroup", running: "SequenceGroup") -> bool:
+        return self.virtual_time[running.tenant] - self.virtual_time[waiting.tenant] > self.threshold
+
+    def on_add(self, group: "SequenceGroup"):
+        if self.num_active[group.tenant] == 0:
+            active = [self.virtual_time[t] for t, n in self.num_active.items() if n > 0]
+            if active:
+                self.virtual_time[group.tenant] = max(self.virtual_time[group.tenant], min(active))
+        self.num_active[group.tenant] += 1
+
+    def on_scheduled(self, group: "SequenceGroup", num_tokens: int):
+        self.virtual_time[group.tenant] += num_tokens / self.weights.get(group.tenant, 1.0)
+
+    def on_finish(self, group: "SequenceGroup"):
+        self.num_active[group.tenant] -= 1
+
+POLICIES = {
+    "fcfs": FCFSPolicy,
+    "priority": PriorityPolicy,
+    "sjf": SJFPolicy,
+    "fair": FairPolicy,
+}
+
+def get_policy(name: str, **kwargs) -> Policy:
+    if name not in POLICIES:
+        raise ValueError(f"Unknown scheduling policy {name!r}, expected one of {sorted(POLICIES)}")
+    return POLICIES[name](**kwargs)
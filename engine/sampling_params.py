@@ -0,0 +1,101 @@
+from typing import List, Optional, Union
+
+_SAMPLING_EPS = 1e-5
+
+class SamplingParams:
+    """
+    Per-request decoding settings.
+    temperature == 0 means greedy decoding; the remaining filters and
+    penalties follow the OpenAI / HuggingFace conventions.
+    A request finishes after max_tokens generated tokens, on EOS (unless
+    ignore_eos), on any of stop_token_ids, or once its text contains one of
+    the stop strings.
+    best_of sequences are generated per request and the n best (by
+    cumulative logprob) are returned; with use_beam_search they are the
+    beams of a greedy beam search instead, ranked by
+    cumulative_logprob / len ** length_penalty.
+    """
+    def __init__(self, temperature: float = 0.0, top_k: int = -1, top_p: float = 1.0, min_p: float = 0.0,
+                 repetition_penalty: float = 1.0, presence_penalty: float = 0.0, frequency_penalty: float = 0.0,
+                 seed: Optional[int] = None, logprobs: Optional[int] = None, max_tokens: int = 16,
+                 stop: Optional[Union[str, List[str]]] = None, stop_token_ids: Optional[List[int]] = None,
+                 ignore_eos: bool = False, include_stop_str_in_output: bool = False,
+                 n: int = 1, best_of: Optional[int] = None, use_beam_search: bool = False,
+                 length_penalty: float = 1.0):
+        self.temperature = temperature
+        self.top_k = top_k                      # -1 disables top-k
+        self.top_p = top_p
+        self.min_p = min_p
+        self.repetition_penalty = repetition_penalty
+        self.presence_penalty = presence_penalty
+        self.frequency_penalty = frequency_penalty
+        self.seed = seed
+        self.logprobs = logprobs                # number of top alternatives to return
+        self.max_tokens = max_tokens
+        if stop is None:
+            stop = []
+        elif isinstance(stop, str):
+            stop = [stop]
+        self.stop: List[str] = list(stop)
+        self.stop_token_ids: List[int] = list(stop_token_ids or [])
+        self.ignore_eos = ignore_eos
+        self.include_stop_str_in_output = include_stop_str_in_output
+        self.n = n
+        self.best_of = best_of if best_of is not None else n
+        self.use_beam_search = use_beam_search
+        self.length_penalty = length_penalty
+        self._verify()
+
+    def _verify(self):
+        if self.temperature < 0.0:
+            raise ValueError(f"temperature must be non-negative, got {self.temperature}")
+        if self.top_k == 0 or self.top_k < -1:
+            raise ValueError(f"top_k must be -1 (disabled) or at least 1, got {self.top_k}")
+        if not 0.0 < self.top_p <= 1.0:
+            raise ValueError(f"top_p must be in (0, 1], got {self.top_p}")
+        if not 0.0 <= self.min_p <= 1.0:
+            raise ValueError(f"min_p must be in [0, 1], got {self.min_p}")
+        if self.repetition_penalty <= 0.0:
+            raise ValueError(f"repetition_penalty must be positive, got {self.repetition_penalty}")
+        if not -2.0 <= self.presence_penalty <= 2.0:
+            raise ValueError(f"presence_penalty must be in [-2, 2], got {self.presence_penalty}")
+        if not -2.0 <= self.frequency_penalty <= 2.0:
+            raise ValueError(f"frequency_penalty must be in [-2, 2], got {self.frequency_penalty}")
+        if self.logprobs is not None and self.logprobs < 0:
+            raise ValueError(f"logprobs must be non-negative, got {self.logprobs}")
+        if self.max_tokens < 1:
+            raise ValueError(f"max_tokens must be at least 1, got {self.max_tokens}")
+        if any(not s for s in self.stop):
+            raise ValueError("stop strings must be non-empty")
+        if self.n < 1:
+            raise ValueError(f"n must be at least 1, got {self.n}")
+        if self.best_of < self.n:
+            raise ValueError(f"best_of must be at least n, got best_of={self.best_of} and n={self.n}")
+        if self.use_beam_search:
+            if self.best_of == 1:
+                raise ValueError("beam search needs best_of > 1")
+            if not self.is_greedy:
+                raise ValueError("temperature must be 0 with beam search")
+            if self.top_k != -1 or self.top_p < 1.0 - _SAMPLING_EPS or self.min_p > _SAMPLING_EPS:
+                raise ValueError("top_k, top_p and min_p must be disabled with beam search")
+        elif self.is_greedy and self.best_of > 1:
+            raise ValueError("best_of > 1 needs temperature > 0 (all greedy samples are identical)")
+
+    @property
+    def is_streamable(self) -> bool:
+        """Whether every generated sequence is returned, so tokens can be emitted as they come."""
+        return self.best_of == self.n and not self.use_beam_search
+
+    @property
+    def is_greedy(self) -> bool:
+        return self.temperature < _SAMPLING_EPS
+
+    def __repr__(self) -> str:
+        return (f"SamplingParams(temperature={self.temperature}, top_k={self.top_k}, top_p={self.top_p}, "
+                f"min_p={self.min_p}, repetition_penalty={self.repetition_penalty}, "
+                f"presence_penalty={self.presence_penalty}, frequency_penalty={self.frequency_penalty}, "
+                f"seed={self.seed}, logprobs={self.logprobs}, max_tokens={self.max_tokens}, "
+                f"stop={self.stop}, stop_token_ids={self.stop_token_ids}, ignore_eos={self.ignore_eos}, "
+                f"include_stop_str_in_output={self.include_stop_str_in_output}, n={self.n}, "
+                f"best_of={self.best_of}, use_beam_search={self.use_beam_search}, "
+                f"length_penalty={self.length_penalty})")
@@ -1,81 +1,508 @@
-from typing import List, Dict, Optional, Deque
+from typing import List, Dict, Optional, Deque, Tuple
 from collections import deque
 import enum
+import itertools
 import time
 
+import numpy as np
+import torch
+
+from .block_manager import BlockManager
+from .policy import FCFSPolicy, Policy
+from .sampling_params import SamplingParams
+
 class RequestStatus(enum.Enum):
     WAITING = "WAITING"
     RUNNING = "RUNNING"
+    SWAPPED = "SWAPPED"
     FINISHED = "FINISHED"
 
+class PreemptionMode(enum.Enum):
+    # Drop the KV blocks and prefill prompt + outputs again on resume
+    RECOMPUTE = "recompute"
+    # Copy the KV blocks to CPU swap space and copy them back on resume
+    SWAP = "swap"
+
+# Initial spare capacity of a sequence's token buffer; it doubles when full
+MIN_TOKEN_BUFFER_SIZE = 64
+
 class Sequence:
-    """Represents a single sequence (prompt + generated tokens)."""
+    """
+    Represents a single sequence (prompt + generated tokens).
+    All token ids live in one preallocated int64 buffer, so the full
+    context (get_token_ids) and the generated tokens (output_token_ids)
+    are views rather than fresh concatenations or lists.
+    """
+    __slots__ = ("seq_id", "prompt", "prompt_token_ids", "status", "num_computed_tokens",
+                 "output_text", "prefix_offset", "read_offset", "num_emitted_chars", "finish_reason",
+                 "cumulative_logprob", "output_logprobs", "_token_buffer", "_num_tokens", "_num_prompt_tokens")
+
     def __init__(self, seq_id: int, prompt: str, prompt_token_ids: List[int]):
         self.seq_id = seq_id
         self.prompt = prompt
         self.prompt_token_ids = prompt_token_ids
-        self.output_token_ids: List[int] = []
         self.status = RequestStatus.WAITING
+        # Tokens whose keys/values are already in the KV cache
+        self.num_computed_tokens = 0
+        self._num_tokens = self._num_prompt_tokens = len(prompt_token_ids)
+        self._token_buffer = np.empty(max(2 * self._num_tokens, MIN_TOKEN_BUFFER_SIZE), dtype=np.int64)
+        self._token_buffer[:self._num_tokens] = prompt_token_ids
+
+        # Incremental detokenization state (see Detokenizer)
+        self.output_text = ""
+        self.prefix_offset = 0
+        self.read_offset = 0
+        # Characters of output_text already returned to the caller
+        self.num_emitted_chars = 0
+        self.finish_reason: Optional[str] = None
+        # Sum of the logprobs of the generated tokens (ranks best_of / beam candidates)
+        self.cumulative_logprob = 0.0
+        # Per-token logprobs, kept for requests that only return their best sequences at the end
+        self.output_logprobs: List = []
 
     def get_len(self) -> int:
-        return len(self.prompt_token_ids) + len(self.output_token_ids)
+        return self._num_tokens
 
-    def append_token_id(self, token_id: int):
-        self.output_token_ids.append(token_id)
+    def get_output_len(self) -> int:
+        return self._num_tokens - self._num_prompt_tokens
+
+    @property
+    def output_token_ids(self) -> np.ndarray:
+        """Generated token ids, as a view of the token buffer."""
+        return self._token_buffer[self._num_prompt_tokens:self._num_tokens]
+
+    def get_token_ids(self) -> np.ndarray:
+        """Prompt and output token ids, as a view of the token buffer (valid until the next append)."""
+        return self._token_buffer[:self._num_tokens]
+
+    def get_last_token_id(self) -> int:
+        return int(self._token_buffer[self._num_tokens - 1])
+
+    def append_token_id(self, token_id: int, logprob: float = 0.0):
+        if self._num_tokens == len(self._token_buffer):
+            self._token_buffer = np.concatenate([self._token_buffer, np.empty_like(self._token_buffer)])
+        self._token_buffer[self._num_tokens] = token_id
+        self._num_tokens += 1
+        self.cumulative_logprob += logprob
+
+    def is_finished(self) -> bool:
+        return self.status == RequestStatus.FINISHED
+
+    def fork(self, seq_id: int) -> "Sequence":
+        """A copy that continues independently from this sequence's current state."""
+        child = Sequence.__new__(Sequence)
+        child.seq_id = seq_id
+        child.prompt = self.prompt
+        child.prompt_token_ids = self.prompt_token_ids
+        child.status = self.status
+        child.num_computed_tokens = self.num_computed_tokens
+        child._token_buffer = self._token_buffer.copy()
+        child._num_tokens = self._num_tokens
+        child._num_prompt_tokens = self._num_prompt_tokens
+        child.output_text = self.output_text
+        child.prefix_offset = self.prefix_offset
+        child.read_offset = self.read_offset
+        child.num_emitted_chars = self.num_emitted_chars
+        child.finish_reason = self.finish_reason
+        child.cumulative_logprob = self.cumulative_logprob
+        child.output_logprobs = list(self.output_logprobs)
+        return child
 
 class SequenceGroup:
-    """A group of sequences from a single request (for beam search, usually size=1 for greedy)."""
-    def __init__(self, request_id: str, seqs: List[Sequence], arrival_time: float):
+    """
+    The sequences of a single request. A request starts with one sequence;
+    with n / best_of > 1 or beam search it forks into several after the
+    prompt is prefilled, and they share the prompt's KV blocks.
+    """
+    __slots__ = ("request_id", "seqs", "arrival_time", "sampling_params", "generator", "priority", "tenant",
+                 "num_spec_steps", "num_draft_tokens", "num_accepted_tokens")
+
+    def __init__(self, request_id: str, seqs: List[Sequence], arrival_time: float,
+                 sampling_params: Optional[SamplingParams] = None,
+                 generator: Optional[torch.Generator] = None,
+                 priority: int = 0, tenant: Optional[str] = None):
         self.request_id = request_id
         self.seqs = seqs
         self.arrival_time = arrival_time
-        # For simplicity in MVP, we assume 1 seq per group
-        
+        self.sampling_params = sampling_params or SamplingParams()
+        # Per-request RNG, only for seeded requests
+        self.generator = generator
+        # Used by the scheduling policy: lower priority classes run first
+        self.priority = priority
+        self.tenant = tenant
+        # Speculative decoding: steps in which a sequence verified drafts, drafts proposed and accepted
+        self.num_spec_steps = 0
+        self.num_draft_tokens = 0
+        self.num_accepted_tokens = 0
+
     def get_seqs(self, status: Optional[RequestStatus] = None) -> List[Sequence]:
         if status is None:
             return self.seqs
         return [s for s in self.seqs if s.status == status]
 
+    def get_unfinished_seqs(self) -> List[Sequence]:
+        return [s for s in self.seqs if not s.is_finished()]
+
+    def is_finished(self) -> bool:
+        return all(s.is_finished() for s in self.seqs)
+
+    def get_max_num_running_seqs(self) -> int:
+        """Sequences this group will run at once; reserved at admission so forks fit."""
+        if self.seqs[0].get_output_len() == 0 and len(self.seqs) == 1:
+            return self.sampling_params.best_of
+        return len(self.get_unfinished_seqs())
+
+    def get_num_output_tokens(self) -> int:
+        return sum(s.get_output_len() for s in self.seqs)
+
+    def get_spec_decode_stats(self) -> Optional[dict]:
+        """
+        Speculation counts of this request, with its acceptance rate and
+        tokens emitted per speculative step; None if it never speculated.
+        """
+        if self.num_spec_steps == 0:
+            return None
+        return {
+            "num_spec_steps": self.num_spec_steps,
+            "num_draft_tokens": self.num_draft_tokens,
+            "num_accepted_tokens": self.num_accepted_tokens,
+            "acceptance_rate": self.num_accepted_tokens / max(self.num_draft_tokens, 1),
+            # Every speculative step emits the accepted drafts plus one target token
+            "tokens_per_step": (self.num_accepted_tokens + self.num_spec_steps) / self.num_spec_steps,
+        }
+
+class SchedulerOutputs:
+    """Everything the engine has to execute for one step."""
+    def __init__(self, scheduled_groups: List[SequenceGroup],
+                 scheduled_seqs: List[Tuple[SequenceGroup, Sequence]],
+                 token_chunk_sizes: List[int],
+                 blocks_to_swap_in: List[Tuple[int, int]],
+                 blocks_to_swap_out: List[Tuple[int, int]],
+                 blocks_to_copy: List[Tuple[int, int]],
+                 ignored_groups: List[SequenceGroup],
+                 num_preempted: int):
+        self.scheduled_groups = scheduled_groups
+        # Every sequence that runs this step, with its group
+        self.scheduled_seqs = scheduled_seqs
+        # New tokens to compute per scheduled sequence: 1 for decode, a chunk for prefill
+        self.token_chunk_sizes = token_chunk_sizes
+        self.blocks_to_swap_in = blocks_to_swap_in
+        self.blocks_to_swap_out = blocks_to_swap_out
+        # Copy-on-write of shared blocks a sequence is about to write into
+        self.blocks_to_copy = blocks_to_copy
+        # Requests that can never (or no longer) fit in the KV cache; finished without running further
+        self.ignored_groups = ignored_groups
+        self.num_preempted = num_preempted
+
+    def is_empty(self) -> bool:
+        return not self.scheduled_groups and not self.ignored_groups
+
 class Scheduler:
     """
     Implements Continuous Batching.
-    Decides which sequences to run in the next step.
+    Decides which sequences to run in the next step, based on the
+    KV blocks the BlockManager still has free. The policy orders the
+    queues (FCFS by default).
+    Unfinished groups are indexed by request id. Finishing or aborting a
+    request only drops it from the index; the queues shed finished groups
+    in one pass per step (remove_finished_groups).
     """
-    def __init__(self, max_num_seqs: int, max_total_tokens: int):
+    def __init__(self, max_num_seqs: int, max_total_tokens: int, block_manager: BlockManager,
+                 preemption_mode: PreemptionMode = PreemptionMode.RECOMPUTE,
+                 max_prefill_chunk_size: Optional[int] = None, policy: Optional[Policy] = None):
+        if max_total_tokens < max_num_seqs:
+            raise ValueError(
+                f"max_total_tokens ({max_total_tokens}) must be >= max_num_seqs ({max_num_seqs}) "
+                "so every running sequence can decode each step"
+            )
         self.waiting: Deque[SequenceGroup] = deque()
         self.running: List[SequenceGroup] = []
+        self.swapped: Deque[SequenceGroup] = deque()
         
         self.max_num_seqs = max_num_seqs # Max batch size (N)
-        self.max_total_tokens = max_total_tokens # Max tokens in KV cache context
+        self.max_total_tokens = max_total_tokens # Token budget per step (decode tokens + prefill chunks)
+        self.max_prefill_chunk_size = max_prefill_chunk_size or max_total_tokens
+        self.block_manager = block_manager
+        self.preemption_mode = preemption_mode
+        self.policy = policy or FCFSPolicy()
+        self.seq_counter = itertools.count()
+        self.num_preemptions = 0
+        # Unfinished groups by request id, whichever queue holds them
+        self.requests: Dict[str, SequenceGroup] = {}
+        # Set when the queues may still hold groups that finished since the last pass
+        self._has_finished_groups = False
         
-    def add_request(self, request_id: str, prompt: str, prompt_token_ids: List[int]):
-        seq = Sequence(seq_id=int(time.time()*1000), prompt=prompt, prompt_token_ids=prompt_token_ids)
-        group = SequenceGroup(request_id, [seq], time.time())
+    def add_request(self, request_id: str, prompt: str, prompt_token_ids: List[int],
+                    sampling_params: Optional[SamplingParams] = None,
+                    generator: Optional[torch.Generator] = None,
+                    priority: int = 0, tenant: Optional[str] = None) -> SequenceGroup:
+        seq = Sequence(seq_id=next(self.seq_counter), prompt=prompt, prompt_token_ids=prompt_token_ids)
+        group = SequenceGroup(request_id, [seq], time.time(), sampling_params, generator, priority, tenant)
         self.waiting.append(group)
+        self.requests[request_id] = group
+        self.policy.on_add(group)
+        return group
+
+    def has_unfinished_requests(self) -> bool:
+        return bool(self.requests)
+
+    def remove_finished_groups(self):
+        """Drops groups finished or aborted since the last call from the queues, in one pass."""
+        if not self._has_finished_groups:
+            return
+        self._has_finished_groups = False
+        if not self.requests:
+            self.running, self.waiting, self.swapped = [], deque(), deque()
+            return
+        self.running = [g for g in self.running if g.request_id in self.requests]
+        self.waiting = deque(g for g in self.waiting if g.request_id in self.requests)
+        self.swapped = deque(g for g in self.swapped if g.request_id in self.requests)
         
-    def schedule(self) -> List[SequenceGroup]:
+    def schedule(self) -> SchedulerOutputs:
         """
-        Naive scheduling policy: FCFS.
-        Move waiting -> running as long as we have slots.
+        Policy-ordered scheduling with memory-aware admission and a per-step
+        token budget. Every queue is sorted most urgent first.
+        0. Let the policy evict running groups for a more urgent waiting one.
+        1. Reserve a KV slot for every running sequence, preempting the
+           least urgent running groups when the pool runs dry.
+        2. Swap previously preempted groups back in.
+        3. Admit waiting groups while their prompt fits in free blocks.
+        New work is only admitted when nothing was preempted this step,
+        so under pressure requests queue instead of thrashing.
+        Decode tokens are budgeted first; prompts are prefilled in chunks of
+        at most max_prefill_chunk_size from whatever budget is left, so a
+        long prompt never stalls running streams for a whole prefill.
+        The sequences of a group are preempted and resumed together.
         """
-        # 1. Update running status check (remove finished)
-        # (In a real system, the Engine tells Scheduler who finished. 
-        # Here we assume Scheduler decides based on external feedback or simple loop)
-        
-        # 2. Add new requests
-        while self.waiting:
+        blocks_to_swap_in: List[Tuple[int, int]] = []
+        blocks_to_swap_out: List[Tuple[int, int]] = []
+        blocks_to_copy: List[Tuple[int, int]] = []
+        ignored_groups: List[SequenceGroup] = []
+        preempted: List[SequenceGroup] = []
+        scheduled: List[SequenceGroup] = []
+        scheduled_seqs: List[Tuple[SequenceGroup, Sequence]] = []
+        token_chunk_sizes: List[int] = []
+
+        def schedule_seqs(group: SequenceGroup, seqs: List[Sequence], chunk_sizes: List[int]):
+            for seq, num_new_tokens in zip(seqs, chunk_sizes):
+                if num_new_tokens == 0:
+                    continue
+                blocks_to_copy.extend(
+                    self.block_manager.append_slot(seq.seq_id, seq.get_len(), seq.num_computed_tokens)
+                )
+                scheduled_seqs.append((group, seq))
+                token_chunk_sizes.append(num_new_tokens)
+            if any(chunk_sizes):
+                scheduled.append(group)
+                self.policy.on_scheduled(group, sum(chunk_sizes))
+
+        self.remove_finished_groups()
+        now = time.time()
+        self.waiting = deque(self.policy.sort_by_priority(now, self.waiting))
+        self.swapped = deque(self.policy.sort_by_priority(now, self.swapped))
+        self.running = self.policy.sort_by_priority(now, self.running)
+        num_evicted = self._preempt_for_priority(now, blocks_to_swap_out)
+
+        # Running decodes are always served; prefill chunks share what remains
+        num_decodes = sum(
+            1 for g in self.running for seq in g.get_unfinished_seqs() if self._get_num_new_tokens(seq) == 1
+        )
+        prefill_budget = self.max_total_tokens - num_decodes
+
+        # 1. Running groups, most urgent first; victims are taken from the back
+        running = deque(self.running)
+        self.running = []
+        while running:
+            group = running.popleft()
+            seqs = group.get_unfinished_seqs()
+            chunk_sizes = []
+            for seq in seqs:
+                num_new_tokens = self._get_num_new_tokens(seq)
+                if num_new_tokens > 1:
+                    # Out of budget: a chunk of 0 continues its prefill next step
+                    num_new_tokens = min(num_new_tokens, self.max_prefill_chunk_size, prefill_budget)
+                    prefill_budget -= num_new_tokens
+                chunk_sizes.append(num_new_tokens)
+            slots = [(seq.seq_id, seq.get_len(), seq.num_computed_tokens)
+                     for seq, size in zip(seqs, chunk_sizes) if size > 0]
+            while not self.block_manager.can_append_slots(slots):
+                if running:
+                    victim = running.pop()
+                else:
+                    victim = group
+                self._preempt(victim, blocks_to_swap_out)
+                preempted.append(victim)
+                if victim is group:
+                    break
+            else:
+                self.running.append(group)
+                schedule_seqs(group, seqs, chunk_sizes)
+
+        budget = prefill_budget
+        num_running_seqs = sum(len(g.get_unfinished_seqs()) for g in self.running)
+
+        def is_ahead_of_swapped(group: SequenceGroup) -> bool:
+            return (not self.swapped
+                    or self.policy.get_priority(now, group) < self.policy.get_priority(now, self.swapped[0]))
+
+        # 2. Swapped groups resume before anything less urgent is admitted
+        while self.swapped and not preempted:
+            group = self.swapped[0]
+            if self.waiting and is_ahead_of_swapped(self.waiting[0]):
+                break
+            seqs = group.get_seqs(RequestStatus.SWAPPED)
+            if not self.block_manager.can_ever_swap_in([s.seq_id for s in seqs], [s.get_len() for s in seqs],
+                                                       [s.num_computed_tokens for s in seqs]):
+                # Outgrew the whole pool while running: finish it like an over-long prompt
+                self.swapped.popleft()
+                self._ignore(group, ignored_groups)
+                continue
+            if num_running_seqs + len(seqs) > self.max_num_seqs:
+                break
+            chunk_sizes = [min(self._get_num_new_tokens(seq), self.max_prefill_chunk_size, budget) for seq in seqs]
+            if sum(chunk_sizes) > budget or 0 in chunk_sizes:
+                break
+            if not self.block_manager.can_swap_in([s.seq_id for s in seqs], [s.get_len() for s in seqs],
+                                                  [s.num_computed_tokens for s in seqs]):
+                break
+            self.swapped.popleft()
+            blocks_to_swap_in.extend(self.block_manager.swap_in([s.seq_id for s in seqs]))
+            for seq in seqs:
+                seq.status = RequestStatus.RUNNING
+            self.running.append(group)
+            schedule_seqs(group, seqs, chunk_sizes)
+            num_running_seqs += len(seqs)
+            budget -= sum(chunk_sizes)
+
+        # 3. Add new requests
+        while self.waiting and is_ahead_of_swapped(self.waiting[0]) and not preempted:
             # Check constraints
-            if len(self.running) >= self.max_num_seqs:
+            if budget == 0:
+                break
+            group = self.waiting[0]
+            if num_running_seqs + group.get_max_num_running_seqs() > self.max_num_seqs:
+                break
+
+            seqs = group.get_seqs(RequestStatus.WAITING)
+            if not all(self.block_manager.can_ever_allocate(seq.get_len()) for seq in seqs):
+                self.waiting.popleft()
+                self._ignore(group, ignored_groups)
+                continue
+            if not self.block_manager.can_allocate_all([seq.get_token_ids() for seq in seqs]):
                 break
-                
-            # Current naive check: Only checks sequence count, not token memory availability
-            # In Phase 3, we connect this to BlockManager to check memory
-            group = self.waiting.popleft()
-            for seq in group.seqs:
+
+            self.waiting.popleft()
+            chunk_sizes = []
+            for seq in seqs:
+                # Prefix-cached blocks are shared and their tokens skip prefill
+                num_cached_tokens, copies = self.block_manager.allocate(seq.seq_id, seq.get_token_ids())
+                seq.num_computed_tokens = num_cached_tokens
+                blocks_to_copy.extend(copies)
                 seq.status = RequestStatus.RUNNING
+                num_new_tokens = min(self._get_num_new_tokens(seq), self.max_prefill_chunk_size, budget)
+                chunk_sizes.append(num_new_tokens)
+                budget -= num_new_tokens
             self.running.append(group)
-            
-        return self.running
+            schedule_seqs(group, seqs, chunk_sizes)
+            num_running_seqs += group.get_max_num_running_seqs()
+
+        self.num_preemptions += len(preempted) + num_evicted
+        return SchedulerOutputs(
+            scheduled_groups=scheduled,
+            scheduled_seqs=scheduled_seqs,
+            token_chunk_sizes=token_chunk_sizes,
+            blocks_to_swap_in=blocks_to_swap_in,
+            blocks_to_swap_out=blocks_to_swap_out,
+            blocks_to_copy=blocks_to_copy,
+            ignored_groups=ignored_groups,
+            num_preempted=len(preempted) + num_evicted,
+        )
+
+    def _preempt_for_priority(self, now: float, blocks_to_swap_out: List[Tuple[int, int]]) -> int:
+        """
+        Preempts the least urgent running groups while the most urgent
+        waiting group does not fit and the policy ranks it above them.
+        """
+        if not self.waiting:
+            return 0
+        head = self.waiting[0]
+        seqs = head.get_seqs(RequestStatus.WAITING)
+        if not all(self.block_manager.can_ever_allocate(seq.get_len()) for seq in seqs):
+            return 0
+
+        num_evicted = 0
+        while self.running and self.policy.should_preempt(now, head, self.running[-1]):
+            num_running_seqs = sum(len(g.get_unfinished_seqs()) for g in self.running)
+            if (num_running_seqs + head.get_max_num_running_seqs() <= self.max_num_seqs
+                    and self.block_manager.can_allocate_all([seq.get_token_ids() for seq in seqs])):
+                break
+            self._preempt(self.running.pop(), blocks_to_swap_out)
+            num_evicted += 1
+        if num_evicted:
+            # Recomputed victims were queued at the front; put them back in order
+            self.waiting = deque(self.policy.sort_by_priority(now, self.waiting))
+            self.swapped = deque(self.policy.sort_by_priority(now, self.swapped))
+        return num_evicted
+
+    def _ignore(self, group: SequenceGroup, ignored_groups: List[SequenceGroup]):
+        """Finishes a group that can never be scheduled and frees any blocks it still holds."""
+        for seq in group.get_seqs():
+            seq.status = RequestStatus.FINISHED
+            self.block_manager.free(seq.seq_id)
+        self.requests.pop(group.request_id, None)
+        ignored_groups.append(group)
+        self.policy.on_finish(group)
+
+    @staticmethod
+    def _get_num_new_tokens(seq: Sequence) -> int:
+        return seq.get_len() - seq.num_computed_tokens
+
+    def _preempt(self, group: SequenceGroup, blocks_to_swap_out: List[Tuple[int, int]]):
+        seqs = group.get_unfinished_seqs()
+        seq_ids = [seq.seq_id for seq in seqs]
+        if self.preemption_mode == PreemptionMode.SWAP and self.block_manager.can_swap_out(seq_ids):
+            blocks_to_swap_out.extend(self.block_manager.swap_out(seq_ids))
+            for seq in seqs:
+                seq.status = RequestStatus.SWAPPED
+            self.swapped.appendleft(group)
+        else:
+            # Recompute: drop the blocks, prompt + outputs get prefilled again
+            for seq in seqs:
+                self.block_manager.free(seq.seq_id)
+                seq.num_computed_tokens = 0
+                seq.status = RequestStatus.WAITING
+            self.waiting.appendleft(group)
+
+    def fork_seq(self, group: SequenceGroup, parent: Sequence) -> Sequence:
+        """Adds a copy of parent to the group, sharing all of its KV blocks."""
+        child = parent.fork(next(self.seq_counter))
+        self.block_manager.fork(parent.seq_id, child.seq_id)
+        group.seqs.append(child)
+        return child
+
+    def free_seq(self, seq: Sequence):
+        """Finishes one sequence of a running group and releases its blocks."""
+        seq.status = RequestStatus.FINISHED
+        self.block_manager.free(seq.seq_id)
+
+    def abort_request(self, request_id: str) -> Optional[SequenceGroup]:
+        """
+        Finishes the request wherever it is (waiting, running or swapped) and
+        frees all of its blocks (device or swap) at once. Returns its group,
+        or None if the request is not (or no longer) scheduled.
+        """
+        group = self.requests.get(request_id)
+        if group is not None:
+            self.free_finished_request(request_id)
+        return group
 
     def free_finished_request(self, request_id: str):
-        self.running = [g for g in self.running if g.request_id != request_id]
+        """Releases the blocks of a finished request; its queue drops it on the next pass."""
+        group = self.requests.pop(request_id, None)
+        if group is None:
+            return
+        for seq in group.get_seqs():
+            seq.status = RequestStatus.FINISHED
+            self.block_manager.free(seq.seq_id)
+        self.policy.on_finish(group)
+        self._has_finished_groups = True
@@ -0,0 +1,97 @@
+import numpy as np
+import torch
+from typing import List, Optional, Tuple
+
+from model.model_executor import ModelExecutor
+from model.quantization import DEFAULT_GROUP_SIZE
+from model.sampler import Sampler, sample_from_probs
+from .scheduler import Sequence, SequenceGroup
+
+# speculative_model value that selects prompt-lookup drafting
+NGRAM_PROPOSER = "[ngram]"
+
+class NgramProposer:
+    """
+    Prompt-lookup drafting: finds the latest earlier occurrence of the
+    sequence's last n tokens (longest n first) and proposes the tokens that
+    followed it. Costs no model call; works well when outputs copy from the
+    prompt (summaries, code edits, retrieval answers).
+    """
+    def __init__(self, max_ngram: int = 4, min_ngram: int = 1):
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+
+    def propose(self, groups: List[SequenceGroup], seqs: List[Sequence], num_tokens: List[int],
+                input_ids: List[np.ndarray], start_positions: List[int], block_tables: np.ndarray,
+                spec_rows: List[int]) -> Tuple[List[List[int]], List[None]]:
+        """Drafts up to num_tokens[j] tokens for seqs[j]; the batch itself is not needed."""
+        drafts = []
+        for seq, k in zip(seqs, num_tokens):
+            drafts.append(self._lookup(seq.get_token_ids(), k) if k else [])
+        return drafts, [None] * len(seqs)
+
+    def _lookup(self, token_ids: np.ndarray, k: int) -> List[int]:
+        token_ids = np.asarray(token_ids)
+        for n in range(min(self.max_ngram, len(token_ids) - 1), self.min_ngram - 1, -1):
+            # Every earlier window of n tokens (all but the suffix itself), compared at once
+            windows = np.lib.stride_tricks.sliding_window_view(token_ids[:-1], n)
+            matches = np.flatnonzero((windows == token_ids[-n:]).all(axis=1))
+            if matches.size:
+                start = int(matches[-1])
+                return token_ids[start + n:start + n + k].tolist()
+        return []
+
+class DraftModelProposer:
+    """
+    Drafting with a small model that shares the target's tokenizer.
+    The draft keeps its own KV pool with the same geometry, addressed by
+    the target's block tables: it processes exactly the tokens the target
+    processes (plus its drafts), so a block's contents stay valid in both
+    pools, including shared prefix-cache blocks. Swaps and copies are
+    mirrored. Drafts are sampled with each request's own settings, and
+    their probabilities are kept for rejection sampling.
+    """
+    def __init__(self, model_name: str, device: str, sampler: Sampler, quantization: str = "fp32",
+                 group_size: int = DEFAULT_GROUP_SIZE):
+        self.executor = ModelExecutor(model_name, device=device, quantization=quantization, group_size=group_size)
+        self.sampler = sampler
+
+    def swap_blocks(self, blocks_to_swap_in, blocks_to_swap_out, blocks_to_copy):
+        self.executor.swap_blocks(blocks_to_swap_in, blocks_to_swap_out, blocks_to_copy)
+
+    def propose(self, groups: List[SequenceGroup], seqs: List[Sequence], num_tokens: List[int],
+                input_ids: List[np.ndarray], start_positions: List[int], block_tables: np.ndarray,
+                spec_rows: List[int]) -> Tuple[List[List[int]], List[Optional[torch.Tensor]]]:
+        """
+        Runs the step's batch through the draft model, then drafts
+        num_tokens[j] tokens for seqs[j] of groups[j] (the batch row spec_rows[j]).
+        """
+        logits = self.executor.execute_model(input_ids, start_positions, block_tables)[spec_rows]
+        drafts: List[List[int]] = [[] for _ in groups]
+        draft_probs: List[List[torch.Tensor]] = [[] for _ in groups]
+
+        active = [j for j, k in enumerate(num_tokens) if k > 0]
+        logits = logits[active]
+        while active:
+            probs, _ = self.sampler.get_probs(
+                logits,
+                [groups[j].sampling_params for j in active],
+                [seqs[j].prompt_token_ids for j in active],
+                [np.concatenate([seqs[j].output_token_ids, np.array(drafts[j], dtype=np.int64)]) for j in active],
+            )
+            tokens = sample_from_probs(probs, [groups[j].generator for j in active]).tolist()
+            for r, j in enumerate(active):
+                drafts[j].append(tokens[r])
+                draft_probs[j].append(probs[r])
+
+            # Write every draft's KV (so the pools stay in sync); logits only matter for the next draft
+            logits = self.executor.execute_model(
+                [[drafts[j][-1]] for j in active],
+                [seqs[j].get_len() - 1 + len(drafts[j]) for j in active],
+                block_tables[[spec_rows[j] for j in active]],
+            )
+            still_active = [r for r, j in enumerate(active) if len(drafts[j]) < num_tokens[j]]
+            active = [active[r] for r in still_active]
+            logits = logits[still_active]
+
+        return drafts, [torch.stack(p) if p else None for p in draft_probs]
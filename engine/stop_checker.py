@@ -0,0 +1,61 @@
+from typing import Optional
+
+from .sampling_params import SamplingParams
+from .scheduler import Sequence
+
+class StopChecker:
+    """
+    Decides when a sequence is finished and how much of its text is safe to
+    return. Runs after the detokenizer has appended the step's new text.
+    """
+    def __init__(self, eos_token_id: Optional[int], max_model_len: int):
+        self.eos_token_id = eos_token_id
+        self.max_model_len = max_model_len
+
+    def check(self, seq: Sequence, sampling_params: SamplingParams) -> Optional[str]:
+        """Returns the finish reason ("stop" / "length") once the sequence is done."""
+        last_token_id = seq.get_last_token_id()
+        if not sampling_params.ignore_eos and last_token_id == self.eos_token_id:
+            return "stop"
+        if last_token_id in sampling_params.stop_token_ids:
+            return "stop"
+        if sampling_params.stop and self._truncate_at_stop_string(seq, sampling_params):
+            return "stop"
+        if seq.get_output_len() >= sampling_params.max_tokens:
+            return "length"
+        if seq.get_len() >= self.max_model_len:
+            return "length"
+        return None
+
+    @staticmethod
+    def _truncate_at_stop_string(seq: Sequence, sampling_params: SamplingParams) -> bool:
+        # Text that may still grow into a stop string is never emitted, so
+        # only the unemitted tail can contain a new match
+        start = seq.num_emitted_chars
+        for stop in sampling_params.stop:
+            idx = seq.output_text.find(stop, start)
+            if idx == -1:
+                continue
+            if sampling_params.include_stop_str_in_output:
+                idx += len(stop)
+            seq.output_text = seq.output_text[:idx]
+            return True
+        return False
+
+    @staticmethod
+    def get_new_text(seq: Sequence, sampling_params: SamplingParams) -> str:
+        """
+        Text produced since the last call. While the sequence runs, a tail
+        that could still become a stop string is held back.
+        """
+        end = len(seq.output_text)
+        if seq.finish_reason is None:
+            for stop in sampling_params.stop:
+                for k in range(min(len(stop) - 1, end), 0, -1):
+                    if seq.output_text.endswith(stop[:k]):
+                        end = min(end, len(seq.output_text) - k)
+                        break
+        end = max(end, seq.num_emitted_chars)
+        text = seq.output_text[seq.num_emitted_chars:end]
+        seq.num_emitted_chars = end
+        return text
@@ -0,0 +1,172 @@
+import tempfile
+import torch
+from typing import List, Optional, Tuple
+
+# KV cache formats: "auto" stores the model's dtype; int8 and fp8 (e4m3,
+# kept as raw bytes) are quantized with one float32 scale per token and head
+KV_CACHE_DTYPES = ("auto", "int8", "fp8")
+_QUANTIZED_STORAGE = {"int8": torch.int8, "fp8": torch.uint8}
+SCALE_DTYPE = torch.float32
+# Each tensor carved out of the swap file starts at a multiple of this
+SWAP_FILE_ALIGNMENT = 64
+
+class KVCachePool:
+    """
+    Preallocated KV storage shared by all sequences.
+    Each layer owns a key and a value tensor shaped
+    [num_blocks, block_size, num_heads, head_dim]; sequences address it
+    through the physical block numbers handed out by the BlockManager.
+    A quantized pool (kv_cache_dtype int8 / fp8) also keeps key and value
+    scales shaped [num_blocks, block_size, num_heads], which move with
+    their blocks on swaps and copies.
+    Swap space has two tiers addressed by swap slot: num_cpu_blocks blocks in
+    host RAM (slots [0, num_cpu_blocks)), then num_disk_blocks blocks in a
+    memory-mapped temporary file under swap_dir, which the OS pages in and
+    out instead of pinning RAM.
+    """
+    def __init__(self, num_layers: int, num_blocks: int, block_size: int,
+                 num_heads: int, head_dim: int, dtype: torch.dtype, device: str,
+                 num_cpu_blocks: int = 0, kv_cache_dtype: str = "auto",
+                 num_disk_blocks: int = 0, swap_dir: Optional[str] = None):
+        if kv_cache_dtype not in KV_CACHE_DTYPES:
+            raise ValueError(f"Unknown kv_cache_dtype {kv_cache_dtype!r}, expected one of {KV_CACHE_DTYPES}")
+        self.num_layers = num_layers
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.num_heads = num_heads
+        self.head_dim = head_dim
+        self.dtype = dtype
+        self.device = device
+        self.kv_cache_dtype = kv_cache_dtype
+        self.is_quantized = kv_cache_dtype in _QUANTIZED_STORAGE
+        storage_dtype = _QUANTIZED_STORAGE.get(kv_cache_dtype, dtype)
+
+        def make(num, shape_tail, dtype, **kwargs):
+            return [torch.zeros((num, block_size) + shape_tail, dtype=dtype, **kwargs) for _ in range(num_layers)]
+
+        self.key_caches: List[torch.Tensor] = make(num_blocks, (num_heads, head_dim), storage_dtype, device=device)
+        self.value_caches: List[torch.Tensor] = make(num_blocks, (num_heads, head_dim), storage_dtype, device=device)
+
+        # Host-side swap space for preempted sequences
+        self.num_cpu_blocks = num_cpu_blocks
+        pin_memory = device != "cpu" and torch.cuda.is_available()
+        self.cpu_key_caches: List[torch.Tensor] = make(num_cpu_blocks, (num_heads, head_dim), storage_dtype,
+                                                       pin_memory=pin_memory)
+        self.cpu_value_caches: List[torch.Tensor] = make(num_cpu_blocks, (num_heads, head_dim), storage_dtype,
+                                                         pin_memory=pin_memory)
+
+        self.key_scales: List[torch.Tensor] = []
+        self.value_scales: List[torch.Tensor] = []
+        self.cpu_key_scales: List[torch.Tensor] = []
+        self.cpu_value_scales: List[torch.Tensor] = []
+        if self.is_quantized:
+            self.key_scales = make(num_blocks, (num_heads,), SCALE_DTYPE, device=device)
+            self.value_scales = make(num_blocks, (num_heads,), SCALE_DTYPE, device=device)
+            self.cpu_key_scales = make(num_cpu_blocks, (num_heads,), SCALE_DTYPE, pin_memory=pin_memory)
+            self.cpu_value_scales = make(num_cpu_blocks, (num_heads,), SCALE_DTYPE, pin_memory=pin_memory)
+
+        self.num_disk_blocks = num_disk_blocks
+        self.swap_file = None
+        self.disk_key_caches: List[torch.Tensor] = []
+        self.disk_value_caches: List[torch.Tensor] = []
+        self.disk_key_scales: List[torch.Tensor] = []
+        self.disk_value_scales: List[torch.Tensor] = []
+        if num_disk_blocks > 0:
+            kv_shape = (num_disk_blocks, block_size, num_heads, head_dim)
+            scale_shape = (num_disk_blocks, block_size, num_heads)
+            specs = [(kv_shape, storage_dtype)] * (2 * num_layers)
+            if self.is_quantized:
+                specs += [(scale_shape, SCALE_DTYPE)] * (2 * num_layers)
+            tensors = self._map_swap_file(specs, swap_dir)
+            self.disk_key_caches = tensors[:num_layers]
+            self.disk_value_caches = tensors[num_layers:2 * num_layers]
+            self.disk_key_scales = tensors[2 * num_layers:3 * num_layers]
+            self.disk_value_scales = tensors[3 * num_layers:]
+
+    def _map_swap_file(self, specs: List[Tuple[Tuple[int, ...], torch.dtype]],
+                       swap_dir: Optional[str]) -> List[torch.Tensor]:
+        """Tensors of the given shapes and dtypes backed by one shared mapping of a new swap file."""
+        sizes = [torch.Size(shape).numel() * torch.tensor([], dtype=dtype).element_size() for shape, dtype in specs]
+        offsets, nbytes = [], 0
+        for size in sizes:
+            offsets.append(nbytes)
+            nbytes += -(-size // SWAP_FILE_ALIGNMENT) * SWAP_FILE_ALIGNMENT
+        # Deleted along with the pool
+        self.swap_file = tempfile.NamedTemporaryFile(prefix="kv-swap-", suffix=".bin", dir=swap_dir)
+        mapping = torch.from_file(self.swap_file.name, shared=True, size=nbytes, dtype=torch.uint8)
+        return [
+            mapping[offset:offset + size].view(dtype).view(shape)
+            for offset, size, (shape, dtype) in zip(offsets, sizes, specs)
+        ]
+
+    def get_scales(self, layer_idx: int) -> Tuple[Optional[torch.Tensor], Optional[torch.Tensor]]:
+        """Key and value scales of a layer, or (None, None) for an unquantized pool."""
+        if not self.is_quantized:
+            return None, None
+        return self.key_scales[layer_idx], self.value_scales[layer_idx]
+
+    def swap_out(self, block_mapping: List[Tuple[int, int]]):
+        """Copies (gpu_block, swap_slot) pairs from the device pool to swap space."""
+        for tier_mapping, (keys, values) in self._split_by_tier(block_mapping, swap_side=1):
+            self._copy_blocks(tier_mapping, self.key_caches + self.key_scales, keys)
+            self._copy_blocks(tier_mapping, self.value_caches + self.value_scales, values)
+
+    def swap_in(self, block_mapping: List[Tuple[int, int]]):
+        """Copies (swap_slot, gpu_block) pairs from swap space back to the device pool."""
+        for tier_mapping, (keys, values) in self._split_by_tier(block_mapping, swap_side=0):
+            self._copy_blocks(tier_mapping, keys, self.key_caches + self.key_scales)
+            self._copy_blocks(tier_mapping, values, self.value_caches + self.value_scales)
+
+    def _split_by_tier(self, block_mapping: List[Tuple[int, int]], swap_side: int):
+        """
+        Splits swap pairs into the host and disk tiers, with swap slots turned
+        into block numbers of the tier, each next to the tier's (keys + key
+        scales, values + value scales).
+        """
+        host, disk = [], []
+        for pair in block_mapping:
+            slot = pair[swap_side]
+            if slot < self.num_cpu_blocks:
+                host.append(pair)
+            else:
+                pair = list(pair)
+                pair[swap_side] = slot - self.num_cpu_blocks
+                disk.append(tuple(pair))
+        return [
+            (host, (self.cpu_key_caches + self.cpu_key_scales, self.cpu_value_caches + self.cpu_value_scales)),
+            (disk, (self.disk_key_caches + self.disk_key_scales, self.disk_value_caches + self.disk_value_scales)),
+        ]
+
+    def copy(self, block_mapping: List[Tuple[int, int]]):
+        """Copies (src_block, dst_block) pairs inside the device pool (copy-on-write)."""
+        self._copy_blocks(block_mapping, self.key_caches + self.key_scales, self.key_caches + self.key_scales)
+        self._copy_blocks(block_mapping, self.value_caches + self.value_scales, self.value_caches + self.value_scales)
+
+    @staticmethod
+    def _copy_blocks(block_mapping: List[Tuple[int, int]], src_caches: List[torch.Tensor],
+                     dst_caches: List[torch.Tensor]):
+        if not block_mapping:
+            return
+        src_blocks, dst_blocks = zip(*block_mapping)
+        src_index = torch.tensor(src_blocks, device=src_caches[0].device)
+        dst_index = torch.tensor(dst_blocks, device=dst_caches[0].device)
+        for src, dst in zip(src_caches, dst_caches):
+            dst[dst_index] = src[src_index].to(dst.device)
+
+    def get_block_nbytes(self) -> int:
+        """Bytes taken by one block across all layers (keys + values, and their scales)."""
+        return get_block_nbytes(self.num_layers, self.block_size, self.num_heads, self.head_dim, self.dtype,
+                                self.kv_cache_dtype)
+
+    def get_memory_usage(self) -> int:
+        return self.num_blocks * self.get_block_nbytes()
+
+def get_block_nbytes(num_layers: int, block_size: int, num_heads: int, head_dim: int, dtype: torch.dtype,
+                     kv_cache_dtype: str = "auto") -> int:
+    """Bytes one KV block takes across all layers (keys + values), before it is allocated."""
+    storage_dtype = _QUANTIZED_STORAGE.get(kv_cache_dtype, dtype)
+    element_size = torch.tensor([], dtype=storage_dtype).element_size()
+    nbytes_per_head = head_dim * element_size
+    if kv_cache_dtype in _QUANTIZED_STORAGE:
+        nbytes_per_head += torch.tensor([], dtype=SCALE_DTYPE).element_size()
+    return 2 * num_layers * block_size * num_heads * nbytes_per_head
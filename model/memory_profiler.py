@@ -0,0 +1,64 @@
+import threading
+import time
+
+import psutil
+import torch
+
+GiB = 1 << 30
+# How often the CPU monitor samples the process RSS while profiling
+RSS_SAMPLE_INTERVAL = 0.0005
+
+def get_memory_budget(device: str, utilization: float) -> int:
+    """
+    Bytes this process may still allocate on device while staying within
+    utilization of the device's memory. What is already in use (weights,
+    other processes) counts against it. On CPU the fraction applies to host
+    RAM, minus this process's RSS, and is capped by what is still available.
+    """
+    if device.startswith("cuda"):
+        free, total = torch.cuda.mem_get_info(device)
+        return int(total * utilization) - (total - free)
+    vm = psutil.virtual_memory()
+    rss = psutil.Process().memory_info().rss
+    return min(int(vm.total * utilization) - rss, vm.available)
+
+class PeakMemoryMonitor:
+    """
+    Measures the peak memory allocated inside a with-block, above what was
+    allocated when it started: the CUDA allocator's peak statistic, or on
+    CPU the RSS sampled from a background thread (transient activations
+    are freed before the block ends, so sampling before and after misses them).
+    """
+    def __init__(self, device: str):
+        self.device = device
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if self.device.startswith("cuda"):
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self._baseline = torch.cuda.memory_allocated(self.device)
+        else:
+            self._process = psutil.Process()
+            self._baseline = self._max_rss = self._process.memory_info().rss
+            self._thread = threading.Thread(target=self._sample_rss, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.device.startswith("cuda"):
+            torch.cuda.synchronize(self.device)
+            peak = torch.cuda.max_memory_allocated(self.device)
+        else:
+            self._stop.set()
+            self._thread.join()
+            peak = max(self._max_rss, self._process.memory_info().rss)
+        self.peak = max(peak - self._baseline, 0)
+        return False
+
+    def _sample_rss(self):
+        while not self._stop.is_set():
+            self._max_rss = max(self._max_rss, self._process.memory_info().rss)
+            time.sleep(RSS_SAMPLE_INTERVAL)
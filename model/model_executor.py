@@ -1,44 +1,290 @@
+import bisect
+import numpy as np
 import torch
-from transformers import AutoModelForCausalLM
+from typing import Callable, List, Optional, Tuple, Union
+
+from .kv_cache import KVCachePool, get_block_nbytes
+from .memory_profiler import PeakMemoryMonitor
+from .quantization import DEFAULT_GROUP_SIZE, get_weight_nbytes, quantize_model
+from .weight_loader import load_model
+from .paged_attention import (AttentionMetadata, paged_attention, varlen_causal_attention, varlen_paged_attention,
+                              write_to_kv_cache)
+
+# Token ids of one sequence, and block tables of a batch: lists, or the engine's numpy arrays
+TokenIds = Union[List[int], np.ndarray]
+BlockTables = Union[List[List[int]], np.ndarray]
+
+def pad_block_tables(block_tables: BlockTables, num_blocks: Optional[int] = None) -> np.ndarray:
+    """The tables as one zero-padded [batch, num_blocks] array (at least as wide as the longest table)."""
+    if isinstance(block_tables, np.ndarray):
+        if num_blocks is None or num_blocks == block_tables.shape[1]:
+            return block_tables
+        padded = np.zeros((len(block_tables), num_blocks), dtype=block_tables.dtype)
+        padded[:, :block_tables.shape[1]] = block_tables
+        return padded
+    width = max(len(table) for table in block_tables)
+    padded = np.zeros((len(block_tables), max(width, num_blocks or 0)), dtype=np.int64)
+    for i, table in enumerate(block_tables):
+        padded[i, :len(table)] = table
+    return padded
 
 class ModelExecutor:
-    def __init__(self, model_name: str, device: str = "cuda"):
+    def __init__(self, model_name: str, device: str = "cuda", quantization: str = "fp32",
+                 group_size: int = DEFAULT_GROUP_SIZE):
+        """quantization selects the weight format (see model.quantization); the integer formats are CPU-only."""
         self.device = device
+        if quantization not in ("fp32", "bf16") and device != "cpu":
+            raise ValueError(f"{quantization} weights are only supported on CPU")
         print(f"Loading {model_name} on {device}...")
-        self.model = AutoModelForCausalLM.from_pretrained(model_name).to(device)
-        # TODO: optimization - enable torch.compile for production
-        # self.model = torch.compile(self.model) 
-
-    def forward(self, input_ids: list[list[int]], past_key_values=None):
-        """
-        Batched forward pass.
-        Current implementation uses naive left-padding.
-        TODO: Refactor to use PagedAttention with unpadded tensors.
-        """
-        # Determine max length for padding
-        max_len = max(len(ids) for ids in input_ids)
-        
-        # GPT-2 uses EOS as pad token usually
-        PAD_TOKEN_ID = 50256 
-        
-        padded_inputs = []
-        attn_masks = []
-        
-        for ids in input_ids:
-            pad_len = max_len - len(ids)
-            # Left padding is required for generation
-            padded = [PAD_TOKEN_ID] * pad_len + ids 
-            mask = [0] * pad_len + [1] * len(ids)
-            
-            padded_inputs.append(padded)
-            attn_masks.append(mask)
-            
-        # Move to GPU
-        inputs_tensor = torch.tensor(padded_inputs, device=self.device)
-        mask_tensor = torch.tensor(attn_masks, device=self.device)
-        
+        self.model = quantize_model(load_model(model_name), quantization, group_size)
+        self.model.to(device)
+        self.model.eval()
+        self.quantization = quantization
+        self.group_size = group_size
+        print(f"[Executor] Weights: {quantization}, {get_weight_nbytes(self.model) / 1024**2:.1f} MB")
+        self.kv_cache: KVCachePool = None
+        # Compiled decode path (see enable_compile): one graph per (batch, block table width) bucket
+        self.compiled_decode = None
+        self.batch_buckets: List[int] = []
+        self.block_buckets: List[int] = []
+
+    def forward(self, input_ids: List[List[int]]) -> torch.Tensor:
+        """
+        Packed forward pass over full contexts, without touching the KV pool.
+        Sequences are concatenated (no padding); attention stays within each one.
+        Returns the logits of the last token of every sequence.
+        """
+        tokens, positions, seq_idx, query_lens, _ = self._pack(input_ids, [0] * len(input_ids))
+
+        def attention(layer_idx, query, key, value, scale):
+            return varlen_causal_attention(query, key, value, seq_idx, scale)
+
+        with torch.no_grad():
+            hidden_states = self._run_layers(tokens, positions, attention)
+            return self.model.lm_head(hidden_states[torch.cumsum(query_lens, dim=0) - 1]).float()
+
+    def profile_run(self, num_tokens: int, num_seqs: int) -> int:
+        """
+        Runs a worst-case batch (num_tokens prompt tokens over num_seqs
+        sequences, i.e. a full token budget) and returns its peak activation
+        memory in bytes, for sizing the KV pool before it is allocated.
+        """
+        num_seqs = max(min(num_seqs, num_tokens), 1)
+        max_len = self.model.config.n_positions
+        lengths = [min(num_tokens // num_seqs + (i < num_tokens % num_seqs), max_len) for i in range(num_seqs)]
+        dummy = [[0] * n for n in lengths]
+        with PeakMemoryMonitor(self.device) as monitor:
+            self.forward(dummy)
+        return monitor.peak
+
+    def get_kv_block_nbytes(self, block_size: int, kv_cache_dtype: str = "auto") -> int:
+        config = self.model.config
+        return get_block_nbytes(config.n_layer, block_size, config.n_head, config.n_embd // config.n_head,
+                                self.model.dtype, kv_cache_dtype)
+
+    def init_kv_cache(self, num_blocks: int, block_size: int, num_cpu_blocks: int = 0,
+                      kv_cache_dtype: str = "auto", num_disk_blocks: int = 0, swap_dir: Optional[str] = None):
+        """
+        Preallocates the paged KV pool the attention layers read and write,
+        in the model's dtype or quantized to kv_cache_dtype (int8 / fp8),
+        with swap space in host RAM and in a memory-mapped file under swap_dir.
+        """
+        config = self.model.config
+        if config.model_type != "gpt2":
+            raise NotImplementedError(f"Paged attention is only implemented for GPT-2 models, got {config.model_type}")
+        self.block_size = block_size
+        self.kv_cache = KVCachePool(
+            num_layers=config.n_layer,
+            num_blocks=num_blocks,
+            block_size=block_size,
+            num_heads=config.n_head,
+            head_dim=config.n_embd // config.n_head,
+            dtype=self.model.dtype,
+            device=self.device,
+            num_cpu_blocks=num_cpu_blocks,
+            kv_cache_dtype=kv_cache_dtype,
+            num_disk_blocks=num_disk_blocks,
+            swap_dir=swap_dir,
+        )
+        print(f"[Executor] KV cache pool ({kv_cache_dtype}): {num_blocks} blocks x {block_size} tokens "
+              f"({self.kv_cache.get_memory_usage() / 1024**2:.1f} MB)")
+
+    def swap_blocks(self, blocks_to_swap_in: List[Tuple[int, int]], blocks_to_swap_out: List[Tuple[int, int]],
+                    blocks_to_copy: List[Tuple[int, int]]):
+        """Applies the scheduler's swap and copy-on-write decisions before the next forward pass."""
+        self.kv_cache.swap_out(blocks_to_swap_out)
+        self.kv_cache.swap_in(blocks_to_swap_in)
+        self.kv_cache.copy(blocks_to_copy)
+
+    def execute_model(self, input_ids: List[TokenIds], start_positions: List[int],
+                      block_tables: BlockTables, num_logits: Optional[List[int]] = None) -> torch.Tensor:
+        """
+        Paged forward pass over a packed (padding-free) batch.
+        input_ids[i] are the tokens of sequence i not yet in the KV cache,
+        starting at absolute position start_positions[i]. Prefill chunks and
+        single decode tokens can be mixed freely. Their keys/values are
+        written into the blocks listed in block_tables[i]; attention reads the
+        whole context back through the same table. block_tables is a list of
+        tables or a zero-padded [batch, max_blocks] array.
+        Returns the logits of the last new token of every sequence, or of its
+        last num_logits[i] tokens (concatenated in order) when given.
+        """
+        block_tables = pad_block_tables(block_tables)
+        if (self.compiled_decode is not None and num_logits is None
+                and all(len(ids) == 1 for ids in input_ids)):
+            bucket = self._get_bucket(len(input_ids), block_tables.shape[1])
+            if bucket is not None:
+                return self._execute_compiled_decode(input_ids, start_positions, block_tables, *bucket)
+
+        tokens, positions, seq_idx, query_lens, query_starts = self._pack(input_ids, start_positions)
+        table_tensor = torch.from_numpy(block_tables).to(self.device, torch.long)
+
+        block_ids = table_tensor[seq_idx, positions // self.block_size]
+        metadata = AttentionMetadata(
+            positions=positions,
+            seq_idx=seq_idx,
+            slot_mapping=block_ids * self.block_size + positions % self.block_size,
+            block_tables=table_tensor,
+            context_lens=torch.tensor(start_positions, device=self.device) + query_lens,
+            query_lens=query_lens,
+            query_starts=query_starts,
+            max_prefill_len=max((len(ids) for ids in input_ids if len(ids) > 1), default=0),
+        )
+
+        def attention(layer_idx, query, key, value, scale):
+            key_cache = self.kv_cache.key_caches[layer_idx]
+            value_cache = self.kv_cache.value_caches[layer_idx]
+            key_scales, value_scales = self.kv_cache.get_scales(layer_idx)
+            write_to_kv_cache(key, value, key_cache, value_cache, metadata.slot_mapping, key_scales, value_scales)
+            return varlen_paged_attention(query, key_cache, value_cache, metadata, scale, key_scales, value_scales)
+
+        logits_idx = query_starts + query_lens - 1
+        if num_logits is not None:
+            # Trailing tokens of each sequence, e.g. to verify speculated tokens
+            counts = torch.tensor(num_logits, device=self.device)
+            ends = torch.repeat_interleave(logits_idx + 1, counts)
+            offsets = torch.arange(int(counts.sum()), device=self.device) - torch.repeat_interleave(
+                torch.cumsum(counts, 0) - counts, counts)
+            logits_idx = ends - torch.repeat_interleave(counts, counts) + offsets
+
+        with torch.no_grad():
+            hidden_states = self._run_layers(tokens, positions, attention)
+            # Only the tokens whose next-token distribution is needed go through the LM head
+            return self.model.lm_head(hidden_states[logits_idx]).float()
+
+    def enable_compile(self, batch_buckets: List[int], block_buckets: List[int],
+                       backend: Union[str, Callable] = "inductor"):
+        """
+        Routes pure decode steps through a torch.compile'd forward. The batch
+        is padded up to the next of batch_buckets and the block tables to the
+        next of block_buckets (in blocks), so a handful of static graphs
+        serve every step; larger steps, prefills and verification passes run
+        eagerly. Call warmup() to compile every bucket before serving.
+        """
+        self.batch_buckets = sorted(set(batch_buckets))
+        self.block_buckets = sorted(set(block_buckets))
+        # Each bucket is its own graph of the same function, counted against dynamo's recompile
+        # limit per executor; the limit is raised only while this executor's decode runs
+        limit_patch = _recompile_limit_patch(len(self.batch_buckets) * len(self.block_buckets))
+        self.compiled_decode = limit_patch(torch.compile(self._decode_forward, backend=backend, dynamic=False))
+
+    def warmup(self):
+        """
+        Compiles the decode graph of every bucket. The dummy steps write into
+        block 0's first slot, which is harmless before any request holds it.
+        """
+        for batch_size in self.batch_buckets:
+            for num_blocks in self.block_buckets:
+                self._execute_compiled_decode([[0]] * batch_size, [0] * batch_size,
+                                              [[0] * num_blocks] * batch_size, batch_size, num_blocks)
+        print(f"[Executor] Compiled decode for batch sizes {self.batch_buckets} "
+              f"x block tables of {self.block_buckets} blocks")
+
+    def _get_bucket(self, batch_size: int, num_blocks: int) -> Optional[Tuple[int, int]]:
+        i = bisect.bisect_left(self.batch_buckets, batch_size)
+        j = bisect.bisect_left(self.block_buckets, num_blocks)
+        if i == len(self.batch_buckets) or j == len(self.block_buckets):
+            return None
+        return self.batch_buckets[i], self.block_buckets[j]
+
+    def _execute_compiled_decode(self, input_ids: List[TokenIds], start_positions: List[int],
+                                 block_tables: BlockTables, batch_size: int, num_blocks: int) -> torch.Tensor:
+        """
+        Pads a decode step to its bucket and runs the compiled graph. Padding
+        rows repeat the first sequence: they write the same key/value to the
+        same slot, and their logits are dropped.
+        """
+        num_seqs = len(input_ids)
+        pad = batch_size - num_seqs
+        tokens = [int(ids[0]) for ids in input_ids] + [int(input_ids[0][0])] * pad
+        positions = start_positions + [start_positions[0]] * pad
+        tables = pad_block_tables(block_tables, num_blocks)
+        tables = np.concatenate([tables, np.repeat(tables[:1], pad, axis=0)])
+
+        tokens = torch.tensor(tokens, dtype=torch.long, device=self.device)
+        positions = torch.tensor(positions, dtype=torch.long, device=self.device)
+        table_tensor = torch.from_numpy(tables).to(self.device, torch.long)
+        block_ids = table_tensor[torch.arange(batch_size, device=self.device), positions // self.block_size]
+        slot_mapping = block_ids * self.block_size + positions % self.block_size
         with torch.no_grad():
-            outputs = self.model(input_ids=inputs_tensor, attention_mask=mask_tensor, use_cache=True)
-            
-        # Logits for the last token (next token prediction)
-        return outputs.logits[:, -1, :]
+            return self.compiled_decode(tokens, positions, table_tensor, slot_mapping)[:num_seqs]
+
+    def _decode_forward(self, tokens: torch.Tensor, positions: torch.Tensor, block_tables: torch.Tensor,
+                        slot_mapping: torch.Tensor) -> torch.Tensor:
+        """Decode step of one token per sequence, with static shapes for torch.compile."""
+        context_lens = positions + 1
+        query_positions = positions.unsqueeze(1)
+
+        def attention(layer_idx, query, key, value, scale):
+            key_cache = self.kv_cache.key_caches[layer_idx]
+            value_cache = self.kv_cache.value_caches[layer_idx]
+            key_scales, value_scales = self.kv_cache.get_scales(layer_idx)
+            write_to_kv_cache(key, value, key_cache, value_cache, slot_mapping, key_scales, value_scales)
+            out = paged_attention(query.unsqueeze(1), key_cache, value_cache, block_tables,
+                                  context_lens, query_positions, scale, key_scales, value_scales)
+            return out.squeeze(1)
+
+        return self.model.lm_head(self._run_layers(tokens, positions, attention)).float()
+
+    def _pack(self, input_ids: List[TokenIds], start_positions: List[int]):
+        """Concatenates the batch into one token axis with explicit positions and boundaries."""
+        query_lens = torch.tensor([len(ids) for ids in input_ids], device=self.device)
+        tokens = torch.from_numpy(np.concatenate(input_ids).astype(np.int64, copy=False)).to(self.device)
+        query_starts = torch.cumsum(query_lens, dim=0) - query_lens
+        seq_idx = torch.repeat_interleave(torch.arange(len(input_ids), device=self.device), query_lens)
+        offsets = torch.arange(len(tokens), device=self.device) - query_starts[seq_idx]
+        positions = torch.tensor(start_positions, device=self.device)[seq_idx] + offsets
+        return tokens, positions, seq_idx, query_lens, query_starts
+
+    def _run_layers(self, tokens: torch.Tensor, positions: torch.Tensor, attention) -> torch.Tensor:
+        """
+        GPT-2 decoder stack over packed tokens [num_tokens].
+        attention(layer_idx, query, key, value, scale) computes the attention
+        output for [num_tokens, num_heads, head_dim] inputs.
+        """
+        transformer = self.model.transformer
+        config = self.model.config
+        num_tokens = tokens.shape[0]
+        num_heads = config.n_head
+        head_dim = config.n_embd // num_heads
+
+        hidden_states = transformer.wte(tokens) + transformer.wpe(positions)
+        for layer_idx, block in enumerate(transformer.h):
+            attn = block.attn
+            residual = hidden_states
+            qkv = attn.c_attn(block.ln_1(hidden_states))
+            query, key, value = qkv.view(num_tokens, 3, num_heads, head_dim).unbind(dim=1)
+
+            attn_output = attention(layer_idx, query, key, value, getattr(attn, "scaling", head_dim ** -0.5))
+            attn_output = attn.c_proj(attn_output.reshape(num_tokens, -1))
+            hidden_states = residual + attn_output
+            hidden_states = hidden_states + block.mlp(block.ln_2(hidden_states))
+
+        return transformer.ln_f(hidden_states)
+
+def _recompile_limit_patch(num_graphs: int):
+    """A torch._dynamo.config.patch that lets one compiled function hold num_graphs graphs."""
+    config = torch._dynamo.config
+    # Older torch releases call it cache_size_limit
+    name = "recompile_limit" if hasattr(config, "recompile_limit") else "cache_size_limit"
+    return config.patch(**{name: max(getattr(config, name), num_graphs)})
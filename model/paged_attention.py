@@ -0,0 +1,163 @@
+import torch
+import torch.nn.functional as F
+from typing import Optional
+
+FP8_MAX = torch.finfo(torch.float8_e4m3fn).max
+
+def quantize_kv(x: torch.Tensor, storage_dtype: torch.dtype):
+    """
+    Quantizes keys or values [..., num_heads, head_dim] with one scale per
+    token and head. int8 is symmetric; fp8 (e4m3) is kept as raw uint8
+    bytes, since CPU kernels cannot index_copy float8 tensors.
+    Returns the stored values and the float32 scales [..., num_heads].
+    """
+    x = x.float()
+    amax = x.abs().amax(dim=-1).clamp(min=1e-8)
+    if storage_dtype == torch.int8:
+        scales = amax / 127
+        return torch.round(x / scales.unsqueeze(-1)).clamp(-127, 127).to(torch.int8), scales
+    scales = amax / FP8_MAX
+    return (x / scales.unsqueeze(-1)).to(torch.float8_e4m3fn).view(torch.uint8), scales
+
+def dequantize_kv(stored: torch.Tensor, scales: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    if stored.dtype == torch.uint8:
+        stored = stored.view(torch.float8_e4m3fn)
+    return (stored.float() * scales.unsqueeze(-1)).to(dtype)
+
+def write_to_kv_cache(key: torch.Tensor, value: torch.Tensor,
+                      key_cache: torch.Tensor, value_cache: torch.Tensor,
+                      slot_mapping: torch.Tensor, key_scales: Optional[torch.Tensor] = None,
+                      value_scales: Optional[torch.Tensor] = None):
+    """
+    Scatters new keys/values into the block pool.
+    key/value: [num_tokens, num_heads, head_dim]
+    key_cache/value_cache: [num_blocks, block_size, num_heads, head_dim]
+    slot_mapping: [num_tokens], flat slot = block_number * block_size + offset
+    key_scales/value_scales: [num_blocks, block_size, num_heads] for a
+    quantized cache; the new keys/values are quantized on the way in.
+    """
+    num_heads, head_dim = key_cache.shape[-2:]
+    if key_scales is not None:
+        key, new_key_scales = quantize_kv(key, key_cache.dtype)
+        value, new_value_scales = quantize_kv(value, value_cache.dtype)
+        key_scales.view(-1, num_heads).index_copy_(0, slot_mapping, new_key_scales)
+        value_scales.view(-1, num_heads).index_copy_(0, slot_mapping, new_value_scales)
+    key_cache.view(-1, num_heads, head_dim).index_copy_(0, slot_mapping, key)
+    value_cache.view(-1, num_heads, head_dim).index_copy_(0, slot_mapping, value)
+
+def paged_attention(query: torch.Tensor, key_cache: torch.Tensor, value_cache: torch.Tensor,
+                    block_tables: torch.Tensor, context_lens: torch.Tensor,
+                    positions: torch.Tensor, scale: float, key_scales: Optional[torch.Tensor] = None,
+                    value_scales: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    Causal attention that reads keys/values through per-sequence block tables.
+    query: [batch, num_queries, num_heads, head_dim]
+    block_tables: [batch, max_blocks] physical block numbers (padded with 0)
+    context_lens: [batch] number of valid cached tokens per sequence
+    positions: [batch, num_queries] absolute position of every query token
+    key_scales/value_scales: scales of a quantized cache; only the gathered blocks are dequantized
+    Returns: [batch, num_queries, num_heads, head_dim]
+    """
+    batch_size, max_blocks = block_tables.shape
+    block_size, num_heads, head_dim = key_cache.shape[1:]
+    max_context = max_blocks * block_size
+
+    # Gather each sequence's blocks into a contiguous [batch, heads, ctx, dim] view
+    keys = key_cache[block_tables]
+    values = value_cache[block_tables]
+    if key_scales is not None:
+        keys = dequantize_kv(keys, key_scales[block_tables], query.dtype)
+        values = dequantize_kv(values, value_scales[block_tables], query.dtype)
+    keys = keys.view(batch_size, max_context, num_heads, head_dim).transpose(1, 2)
+    values = values.view(batch_size, max_context, num_heads, head_dim).transpose(1, 2)
+
+    key_positions = torch.arange(max_context, device=query.device)
+    # A query attends to every cached key at or before its own position
+    mask = key_positions[None, None, :] <= positions[:, :, None]
+    mask &= key_positions[None, None, :] < context_lens[:, None, None]
+
+    out = F.scaled_dot_product_attention(
+        query.transpose(1, 2), keys, values, attn_mask=mask.unsqueeze(1), scale=scale
+    )
+    return out.transpose(1, 2)
+
+class AttentionMetadata:
+    """
+    Layout of one packed batch, built once per step and shared by every layer.
+    The tokens of all sequences are concatenated on a single [num_tokens] axis.
+    For attention, decode sequences (one query each) and prefill chunks are
+    regrouped separately, so a chunk never pads the decode rows and vice versa.
+    """
+    def __init__(self, positions: torch.Tensor, seq_idx: torch.Tensor, slot_mapping: torch.Tensor,
+                 block_tables: torch.Tensor, context_lens: torch.Tensor,
+                 query_lens: torch.Tensor, query_starts: torch.Tensor, max_prefill_len: int):
+        self.slot_mapping = slot_mapping
+
+        is_decode_seq = query_lens == 1
+        is_decode_token = is_decode_seq[seq_idx]
+
+        # Decode group: one query per sequence
+        self.decode_token_idx = is_decode_token.nonzero().squeeze(-1)
+        decode_seqs = seq_idx[self.decode_token_idx]
+        self.decode_block_tables = block_tables[decode_seqs]
+        self.decode_context_lens = context_lens[decode_seqs]
+        self.decode_positions = positions[self.decode_token_idx].unsqueeze(-1)
+
+        # Prefill group: chunks padded to the longest chunk, only for attention
+        self.prefill_token_idx = (~is_decode_token).nonzero().squeeze(-1)
+        prefill_seqs = (~is_decode_seq).nonzero().squeeze(-1)
+        prefill_token_seqs = seq_idx[self.prefill_token_idx]
+        # Row of each token's sequence within the prefill group, and its offset in the chunk
+        seq_to_row = torch.cumsum(~is_decode_seq, dim=0) - 1
+        self.prefill_rows = seq_to_row[prefill_token_seqs]
+        self.prefill_cols = self.prefill_token_idx - query_starts[prefill_token_seqs]
+        self.prefill_shape = (len(prefill_seqs), max_prefill_len)
+        self.prefill_block_tables = block_tables[prefill_seqs]
+        self.prefill_context_lens = context_lens[prefill_seqs]
+        self.prefill_positions = positions.new_zeros(self.prefill_shape)
+        self.prefill_positions[self.prefill_rows, self.prefill_cols] = positions[self.prefill_token_idx]
+
+def varlen_paged_attention(query: torch.Tensor, key_cache: torch.Tensor, value_cache: torch.Tensor,
+                           metadata: AttentionMetadata, scale: float, key_scales: Optional[torch.Tensor] = None,
+                           value_scales: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    Paged attention over a packed batch.
+    query: [num_tokens, num_heads, head_dim]
+    Returns: [num_tokens, num_heads, head_dim]
+    """
+    out = torch.empty_like(query)
+
+    if metadata.decode_token_idx.numel():
+        idx = metadata.decode_token_idx
+        decode_out = paged_attention(
+            query[idx].unsqueeze(1), key_cache, value_cache, metadata.decode_block_tables,
+            metadata.decode_context_lens, metadata.decode_positions, scale, key_scales, value_scales,
+        )
+        out[idx] = decode_out.squeeze(1)
+
+    if metadata.prefill_token_idx.numel():
+        idx = metadata.prefill_token_idx
+        rows, cols = metadata.prefill_rows, metadata.prefill_cols
+        padded_query = query.new_zeros(*metadata.prefill_shape, *query.shape[1:])
+        padded_query[rows, cols] = query[idx]
+        prefill_out = paged_attention(
+            padded_query, key_cache, value_cache, metadata.prefill_block_tables,
+            metadata.prefill_context_lens, metadata.prefill_positions, scale, key_scales, value_scales,
+        )
+        out[idx] = prefill_out[rows, cols]
+
+    return out
+
+def varlen_causal_attention(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor,
+                            seq_idx: torch.Tensor, scale: float) -> torch.Tensor:
+    """
+    Attention over packed sequences without a KV cache.
+    Each token sees the earlier tokens of its own sequence only.
+    query/key/value: [num_tokens, num_heads, head_dim]
+    """
+    token_idx = torch.arange(query.shape[0], device=query.device)
+    mask = (seq_idx[:, None] == seq_idx[None, :]) & (token_idx[None, :] <= token_idx[:, None])
+    out = F.scaled_dot_product_attention(
+        query.transpose(0, 1), key.transpose(0, 1), value.transpose(0, 1), attn_mask=mask, scale=scale
+    )
+    return out.transpose(0, 1)
@@ -0,0 +1,146 @@
+import warnings
+from typing import Iterator, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from transformers.pytorch_utils import Conv1D
+
+QUANTIZATION_MODES = ("fp32", "bf16", "int8_dynamic", "int8", "int4")
+# Group sizes the CPU int4 matmul kernel supports
+INT4_GROUP_SIZES = (32, 64, 128, 256)
+DEFAULT_GROUP_SIZE = 128
+# The int4 kernel packs output channels in tiles of 16
+INT4_OUT_FEATURES_ALIGNMENT = 16
+
+class Int8WeightOnlyLinear(nn.Module):
+    """
+    int8 weights with one symmetric scale per output channel; activations
+    stay in floating point and the matmul dequantizes on the fly.
+    """
+    def __init__(self, weight: torch.Tensor, bias: torch.Tensor = None):
+        super().__init__()
+        self.in_features = weight.shape[1]
+        self.out_features = weight.shape[0]
+        scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        self.register_buffer("weight", torch.round(weight / scales[:, None]).clamp(-128, 127).to(torch.int8))
+        self.register_buffer("scales", scales.to(weight.dtype))
+        self.register_buffer("bias", bias)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        out = torch.ops.aten._weight_int8pack_mm(x.reshape(-1, self.in_features).contiguous(),
+                                                 self.weight, self.scales)
+        out = out.view(*x.shape[:-1], self.out_features)
+        return out if self.bias is None else out + self.bias
+
+class Int4WeightOnlyLinear(nn.Module):
+    """
+    4-bit weights, asymmetric with a scale and zero point per group of
+    group_size input channels, packed for the CPU int4 matmul kernel.
+    Output channels are padded to the kernel's tile and sliced off again.
+    """
+    def __init__(self, weight: torch.Tensor, bias: torch.Tensor = None, group_size: int = DEFAULT_GROUP_SIZE):
+        super().__init__()
+        out_features, in_features = weight.shape
+        if group_size not in INT4_GROUP_SIZES or in_features % group_size:
+            raise ValueError(f"int4 group size must be one of {INT4_GROUP_SIZES} and divide "
+                             f"in_features={in_features}, got {group_size}")
+        self.in_features = in_features
+        self.out_features = out_features
+        self.group_size = group_size
+
+        padded_out = -(-out_features // INT4_OUT_FEATURES_ALIGNMENT) * INT4_OUT_FEATURES_ALIGNMENT
+        weight = F.pad(weight.float(), (0, 0, 0, padded_out - out_features))
+        groups = weight.view(padded_out, in_features // group_size, group_size)
+        w_min, w_max = groups.amin(dim=-1, keepdim=True), groups.amax(dim=-1, keepdim=True)
+        scales = (w_max - w_min).clamp(min=1e-8) / 15
+        q = torch.round((groups - w_min) / scales).clamp(0, 15).to(torch.int32).view(padded_out, in_features)
+        # The kernel dequantizes as (q - 8) * scale + zero
+        zeros = w_min + 8 * scales
+        self.register_buffer("weight", torch.ops.aten._convert_weight_to_int4pack_for_cpu(q, 1))
+        self.register_buffer("scales_and_zeros",
+                             torch.cat([scales, zeros], dim=-1).transpose(0, 1).contiguous())
+        self.register_buffer("bias", bias)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        out = torch.ops.aten._weight_int4pack_mm_for_cpu(
+            x.reshape(-1, self.in_features).float().contiguous(), self.weight, self.group_size,
+            self.scales_and_zeros,
+        )
+        out = out[:, :self.out_features].to(x.dtype).view(*x.shape[:-1], self.out_features)
+        return out if self.bias is None else out + self.bias
+
+class Int8Embedding(nn.Module):
+    """Embedding table stored as int8 rows with one scale each; only the looked-up rows are dequantized."""
+    def __init__(self, weight: torch.Tensor):
+        super().__init__()
+        scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        self.register_buffer("weight", torch.round(weight / scales[:, None]).clamp(-128, 127).to(torch.int8))
+        self.register_buffer("scales", scales.to(weight.dtype))
+
+    def forward(self, input_ids: torch.Tensor) -> torch.Tensor:
+        return self.weight[input_ids].to(self.scales.dtype) * self.scales[input_ids].unsqueeze(-1)
+
+def quantize_model(model: nn.Module, mode: str, group_size: int = DEFAULT_GROUP_SIZE) -> nn.Module:
+    """
+    Converts a loaded fp32 model's weights in place:
+      bf16          every weight (and so the KV cache) in bfloat16
+      int8_dynamic  linear layers as int8, activations quantized per batch
+      int8          weight-only int8, per output channel
+      int4          weight-only int4, per group of group_size input channels
+    The integer modes run on CPU kernels. They also quantize the LM head,
+    untying it from the token embedding, which becomes an int8 table.
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization {mode!r}, expected one of {QUANTIZATION_MODES}")
+    if mode == "fp32":
+        return model
+    if mode == "bf16":
+        return model.to(torch.bfloat16)
+
+    embeddings = model.get_input_embeddings().weight.data
+    for parent, name, weight, bias in list(_linear_layers(model)):
+        if mode == "int8_dynamic":
+            linear = nn.Linear(weight.shape[1], weight.shape[0], bias=bias is not None)
+            linear.weight.data = weight
+            if bias is not None:
+                linear.bias.data = bias
+            setattr(parent, name, linear)
+        elif mode == "int8":
+            setattr(parent, name, Int8WeightOnlyLinear(weight, bias))
+        else:
+            setattr(parent, name, Int4WeightOnlyLinear(weight, bias, min(group_size, weight.shape[1])))
+    model.set_input_embeddings(Int8Embedding(embeddings))
+    if mode == "int8_dynamic":
+        with warnings.catch_warnings():
+            # Eager-mode quantization is deprecated in favour of torchao, which is not a dependency
+            warnings.simplefilter("ignore")
+            torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+def get_weight_nbytes(model: nn.Module) -> int:
+    """Bytes of weights and buffers, counting tensors shared between modules once."""
+    seen = set()
+    total = 0
+
+    def add(value):
+        nonlocal total
+        if isinstance(value, (tuple, list)):
+            for item in value:
+                add(item)
+        elif isinstance(value, torch.Tensor) and value.data_ptr() not in seen:
+            seen.add(value.data_ptr())
+            total += value.numel() * value.element_size()
+
+    for value in model.state_dict(keep_vars=True).values():
+        add(value)
+    return total
+
+def _linear_layers(model: nn.Module) -> Iterator[Tuple[nn.Module, str, torch.Tensor, torch.Tensor]]:
+    """(parent, attribute, weight [out, in], bias) of every Conv1D (GPT-2's transposed linear) and Linear."""
+    for parent in model.modules():
+        for name, child in parent.named_children():
+            if isinstance(child, Conv1D):
+                yield parent, name, child.weight.data.t().contiguous(), child.bias.data
+            elif isinstance(child, nn.Linear):
+                yield parent, name, child.weight.data, None if child.bias is None else child.bias.data
@@ -0,0 +1,71 @@
+import itertools
+import torch
+from typing import List, Optional
+
+from .sampler import sample_from_probs
+
+class RejectionSampler:
+    """
+    Verifies speculated tokens against the target model.
+    Draft token d is accepted with probability min(1, p(d) / q(d)), where p
+    is the target and q the draft distribution. At the first rejection the
+    replacement is drawn from max(p - q, 0), renormalized; if every draft is
+    accepted a bonus token is drawn from p. The emitted tokens then follow p
+    exactly. Greedy requests have one-hot p and q, which reduces this to
+    "accept while the draft equals the argmax". Deterministic proposers
+    (prompt lookup) pass no draft probs: q is one-hot on the draft.
+    """
+    def __call__(self, target_probs: torch.Tensor, draft_token_ids: List[List[int]],
+                 draft_probs: List[Optional[torch.Tensor]],
+                 generators: List[Optional[torch.Generator]]) -> List[List[int]]:
+        """
+        target_probs: [sum(len(drafts) + 1), vocab], the target distribution
+        after each prefix of every sequence's drafts, sequence by sequence.
+        draft_probs[i]: [len(draft_token_ids[i]), vocab] or None.
+        Returns the accepted drafts plus one corrected or bonus token per sequence.
+        """
+        device = target_probs.device
+        num_drafts = [len(drafts) for drafts in draft_token_ids]
+        starts = list(itertools.accumulate([k + 1 for k in num_drafts], initial=0))[:-1]
+
+        # Acceptance test for every draft token at once
+        draft_rows = torch.tensor([s + j for s, k in zip(starts, num_drafts) for j in range(k)],
+                                  dtype=torch.long, device=device)
+        flat_drafts = torch.tensor(list(itertools.chain.from_iterable(draft_token_ids)),
+                                   dtype=torch.long, device=device)
+        draft_starts = list(itertools.accumulate(num_drafts, initial=0))
+        draft_q = torch.ones(len(flat_drafts), device=device)
+        for i, probs in enumerate(draft_probs):
+            if probs is not None and num_drafts[i]:
+                lo, hi = draft_starts[i], draft_starts[i + 1]
+                draft_q[lo:hi] = probs.gather(-1, flat_drafts[lo:hi, None]).squeeze(-1)
+        accept_probs = target_probs[draft_rows, flat_drafts] / draft_q
+        uniform = torch.cat([
+            torch.rand(k, device=device, generator=generator) if generator is not None else torch.rand(k, device=device)
+            for k, generator in zip(num_drafts, generators)
+        ])
+        accepted = (uniform < accept_probs).tolist()
+
+        # Distribution of the token that follows the accepted prefix
+        num_accepted = []
+        final_dists = []
+        for i, k in enumerate(num_drafts):
+            a = 0
+            while a < k and accepted[draft_starts[i] + a]:
+                a += 1
+            num_accepted.append(a)
+            p = target_probs[starts[i] + a]
+            if a == k:
+                final_dists.append(p)
+                continue
+            if draft_probs[i] is not None:
+                q = draft_probs[i][a]
+            else:
+                q = torch.zeros_like(p)
+                q[draft_token_ids[i][a]] = 1.0
+            residual = (p - q).clamp_(min=0)
+            # p == q up to rounding: fall back to p itself
+            final_dists.append(residual if residual.sum() > 0 else p)
+        final_tokens = sample_from_probs(torch.stack(final_dists), generators).tolist()
+
+        return [draft_token_ids[i][:a] + [final_tokens[i]] for i, a in enumerate(num_accepted)]
@@ -0,0 +1,151 @@
+import numpy as np
+import torch
+from typing import Dict, List, Optional, Tuple, Union
+
+from engine.sampling_params import SamplingParams, _SAMPLING_EPS
+
+# Token ids of one sequence: a list, or a view of the sequence's token buffer
+TokenIds = Union[List[int], np.ndarray]
+
+# (logprob of the sampled token, {token_id: logprob} of the top alternatives)
+Logprobs = Tuple[float, Dict[int, float]]
+
+class Sampler:
+    """
+    Turns the [batch, vocab] logits of one step into next tokens.
+    Every request's settings are gathered into per-row tensors and applied
+    to the whole logits block at once, so requests with different settings
+    share one pass. Stages that no request in the batch uses are skipped.
+    """
+    def __call__(self, logits: torch.Tensor, sampling_params: List[SamplingParams],
+                 prompt_token_ids: List[TokenIds], output_token_ids: List[TokenIds],
+                 generators: List[Optional[torch.Generator]]) -> Tuple[List[int], List[Optional[Logprobs]]]:
+        logits, logprobs = self.process_logits(logits, sampling_params, prompt_token_ids, output_token_ids)
+
+        # Greedy rows take the argmax; the rest are sampled
+        is_greedy = torch.tensor([p.is_greedy for p in sampling_params], device=logits.device)
+        next_tokens = logits.argmax(dim=-1)
+        if not is_greedy.all():
+            sampled = sample_from_probs(logits.softmax(dim=-1), generators)
+            next_tokens = torch.where(is_greedy, next_tokens, sampled)
+
+        return next_tokens.tolist(), get_logprobs(logprobs, next_tokens, sampling_params)
+
+    def get_probs(self, logits: torch.Tensor, sampling_params: List[SamplingParams],
+                  prompt_token_ids: List[TokenIds], output_token_ids: List[TokenIds]):
+        """
+        The distribution each row actually samples from: one-hot on the
+        argmax for greedy rows. Also returns the logprobs (or None) reported
+        to requests that asked for them.
+        """
+        logits, logprobs = self.process_logits(logits, sampling_params, prompt_token_ids, output_token_ids)
+        probs = logits.softmax(dim=-1)
+        is_greedy = torch.tensor([p.is_greedy for p in sampling_params], device=logits.device)
+        if is_greedy.any():
+            one_hot = torch.zeros_like(probs).scatter_(-1, logits.argmax(dim=-1, keepdim=True), 1.0)
+            probs = torch.where(is_greedy[:, None], one_hot, probs)
+        return probs, logprobs
+
+    def process_logits(self, logits: torch.Tensor, sampling_params: List[SamplingParams],
+                       prompt_token_ids: List[TokenIds], output_token_ids: List[TokenIds]):
+        """
+        Applies every request's penalties, temperature and filters to its row.
+        Returns the processed logits and the log-softmax of the penalized
+        logits, or None if no request asked for logprobs.
+        """
+        vocab_size = logits.shape[-1]
+        device = logits.device
+        logits = logits.float()
+
+        def column(name):
+            return torch.tensor([getattr(p, name) for p in sampling_params], dtype=torch.float, device=device)
+
+        # 1. Repetition / presence / frequency penalties
+        repetition_penalties = column("repetition_penalty")
+        presence_penalties = column("presence_penalty")
+        frequency_penalties = column("frequency_penalty")
+        if (presence_penalties != 0).any() or (frequency_penalties != 0).any() or (repetition_penalties != 1).any():
+            output_counts = _token_counts(output_token_ids, vocab_size, device)
+            if (repetition_penalties != 1).any():
+                seen = (output_counts + _token_counts(prompt_token_ids, vocab_size, device)) > 0
+                penalties = torch.where(seen, repetition_penalties[:, None], 1.0)
+                logits = torch.where(logits > 0, logits / penalties, logits * penalties)
+            logits = logits - frequency_penalties[:, None] * output_counts
+            logits = logits - presence_penalties[:, None] * (output_counts > 0)
+
+        # Logprobs are reported for the penalized model distribution; best_of also ranks samples by them
+        logprobs = None
+        if any(p.logprobs is not None or p.best_of > p.n for p in sampling_params):
+            logprobs = torch.log_softmax(logits, dim=-1)
+
+        # 2. Temperature and filters; they never change the argmax of greedy rows
+        temperatures = column("temperature")
+        is_greedy = temperatures < _SAMPLING_EPS
+        if not is_greedy.all():
+            logits = logits / torch.where(is_greedy, 1.0, temperatures)[:, None]
+            logits = _apply_top_k_top_p(logits, column("top_k"), column("top_p"))
+            min_p = column("min_p")
+            if (min_p > 0).any():
+                probs = logits.softmax(dim=-1)
+                threshold = min_p[:, None] * probs.max(dim=-1, keepdim=True).values
+                logits = logits.masked_fill(probs < threshold, float("-inf"))
+        return logits, logprobs
+
+def sample_from_probs(probs: torch.Tensor, generators: List[Optional[torch.Generator]]) -> torch.Tensor:
+    """Draws one token per row; rows with a generator use it for reproducibility."""
+    # Exponential race: argmax(p / E) with E ~ Exp(1) samples from p
+    noise = torch.empty_like(probs).exponential_()
+    for i, generator in enumerate(generators):
+        if generator is not None:
+            noise[i].exponential_(generator=generator)
+    return (probs / noise).argmax(dim=-1)
+
+def _token_counts(token_ids: List[TokenIds], vocab_size: int, device) -> torch.Tensor:
+    """[batch, vocab] occurrence counts, built with one scatter."""
+    lens = torch.tensor([len(ids) for ids in token_ids], device=device)
+    flat = torch.from_numpy(np.concatenate([np.asarray(ids, dtype=np.int64) for ids in token_ids])).to(device)
+    rows = torch.repeat_interleave(torch.arange(len(token_ids), device=device), lens)
+    counts = torch.zeros(len(token_ids), vocab_size, device=device)
+    counts.index_put_((rows, flat), torch.ones_like(flat, dtype=counts.dtype), accumulate=True)
+    return counts
+
+def _apply_top_k_top_p(logits: torch.Tensor, top_k: torch.Tensor, top_p: torch.Tensor) -> torch.Tensor:
+    use_top_k = (top_k > 0).any()
+    use_top_p = (top_p < 1).any()
+    if not use_top_k and not use_top_p:
+        return logits
+
+    vocab_size = logits.shape[-1]
+    sorted_logits, sorted_idx = logits.sort(dim=-1, descending=True)
+    if use_top_k:
+        k = torch.where(top_k > 0, top_k, vocab_size).long()
+        ranks = torch.arange(vocab_size, device=logits.device)
+        sorted_logits = sorted_logits.masked_fill(ranks[None, :] >= k[:, None], float("-inf"))
+    if use_top_p:
+        sorted_probs = sorted_logits.softmax(dim=-1)
+        # Drop a token once the mass before it already reaches top_p (the top token always stays)
+        mass_before = sorted_probs.cumsum(dim=-1) - sorted_probs
+        # Rows with top_p == 1 must keep everything despite cumsum rounding
+        top_p = torch.where(top_p < 1, top_p, 2.0)
+        sorted_logits = sorted_logits.masked_fill(mass_before >= top_p[:, None], float("-inf"))
+    return torch.empty_like(logits).scatter_(-1, sorted_idx, sorted_logits)
+
+def get_logprobs(logprobs: Optional[torch.Tensor], next_tokens: torch.Tensor,
+                  sampling_params: List[SamplingParams]) -> List[Optional[Logprobs]]:
+    if logprobs is None:
+        return [None] * len(sampling_params)
+
+    chosen = logprobs.gather(-1, next_tokens[:, None]).squeeze(-1).tolist()
+    # One topk for the largest request; smaller ones take a prefix of it
+    max_top = max(p.logprobs or 0 for p in sampling_params)
+    top_values, top_ids = logprobs.topk(max(max_top, 1), dim=-1)
+    top_values, top_ids = top_values.tolist(), top_ids.tolist()
+
+    results = []
+    for i, params in enumerate(sampling_params):
+        if params.logprobs is None and params.best_of == params.n:
+            results.append(None)
+            continue
+        n = params.logprobs or 0
+        results.append((chosen[i], dict(zip(top_ids[i][:n], top_values[i][:n]))))
+    return results
@@ -0,0 +1,55 @@
+import os
+import time
+
+import torch
+import torch.nn as nn
+from safetensors.torch import load_file
+from transformers import AutoConfig, AutoModelForCausalLM
+from transformers.utils import cached_file
+
+SAFETENSORS_WEIGHTS_NAME = "model.safetensors"
+
+def load_model(model_name: str) -> nn.Module:
+    """
+    Loads a causal LM without copying its weights: the model is built on the
+    meta device and its parameters are assigned the tensors of a
+    memory-mapped safetensors checkpoint, so pages are read in on first use
+    and shared with the OS page cache. Checkpoints without a single
+    model.safetensors file (sharded, or .bin only) fall back to from_pretrained.
+    Weights come out in float32, like from_pretrained's default.
+    """
+    start = time.perf_counter()
+    path = _find_safetensors(model_name)
+    model = None if path is None else _load_mmap(model_name, path)
+    if model is None:
+        model = AutoModelForCausalLM.from_pretrained(model_name)
+        source = "from_pretrained"
+    else:
+        source = f"{os.path.basename(path)} (memory-mapped)"
+    if any(p.dtype != torch.float32 for p in model.parameters()):
+        model = model.float()
+    print(f"[Executor] Loaded weights from {source} in {time.perf_counter() - start:.2f}s")
+    return model
+
+def _find_safetensors(model_name: str):
+    if os.path.isdir(model_name):
+        path = os.path.join(model_name, SAFETENSORS_WEIGHTS_NAME)
+        return path if os.path.isfile(path) else None
+    return cached_file(model_name, SAFETENSORS_WEIGHTS_NAME, _raise_exceptions_for_missing_entries=False)
+
+def _load_mmap(model_name: str, path: str):
+    """The model with its parameters assigned from the mapped file, or None if the checkpoint does not cover it."""
+    config = AutoConfig.from_pretrained(model_name)
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(config)
+    state_dict = load_file(path)
+    prefix = model.base_model_prefix
+    target = model
+    if not any(key.startswith(prefix + ".") for key in state_dict):
+        # Checkpoints of the bare base model (e.g. the original GPT-2 ones)
+        target = getattr(model, prefix)
+    target.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+    if any(t.is_meta for t in list(model.parameters()) + list(model.buffers())):
+        return None
+    return model.eval()
@@ -0,0 +1,533 @@
+"""
+Load-testing benchmark for Mini-vLLM.
+
+Replays one synthetic (or recorded) workload against a backend and reports
+throughput, goodput under a latency SLO and TTFT / ITL / TPOT / E2E
+percentiles as JSON:
+
+  engine  drives LLMEngine in-process (continuous batching)
+  http    drives a running API server over streaming /v1/completions
+  hf      HuggingFace generate() in static batches (the baseline)
+
+Requests arrive as a Poisson process, in bursts, or at the timestamps of
+a trace file (JSON lines with "timestamp", "prompt_len" or
+"prompt_token_ids", and "output_len"). Prompts are random token ids, and
+EOS is ignored, so every request generates exactly its output length.
+
+Runs on CPU; --tiny swaps the weights for a small random-weight GPT-2 so
+the numbers are cheap enough to gate regressions on:
+
+  python scripts/benchmark.py --backend engine --model gpt2 --tiny \\
+      --num-requests 64 --request-rate 8 --compare-hf --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import torch
+
+from model.kv_cache import KV_CACHE_DTYPES
+from model.quantization import DEFAULT_GROUP_SIZE, QUANTIZATION_MODES
+
+ARRIVAL_PROCESSES = ("poisson", "burst", "trace")
+LENGTH_DISTRIBUTIONS = ("fixed", "uniform", "exponential")
+PERCENTILES = (50, 90, 99)
+
+class RequestSpec:
+    """One request of a workload: when it arrives (seconds from the start) and its shape."""
+    def __init__(self, arrival_time: float, prompt_token_ids: List[int], output_len: int):
+        self.arrival_time = arrival_time
+        self.prompt_token_ids = prompt_token_ids
+        self.output_len = output_len
+
+class RequestResult:
+    """
+    What the client saw of one request. token_times are the times (from
+    the start) at which output arrived; over HTTP a chunk can carry several
+    tokens, so num_output_tokens is counted separately.
+    """
+    def __init__(self, spec: RequestSpec):
+        self.spec = spec
+        self.token_times: List[float] = []
+        self.num_output_tokens = 0
+        self.error: Optional[str] = None
+
+    @property
+    def ttft(self) -> float:
+        return self.token_times[0] - self.spec.arrival_time
+
+    @property
+    def e2e(self) -> float:
+        return self.token_times[-1] - self.spec.arrival_time
+
+    @property
+    def tpot(self) -> float:
+        """Mean time per output token after the first."""
+        if self.num_output_tokens < 2:
+            return 0.0
+        return (self.token_times[-1] - self.token_times[0]) / (self.num_output_tokens - 1)
+
+def sample_lengths(rng: random.Random, distribution: str, mean: int, count: int,
+                   minimum: int = 1, maximum: Optional[int] = None) -> List[int]:
+    """fixed: always mean; uniform: in [mean / 2, 3 * mean / 2]; exponential: with the given mean."""
+    if distribution == "fixed":
+        lengths = [mean] * count
+    elif distribution == "uniform":
+        lengths = [rng.randint(max(mean // 2, 1), mean + mean // 2) for _ in range(count)]
+    elif distribution == "exponential":
+        lengths = [round(rng.expovariate(1.0 / mean)) for _ in range(count)]
+    else:
+        raise ValueError(f"Unknown length distribution {distribution!r}, expected one of {LENGTH_DISTRIBUTIONS}")
+    return [min(max(n, minimum), maximum or n) for n in lengths]
+
+def sample_arrivals(rng: random.Random, process: str, count: int, request_rate: float = math.inf,
+                    burst_size: int = 0, burst_interval: float = 0.0) -> List[float]:
+    """
+    poisson: exponential gaps at request_rate (inf sends everything at once);
+    burst: burst_size requests every burst_interval seconds (0: one burst).
+    """
+    if process == "poisson":
+        if math.isinf(request_rate):
+            return [0.0] * count
+        arrivals, now = [], 0.0
+        for _ in range(count):
+            now += rng.expovariate(request_rate)
+            arrivals.append(now)
+        return arrivals
+    if process == "burst":
+        burst_size = burst_size or count
+        return [(i // burst_size) * burst_interval for i in range(count)]
+    raise ValueError(f"Unknown arrival process {process!r}, expected one of {ARRIVAL_PROCESSES}")
+
+def random_prompt(rng: random.Random, length: int, vocab_size: int, eos_token_id: Optional[int]) -> List[int]:
+    token_ids = []
+    while len(token_ids) < length:
+        token_id = rng.randrange(vocab_size)
+        if token_id != eos_token_id:
+            token_ids.append(token_id)
+    return token_ids
+
+def build_workload(num_requests: int, vocab_size: int, eos_token_id: Optional[int] = None,
+                   arrival: str = "poisson", request_rate: float = math.inf,
+                   burst_size: int = 0, burst_interval: float = 0.0,
+                   input_len: int = 128, input_dist: str = "uniform",
+                   output_len: int = 128, output_dist: str = "uniform",
+                   max_model_len: Optional[int] = None, seed: int = 0) -> List[RequestSpec]:
+    rng = random.Random(seed)
+    max_input = max_model_len - 1 if max_model_len else None
+    prompt_lens = sample_lengths(rng, input_dist, input_len, num_requests, maximum=max_input)
+    output_lens = sample_lengths(rng, output_dist, output_len, num_requests)
+    if max_model_len:
+        output_lens = [min(o, max_model_len - p) for p, o in zip(prompt_lens, output_lens)]
+    arrivals = sample_arrivals(rng, arrival, num_requests, request_rate, burst_size, burst_interval)
+    return [RequestSpec(t, random_prompt(rng, p, vocab_size, eos_token_id), o)
+            for t, p, o in zip(arrivals, prompt_lens, output_lens)]
+
+def load_trace(path: str, vocab_size: int, eos_token_id: Optional[int] = None,
+               seed: int = 0) -> List[RequestSpec]:
+    """Reads a JSON-lines trace; timestamps are shifted so the first request arrives at 0."""
+    rng = random.Random(seed)
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if not records:
+        raise ValueError(f"Trace {path} has no requests")
+    start = min(r["timestamp"] for r in records)
+    workload = []
+    for r in sorted(records, key=lambda r: r["timestamp"]):
+        prompt_token_ids = r.get("prompt_token_ids") or random_prompt(rng, r["prompt_len"], vocab_size, eos_token_id)
+        workload.append(RequestSpec(r["timestamp"] - start, prompt_token_ids, r["output_len"]))
+    return workload
+
+def run_engine(engine, workload: List[RequestSpec]) -> List[RequestResult]:
+    """
+    Feeds the workload to an LLMEngine at its arrival times and steps it
+    until every request finishes. The engine only sleeps when it is idle.
+    """
+    from engine.sampling_params import SamplingParams
+
+    results = [RequestResult(spec) for spec in workload]
+    pending = deque(sorted(results, key=lambda r: r.spec.arrival_time))
+    by_id: Dict[str, RequestResult] = {}
+    start = time.perf_counter()
+    while pending or engine.has_unfinished_requests():
+        now = time.perf_counter() - start
+        while pending and pending[0].spec.arrival_time <= now:
+            result = pending.popleft()
+            params = SamplingParams(temperature=0.0, max_tokens=result.spec.output_len, ignore_eos=True)
+            try:
+                by_id[engine.add_request(None, params, prompt_token_ids=result.spec.prompt_token_ids)] = result
+            except ValueError as e:
+                result.error = str(e)
+        if not engine.has_unfinished_requests():
+            if pending:
+                time.sleep(max(pending[0].spec.arrival_time - now, 0.0))
+            continue
+        outputs = engine.step()
+        now = time.perf_counter() - start
+        for output in outputs:
+            result = by_id[output["req_id"]]
+            result.token_times.append(now)
+            result.num_output_tokens += 1
+    return results
+
+async def run_http(base_url: str, workload: List[RequestSpec], client=None,
+                   max_concurrency: Optional[int] = None) -> List[RequestResult]:
+    """
+    Sends each request to a running server's streaming /v1/completions at
+    its arrival time; a chunk's arrival time is that of all its tokens.
+    max_concurrency caps the requests in flight (None: unbounded); time
+    spent waiting for a slot counts towards TTFT.
+    """
+    import httpx
+
+    results = [RequestResult(spec) for spec in workload]
+    semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+    own_client = client is None
+    if own_client:
+        client = httpx.AsyncClient(base_url=base_url, timeout=None)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+
+    async def send(result: RequestResult):
+        payload = {"prompt_token_ids": result.spec.prompt_token_ids, "max_tokens": result.spec.output_len,
+                   "temperature": 0.0, "ignore_eos": True, "stream": True}
+        async with client.stream("POST", "/v1/completions", json=payload) as response:
+            if response.status_code != 200:
+                result.error = f"HTTP {response.status_code}: {(await response.aread()).decode()}"
+                return
+            async for line in response.aiter_lines():
+                if not line.startswith("data: ") or line == "data: [DONE]":
+                    continue
+                chunk = json.loads(line[len("data: "):])
+                if chunk["choices"]:
+                    result.token_times.append(loop.time() - start)
+                elif "usage" in chunk:
+                    result.num_output_tokens = chunk["usage"]["completion_tokens"]
+
+    async def arrive(result: RequestResult):
+        await asyncio.sleep(max(result.spec.arrival_time - (loop.time() - start), 0.0))
+        if semaphore is None:
+            return await send(result)
+        async with semaphore:
+            await send(result)
+
+    try:
+        await asyncio.gather(*[arrive(r) for r in results])
+    finally:
+        if own_client:
+            await client.aclose()
+    return results
+
+def run_hf(model, workload: List[RequestSpec], batch_size: int, pad_token_id: int) -> List[RequestResult]:
+    """
+    The static-batching baseline: up to batch_size requests that have
+    arrived are left-padded into one generate() call, which runs until the
+    longest output is done. Token times are taken after every decoding
+    step as if generate() streamed, which flatters the baseline's TTFT.
+    """
+    from transformers import StoppingCriteria, StoppingCriteriaList
+
+    class StepClock(StoppingCriteria):
+        def __init__(self):
+            self.times: List[float] = []
+
+        def __call__(self, input_ids, scores, **kwargs):
+            self.times.append(time.perf_counter() - start)
+            return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+    device = next(model.parameters()).device
+    results = [RequestResult(spec) for spec in workload]
+    pending = deque(sorted(results, key=lambda r: r.spec.arrival_time))
+    start = time.perf_counter()
+    while pending:
+        now = time.perf_counter() - start
+        if pending[0].spec.arrival_time > now:
+            time.sleep(pending[0].spec.arrival_time - now)
+            now = time.perf_counter() - start
+        batch = []
+        while pending and len(batch) < batch_size and pending[0].spec.arrival_time <= now:
+            batch.append(pending.popleft())
+
+        max_prompt_len = max(len(r.spec.prompt_token_ids) for r in batch)
+        max_new_tokens = max(r.spec.output_len for r in batch)
+        input_ids = torch.full((len(batch), max_prompt_len), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for i, r in enumerate(batch):
+            prompt_len = len(r.spec.prompt_token_ids)
+            input_ids[i, max_prompt_len - prompt_len:] = torch.tensor(r.spec.prompt_token_ids)
+            attention_mask[i, max_prompt_len - prompt_len:] = 1
+        clock = StepClock()
+        with torch.no_grad():
+            model.generate(input_ids=input_ids.to(device), attention_mask=attention_mask.to(device),
+                           max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens, do_sample=False,
+                           pad_token_id=pad_token_id, stopping_criteria=StoppingCriteriaList([clock]))
+        for r in batch:
+            r.token_times = clock.times[:r.spec.output_len]
+            r.num_output_tokens = len(r.token_times)
+    return results
+
+def _percentiles(values: List[float], scale: float = 1000.0) -> Dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+    stats = {"mean": sum(values) / len(values) * scale}
+    for p in PERCENTILES:
+        # Nearest-rank percentile
+        stats[f"p{p}"] = values[min(math.ceil(p / 100 * len(values)) - 1, len(values) - 1)] * scale
+    return stats
+
+def summarize(results: List[RequestResult], slo_ttft: Optional[float] = None,
+              slo_tpot: Optional[float] = None) -> dict:
+    """
+    Aggregates one run. Latencies are in milliseconds; goodput counts only
+    the requests that met both SLOs (seconds; None means no bound).
+    """
+    completed = [r for r in results if r.error is None and r.token_times]
+    start = min(r.spec.arrival_time for r in results)
+    duration = max((r.token_times[-1] for r in completed), default=start) - start
+    output_tokens = sum(r.num_output_tokens for r in completed)
+    prompt_tokens = sum(len(r.spec.prompt_token_ids) for r in completed)
+    good = [r for r in completed
+            if (slo_ttft is None or r.ttft <= slo_ttft) and (slo_tpot is None or r.tpot <= slo_tpot)]
+    itl = [b - a for r in completed for a, b in zip(r.token_times, r.token_times[1:])]
+    per_second = (lambda n: n / duration) if duration > 0 else (lambda n: 0.0)
+    return {
+        "num_requests": len(results),
+        "num_completed": len(completed),
+        "num_errors": sum(r.error is not None for r in results),
+        "duration_s": duration,
+        "prompt_tokens": prompt_tokens,
+        "output_tokens": output_tokens,
+        "request_throughput": per_second(len(completed)),
+        "output_throughput": per_second(output_tokens),
+        "total_token_throughput": per_second(prompt_tokens + output_tokens),
+        "goodput": per_second(len(good)),
+        "slo_attainment": len(good) / len(results) if results else 0.0,
+        "slo": {"ttft_s": slo_ttft, "tpot_s": slo_tpot},
+        "ttft_ms": _percentiles([r.ttft for r in completed]),
+        "tpot_ms": _percentiles([r.tpot for r in completed if r.num_output_tokens > 1]),
+        "itl_ms": _percentiles(itl),
+        "e2e_ms": _percentiles([r.e2e for r in completed]),
+    }
+
+def perplexity(model, token_ids: List[int], window: int) -> float:
+    """exp of the mean next-token negative log-likelihood over consecutive windows of token_ids."""
+    device = next(model.parameters()).device
+    total_nll, num_predicted = 0.0, 0
+    for start in range(0, len(token_ids) - 1, window):
+        ids = torch.tensor([token_ids[start:start + window + 1]], device=device)
+        with torch.no_grad():
+            logits = model(input_ids=ids[:, :-1]).logits.float()
+        total_nll += torch.nn.functional.cross_entropy(logits[0], ids[0, 1:], reduction="sum").item()
+        num_predicted += ids.shape[1] - 1
+    return math.exp(total_nll / num_predicted)
+
+def quantization_report(model_path: str, executor, text: str, max_tokens: int) -> dict:
+    """Weight bytes and perplexity of a quantized executor's model against the fp32 checkpoint on text."""
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    from model.quantization import get_weight_nbytes
+
+    token_ids = AutoTokenizer.from_pretrained(model_path).encode(text)[:max_tokens]
+    reference = AutoModelForCausalLM.from_pretrained(model_path).to(executor.device).eval()
+    window = min(reference.config.n_positions, 1024) - 1
+    ppl, ppl_fp32 = perplexity(executor.model, token_ids, window), perplexity(reference, token_ids, window)
+    return {
+        "mode": executor.quantization,
+        "weight_mb": get_weight_nbytes(executor.model) / 1024**2,
+        "weight_mb_fp32": get_weight_nbytes(reference) / 1024**2,
+        "eval_tokens": len(token_ids),
+        "perplexity": ppl,
+        "perplexity_fp32": ppl_fp32,
+        "perplexity_delta": ppl - ppl_fp32,
+    }
+
+def paged_perplexity(executor, token_ids: List[int], window: int, chunk_size: int = 64) -> float:
+    """
+    Perplexity through the executor's paged KV cache: each window is
+    prefilled in chunks that attend to the cached (possibly quantized) keys
+    and values of the earlier ones, as in serving.
+    """
+    block_size = executor.kv_cache.block_size
+    block_table = list(range(executor.kv_cache.num_blocks))
+    total_nll, num_predicted = 0.0, 0
+    for start in range(0, len(token_ids) - 1, window):
+        ids = token_ids[start:start + window + 1]
+        for chunk_start in range(0, len(ids) - 1, chunk_size):
+            chunk = ids[chunk_start:min(chunk_start + chunk_size, len(ids) - 1)]
+            num_blocks = -(-(chunk_start + len(chunk)) // block_size)
+            logits = executor.execute_model([chunk], [chunk_start], [block_table[:num_blocks]], [len(chunk)])
+            targets = torch.tensor(ids[chunk_start + 1:chunk_start + 1 + len(chunk)], device=logits.device)
+            total_nll += torch.nn.functional.cross_entropy(logits, targets, reduction="sum").item()
+            num_predicted += len(chunk)
+    return math.exp(total_nll / num_predicted)
+
+def kv_cache_report(model_path: str, engine, text: str, max_tokens: int) -> dict:
+    """Capacity gain of a quantized KV cache over the model's dtype, and its perplexity delta."""
+    from transformers import AutoTokenizer
+    from model.model_executor import ModelExecutor
+
+    executor = engine.model_executor
+    kv_cache_dtype = executor.kv_cache.kv_cache_dtype
+    token_ids = AutoTokenizer.from_pretrained(model_path).encode(text)[:max_tokens]
+    window = min(engine.max_model_len, 1024) - 1
+    ppl = {}
+    for dtype in (kv_cache_dtype, "auto"):
+        # Fresh pools sized for one window, with the engine's weights
+        eval_executor = ModelExecutor(model_path, device=executor.device, quantization=executor.quantization,
+                                      group_size=executor.group_size)
+        eval_executor.init_kv_cache(num_blocks=-(-window // engine.block_size), block_size=engine.block_size,
+                                    kv_cache_dtype=dtype)
+        ppl[dtype] = paged_perplexity(eval_executor, token_ids, window)
+    block_nbytes = executor.get_kv_block_nbytes(engine.block_size, kv_cache_dtype)
+    block_nbytes_auto = executor.get_kv_block_nbytes(engine.block_size)
+    return {
+        "dtype": kv_cache_dtype,
+        "num_blocks": engine.num_gpu_blocks,
+        "max_concurrency": engine.max_concurrency,
+        "block_bytes": block_nbytes,
+        "block_bytes_auto": block_nbytes_auto,
+        "capacity_gain": block_nbytes_auto / block_nbytes,
+        "eval_tokens": len(token_ids),
+        "perplexity": ppl[kv_cache_dtype],
+        "perplexity_auto": ppl["auto"],
+        "perplexity_delta": ppl[kv_cache_dtype] - ppl["auto"],
+    }
+
+def build_tiny_model(model_name: str, path: str, n_embd: int = 64, n_layer: int = 2, n_head: int = 4) -> str:
+    """Saves model_name's tokenizer next to a small random-weight GPT-2 with its vocabulary."""
+    from transformers import AutoConfig, AutoTokenizer, GPT2Config, GPT2LMHeadModel
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    config = AutoConfig.from_pretrained(model_name)
+    torch.manual_seed(0)
+    tiny_config = GPT2Config(
+        vocab_size=config.vocab_size, n_positions=getattr(config, "n_positions", 1024),
+        n_embd=n_embd, n_layer=n_layer, n_head=n_head,
+        bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id,
+    )
+    GPT2LMHeadModel(tiny_config).save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    return path
+
+def _workload_from_args(args, vocab_size: int, eos_token_id: Optional[int], max_model_len: int) -> List[RequestSpec]:
+    if args.arrival == "trace":
+        if not args.trace:
+            raise SystemExit("--arrival trace needs --trace")
+        return load_trace(args.trace, vocab_size, eos_token_id, args.seed)
+    return build_workload(
+        args.num_requests, vocab_size, eos_token_id, arrival=args.arrival, request_rate=args.request_rate,
+        burst_size=args.burst_size, burst_interval=args.burst_interval,
+        input_len=args.input_len, input_dist=args.input_dist,
+        output_len=args.output_len, output_dist=args.output_dist,
+        max_model_len=max_model_len, seed=args.seed,
+    )
+
+def _run_hf_baseline(model_path: str, workload: List[RequestSpec], batch_size: int) -> List[RequestResult]:
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    print(f"[Benchmark] HF generate baseline (batch_size={batch_size})...", file=sys.stderr)
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = AutoModelForCausalLM.from_pretrained(model_path).to(device).eval()
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    run_hf(model, [RequestSpec(0.0, workload[0].prompt_token_ids[:8], 2)], batch_size, pad_token_id)  # warmup
+    return run_hf(model, workload, batch_size, pad_token_id)
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["engine", "http", "hf"], default="engine")
+    parser.add_argument("--model", default="gpt2", help="Model (and tokenizer) name or path")
+    parser.add_argument("--tiny", action="store_true", help="Random-weight tiny GPT-2 with the model's vocabulary")
+    parser.add_argument("--url", default="http://localhost:8000", help="Server for --backend http")
+    parser.add_argument("--max-concurrency", type=int, default=None, help="Requests in flight (http)")
+
+    parser.add_argument("--num-requests", type=int, default=64)
+    parser.add_argument("--arrival", choices=ARRIVAL_PROCESSES, default="poisson")
+    parser.add_argument("--request-rate", type=float, default=math.inf, help="Requests/s (poisson)")
+    parser.add_argument("--burst-size", type=int, default=0, help="Requests per burst (0: all)")
+    parser.add_argument("--burst-interval", type=float, default=0.0, help="Seconds between bursts")
+    parser.add_argument("--trace", help="JSON-lines trace for --arrival trace")
+    parser.add_argument("--input-len", type=int, default=128)
+    parser.add_argument("--input-dist", choices=LENGTH_DISTRIBUTIONS, default="uniform")
+    parser.add_argument("--output-len", type=int, default=128)
+    parser.add_argument("--output-dist", choices=LENGTH_DISTRIBUTIONS, default="uniform")
+    parser.add_argument("--seed", type=int, default=0)
+
+    parser.add_argument("--slo-ttft", type=float, default=None, help="TTFT bound in seconds for goodput")
+    parser.add_argument("--slo-tpot", type=float, default=None, help="Time-per-output-token bound in seconds")
+
+    parser.add_argument("--max-num-seqs", type=int, default=16, help="Engine batch size, and the HF batch size")
+    parser.add_argument("--num-gpu-blocks", type=int, default=None, help="KV blocks (default: profiled)")
+    parser.add_argument("--block-size", type=int, default=16)
+    parser.add_argument("--max-total-tokens", type=int, default=1024)
+    parser.add_argument("--compile", action="store_true", help="Compiled, shape-bucketed decode path (engine)")
+    parser.add_argument("--quantization", choices=QUANTIZATION_MODES, default="fp32", help="Weight format (engine)")
+    parser.add_argument("--group-size", type=int, default=DEFAULT_GROUP_SIZE, help="int4 quantization group size")
+    parser.add_argument("--kv-cache-dtype", choices=KV_CACHE_DTYPES, default="auto", help="KV cache format (engine)")
+    parser.add_argument("--ppl-text", default=os.path.join(os.path.dirname(__file__), "..", "README.md"),
+                        help="Text for the perplexity check of quantized weights")
+    parser.add_argument("--ppl-tokens", type=int, default=4096)
+    parser.add_argument("--compare-hf", action="store_true", help="Also run the HF baseline on the same workload")
+    parser.add_argument("--output", help="Also write the JSON report here")
+    args = parser.parse_args(argv)
+
+    from transformers import AutoConfig, AutoTokenizer
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = build_tiny_model(args.model, tmp) if args.tiny else args.model
+        config = AutoConfig.from_pretrained(model_path)
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        max_model_len = getattr(config, "n_positions", None) or config.max_position_embeddings
+        workload = _workload_from_args(args, config.vocab_size, tokenizer.eos_token_id, max_model_len)
+        print(f"[Benchmark] {len(workload)} requests, {args.arrival} arrivals, backend={args.backend}",
+              file=sys.stderr)
+
+        if args.backend == "engine":
+            from engine.llm_engine import LLMEngine
+
+            engine = LLMEngine(model_path, block_size=args.block_size, max_num_seqs=args.max_num_seqs,
+                               max_total_tokens=args.max_total_tokens, num_gpu_blocks=args.num_gpu_blocks,
+                               compile_decode=args.compile, quantization=args.quantization,
+                               quantization_group_size=args.group_size, kv_cache_dtype=args.kv_cache_dtype)
+            run_engine(engine, [RequestSpec(0.0, workload[0].prompt_token_ids[:8], 2)])  # warmup
+            results = run_engine(engine, workload)
+        elif args.backend == "http":
+            results = asyncio.run(run_http(args.url, workload, max_concurrency=args.max_concurrency))
+        else:
+            results = _run_hf_baseline(model_path, workload, args.max_num_seqs)
+
+        report = {"backend": args.backend, "model": args.model, "tiny": args.tiny,
+                  **summarize(results, args.slo_ttft, args.slo_tpot)}
+        if args.backend == "engine" and args.quantization != "fp32":
+            with open(args.ppl_text) as f:
+                report["quantization"] = quantization_report(model_path, engine.model_executor, f.read(),
+                                                              args.ppl_tokens)
+        if args.backend == "engine" and args.kv_cache_dtype != "auto":
+            with open(args.ppl_text) as f:
+                report["kv_cache"] = kv_cache_report(model_path, engine, f.read(), args.ppl_tokens)
+        if args.compare_hf and args.backend != "hf":
+            baseline = summarize(_run_hf_baseline(model_path, workload, args.max_num_seqs),
+                                 args.slo_ttft, args.slo_tpot)
+            report["hf_baseline"] = baseline
+            if baseline["output_throughput"] > 0:
+                report["speedup"] = report["output_throughput"] / baseline["output_throughput"]
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    return report
+
+if __name__ == "__main__":
+    main()
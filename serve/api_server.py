@@ -1,10 +1,15 @@
-from fastapi import FastAPI, HTTPException
+import time
+_import_start = time.perf_counter()
+
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 import asyncio
-import uuid
+import json
+import signal
 import uvicorn
 from contextlib import asynccontextmanager
-from typing import Dict, AsyncGenerator
+from typing import TYPE_CHECKING, AsyncGenerator, Dict, List, Optional, Union
 
 import sys
 import os
@@ -12,103 +17,334 @@ import os
 # Add parent directory to path to allow importing 'engine' and 'model'
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from engine.llm_engine import LLMEngine
+# torch and transformers are only imported by the engine loader, after the
+# server is listening, so /health answers while the model loads
+from engine.sampling_params import SamplingParams
+
+if TYPE_CHECKING:
+    from engine.async_llm_engine import AsyncLLMEngine
+    from engine.data_parallel import DataParallelEngine
 
-# Global Engine Instance
-engine: LLMEngine = None
-request_queues: Dict[str, asyncio.Queue] = {}
+# Global Engine Instance (the LLMEngine runs in its own thread, or in
+# NUM_ENGINE_REPLICAS worker processes behind a router); set once it is ready
+engine: Union["AsyncLLMEngine", "DataParallelEngine"] = None
+# Seconds per startup phase, and the error that stopped startup, if any
+startup_timings: Dict[str, float] = {"import_server": time.perf_counter() - _import_start}
+startup_error: Optional[str] = None
+# Seconds between checks that a client is still connected
+DISCONNECT_POLL_INTERVAL = 0.5
+# Default per-request deadline in seconds (unset: none); a request's "timeout" overrides it
+REQUEST_TIMEOUT = float(os.environ["REQUEST_TIMEOUT"]) if "REQUEST_TIMEOUT" in os.environ else None
 
 class CompletionRequest(BaseModel):
-    prompt: str
+    # Either the prompt text or its token ids (skips server-side tokenization)
+    prompt: Optional[str] = None
+    prompt_token_ids: Optional[List[int]] = None
     max_tokens: int = 50
+    temperature: float = 1.0
+    top_p: float = 1.0
+    top_k: int = -1
+    min_p: float = 0.0
+    repetition_penalty: float = 1.0
+    presence_penalty: float = 0.0
+    frequency_penalty: float = 0.0
+    seed: Optional[int] = None
+    logprobs: Optional[int] = None
+    stream: bool = False
+    stop: Optional[Union[str, List[str]]] = None
+    stop_token_ids: Optional[List[int]] = None
+    ignore_eos: bool = False
+    n: int = 1
+    best_of: Optional[int] = None
+    use_beam_search: bool = False
+    length_penalty: float = 1.0
+    # Scheduling: lower priority classes run first; user names the tenant
+    # when the request carries no API key
+    priority: int = 0
+    user: Optional[str] = None
+    # Seconds until generation stops with finish_reason "timeout"
+    timeout: Optional[float] = None
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    # Startup: Initialize Engine
-    global engine
+    def to_sampling_params(self) -> SamplingParams:
+        return SamplingParams(
+            temperature=self.temperature,
+            top_k=self.top_k,
+            top_p=self.top_p,
+            min_p=self.min_p,
+            repetition_penalty=self.repetition_penalty,
+            presence_penalty=self.presence_penalty,
+            frequency_penalty=self.frequency_penalty,
+            seed=self.seed,
+            logprobs=self.logprobs,
+            max_tokens=self.max_tokens,
+            stop=self.stop,
+            stop_token_ids=self.stop_token_ids,
+            ignore_eos=self.ignore_eos,
+            n=self.n,
+            best_of=self.best_of,
+            use_beam_search=self.use_beam_search,
+            length_penalty=self.length_penalty,
+        )
+
+def _engine_kwargs() -> dict:
     # Use a small model for the demo to run on consumer hardware
     # Use a medium model for better intelligence (requires more RAM)
-    engine = LLMEngine(model_name="gpt2-medium", max_num_seqs=16) 
-    
-    # Start the background inference loop
-    asyncio.create_task(inference_loop())
+    engine_kwargs = dict(model_name="gpt2-medium", max_num_seqs=16,
+                         scheduling_policy=os.environ.get("SCHEDULING_POLICY", "fcfs"),
+                         preemption_mode=os.environ.get("PREEMPTION_MODE", "recompute"),
+                         swap_space_gb=float(os.environ.get("SWAP_SPACE_GB", "0")),
+                         disk_swap_space_gb=float(os.environ.get("DISK_SWAP_SPACE_GB", "0")),
+                         swap_dir=os.environ.get("SWAP_DIR"),
+                         compile_decode=os.environ.get("COMPILE_DECODE", "0") == "1",
+                         quantization=os.environ.get("QUANTIZATION", "fp32"),
+                         kv_cache_dtype=os.environ.get("KV_CACHE_DTYPE", "auto"),
+                         warmup=os.environ.get("WARMUP", "1") == "1")
+    # The KV pool is sized by profiling unless given an absolute budget (per replica)
+    if "GPU_MEMORY_UTILIZATION" in os.environ:
+        engine_kwargs["gpu_memory_utilization"] = float(os.environ["GPU_MEMORY_UTILIZATION"])
+    if "KV_CACHE_MEMORY_GB" in os.environ:
+        engine_kwargs["kv_cache_memory_gb"] = float(os.environ["KV_CACHE_MEMORY_GB"])
+    return engine_kwargs
+
+async def load_engine(engine_kwargs: dict, num_replicas: int = 1):
+    """
+    Imports and builds the engine (weights, tokenizer, KV cache, optional
+    warm-up) off the event loop, starts it and only then publishes it, which
+    makes /ready succeed. Each phase is timed into startup_timings.
+    """
+    global engine, startup_error
+    phase_start = time.perf_counter()
+
+    def mark(phase: str):
+        nonlocal phase_start
+        now = time.perf_counter()
+        startup_timings[phase] = now - phase_start
+        phase_start = now
+
+    try:
+        def import_engine():
+            from engine.async_llm_engine import AsyncLLMEngine
+            from engine.data_parallel import DataParallelEngine
+            from engine.llm_engine import LLMEngine
+            return AsyncLLMEngine, DataParallelEngine, LLMEngine
+
+        AsyncLLMEngine, DataParallelEngine, LLMEngine = await asyncio.to_thread(import_engine)
+        mark("import_engine")
+        if num_replicas > 1:
+            new_engine = await asyncio.to_thread(DataParallelEngine, num_replicas, engine_kwargs, pin_cores=True)
+            new_engine.start(wait=False)
+            await asyncio.to_thread(new_engine.wait_until_ready)
+        else:
+            llm_engine = await asyncio.to_thread(LLMEngine, **engine_kwargs)
+            new_engine = AsyncLLMEngine(llm_engine)
+            # Start the engine thread; it sleeps until requests arrive
+            new_engine.start()
+        mark("load_engine")
+    except Exception as e:
+        startup_error = f"{type(e).__name__}: {e}"
+        print(f"[Server] Startup failed: {startup_error}")
+        raise
+    engine = new_engine
+    startup_timings["total"] = time.perf_counter() - _import_start
+    print("[Server] Ready. Startup: " + ", ".join(f"{phase} {seconds:.2f}s"
+                                                  for phase, seconds in startup_timings.items()))
+
+def _exit_on_startup_failure(loader: asyncio.Task):
+    # A server that can never become ready shuts down (and exits non-zero, see
+    # __main__) so start.sh and process supervisors see the failure
+    if not loader.cancelled() and loader.exception() is not None:
+        os.kill(os.getpid(), signal.SIGTERM)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup: the engine loads in the background; /ready reports when it is done
+    num_replicas = int(os.environ.get("NUM_ENGINE_REPLICAS", "1"))
+    loader = asyncio.create_task(load_engine(_engine_kwargs(), num_replicas))
+    loader.add_done_callback(_exit_on_startup_failure)
     yield
-    # Shutdown logic (if any)
+    # Loading runs in threads that cannot be interrupted; let it finish before shutting down
+    try:
+        await loader
+    except Exception:
+        pass
+    if engine is not None:
+        engine.shutdown()
 
 app = FastAPI(lifespan=lifespan)
 
-async def inference_loop():
+class LogprobsCollector:
+    """Builds the OpenAI legacy completions logprobs layout chunk by chunk."""
+    def __init__(self):
+        self.text_len = 0
+
+    def add(self, chunk: dict) -> dict:
+        logprobs = {"tokens": [], "token_logprobs": [], "top_logprobs": [], "text_offset": []}
+        for token_id, token_logprobs in zip(chunk["token_ids"], chunk["logprobs"]):
+            token_text = engine.tokenizer.decode([token_id])
+            token_logprob, top_logprobs = token_logprobs
+            logprobs["tokens"].append(token_text)
+            logprobs["token_logprobs"].append(token_logprob)
+            logprobs["top_logprobs"].append(
+                {engine.tokenizer.decode([tok]): lp for tok, lp in top_logprobs.items()}
+            )
+            logprobs["text_offset"].append(self.text_len)
+            self.text_len += len(token_text)
+        return logprobs
+
+def _usage(chunk: dict) -> dict:
+    usage = {
+        "prompt_tokens": chunk["prompt_tokens"],
+        "completion_tokens": chunk["completion_tokens"],
+        "total_tokens": chunk["prompt_tokens"] + chunk["completion_tokens"],
+    }
+    # Draft, accepted and step counts of a request that used speculative decoding
+    if chunk["spec_decode"] is not None:
+        usage["spec_decode"] = chunk["spec_decode"]
+    return usage
+
+def _tenant(request: CompletionRequest, authorization: Optional[str]) -> Optional[str]:
+    """Requests are grouped into tenants by API key, else by the user field."""
+    if authorization and authorization.startswith("Bearer "):
+        return authorization[len("Bearer "):]
+    return request.user
+
+async def watch_request(http_request: Request, request_id: str, deadline: Optional[float]):
     """
-    Background Task: Ticks the engine every few milliseconds.
+    Aborts the request, freeing its KV blocks, as soon as its client
+    disconnects or its deadline (time.monotonic()) passes. Cancelled once
+    the response is complete.
     """
-    print("[Server] Inference loop started.")
     while True:
-        # Run one step of the engine
-        outputs = engine.step()
-        
-        # Distribute results to waiting requests
-        for out in outputs:
-            req_id = out["req_id"]
-            if req_id in request_queues:
-                # Put the output into the specific request's queue
-                request_queues[req_id].put_nowait(out)
-                
-        # Yield control to allow other async tasks (like receiving requests) to run
-        # A small sleep to prevent CPU spinning if idle, 
-        # but in tight loop we want 0.
-        if not outputs:
-            await asyncio.sleep(0.01)
-        else:
-            await asyncio.sleep(0)
+        interval = DISCONNECT_POLL_INTERVAL
+        if deadline is not None:
+            interval = min(interval, max(deadline - time.monotonic(), 0.0))
+        await asyncio.sleep(interval)
+        if deadline is not None and time.monotonic() >= deadline:
+            engine.abort_request(request_id, "timeout")
+            return
+        if await http_request.is_disconnected():
+            engine.abort_request(request_id)
+            return
 
 @app.post("/v1/completions")
-async def generate(request: CompletionRequest):
+async def generate(request: CompletionRequest, http_request: Request, authorization: Optional[str] = Header(None)):
     """
     OpenAI-compatible completion endpoint (simplified).
+    With stream=true the tokens are sent as Server-Sent Events while they
+    are generated, followed by a usage chunk and "data: [DONE]". Every
+    chunk carries the choice ("index") it belongs to when n > 1.
+    A request whose client disconnects is aborted; one that runs past its
+    timeout ends early with finish_reason "timeout".
     """
-    # 1. Add request to engine
-    # We ignore the engine's internal req_id and use our own to map back
-    # Actually, LLMEngine.add_request returns the req_id it assigned.
-    # We should wrap add_request to be thread-safe if needed, 
-    # practically for this MVP, Python GIL + Asyncio single thread is fine.
-    
-    req_id = engine.add_request(request.prompt)
-    
-    # 2. Setup a queue to receive tokens
-    queue = asyncio.Queue()
-    request_queues[req_id] = queue
-    
-    generated_text = ""
-    
+    if engine is None:
+        raise HTTPException(status_code=503, detail="Model is still loading")
+    # Already imported by load_engine
+    from engine.async_llm_engine import EngineDeadError
     try:
-        while True:
-            # Wait for next token
-            output = await queue.get()
-            
-            token_text = output["text"]
-            generated_text += token_text
-            
-            if output["finished"]:
-                break
-                
+        if (request.prompt is None) == (request.prompt_token_ids is None):
+            raise ValueError("Exactly one of prompt and prompt_token_ids must be given")
+        timeout = request.timeout if request.timeout is not None else REQUEST_TIMEOUT
+        if timeout is not None and timeout <= 0:
+            raise ValueError("timeout must be positive")
+        sampling_params = request.to_sampling_params()
+        if request.stream and not sampling_params.is_streamable:
+            raise ValueError("best_of > n and beam search cannot be streamed")
+        stream = await engine.add_request(request.prompt, sampling_params, request.prompt_token_ids,
+                                          priority=request.priority, tenant=_tenant(request, authorization))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except EngineDeadError as e:
+        raise HTTPException(status_code=503, detail=f"Engine failed: {e}")
+    req_id = stream.request_id
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    watcher = asyncio.create_task(watch_request(http_request, req_id, deadline))
+    created = int(time.time())
+    want_logprobs = request.logprobs is not None
+    collectors = [LogprobsCollector() for _ in range(request.n)]
+
+    def completion(choices: List[dict], **extra) -> dict:
+        return {"id": req_id, "object": "text_completion", "created": created,
+                "model": engine.model_name, "choices": choices, **extra}
+
+    if request.stream:
+        async def event_stream() -> AsyncGenerator[str, None]:
+            finished = False
+            try:
+                while not finished:
+                    chunk = await stream.get()
+                    finished = chunk["finished"]
+                    choice = {
+                        "text": chunk["text"],
+                        "index": chunk["index"],
+                        "logprobs": collectors[chunk["index"]].add(chunk) if want_logprobs else None,
+                        "finish_reason": chunk["finish_reason"],
+                    }
+                    yield f"data: {json.dumps(completion([choice]))}\n\n"
+                yield f"data: {json.dumps(completion([], usage=_usage(chunk)))}\n\n"
+                yield "data: [DONE]\n\n"
+            except EngineDeadError as e:
+                # The headers are sent already: report the failure as the last event
+                yield f"data: {json.dumps({'error': {'message': f'Engine failed: {e}', 'type': 'engine_error'}})}\n\n"
+            finally:
+                watcher.cancel()
+                # The stream was closed early (client gone): stop generating for it
+                if not finished:
+                    engine.abort_request(req_id)
+
+        return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+    choices = [
+        {"text": "", "index": index,
+         "logprobs": {"tokens": [], "token_logprobs": [], "top_logprobs": [], "text_offset": []} if want_logprobs else None,
+         "finish_reason": None}
+        for index in range(request.n)
+    ]
+    finished = False
+    try:
+        while not finished:
+            chunk = await stream.get()
+            finished = chunk["finished"]
+            choice = choices[chunk["index"]]
+            choice["text"] += chunk["text"]
+            if want_logprobs:
+                for key, values in collectors[chunk["index"]].add(chunk).items():
+                    choice["logprobs"][key].extend(values)
+            if chunk["finish_reason"] is not None:
+                choice["finish_reason"] = chunk["finish_reason"]
+    except EngineDeadError as e:
+        raise HTTPException(status_code=503, detail=f"Engine failed: {e}")
     finally:
-        # Cleanup
-        del request_queues[req_id]
-        
-    return {
-        "id": req_id,
-        "object": "text_completion",
-        "created": int(uuid.uuid4().time_low),
-        "model": "gpt2",
-        "choices": [
-            {
-                "text": generated_text,
-                "index": 0,
-                "logprobs": None,
-                "finish_reason": "length"
-            }
-        ]
-    }
+        watcher.cancel()
+        # The handler was cancelled before the request finished
+        if not finished:
+            engine.abort_request(req_id)
+
+    return completion(choices, usage=_usage(chunk))
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint: latencies, queue and batch sizes, throughput, KV usage, step phases."""
+    if engine is None:
+        raise HTTPException(status_code=503, detail="Model is still loading")
+    return PlainTextResponse(engine.render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/health")
+async def health():
+    """Liveness: the server process answers, unless loading the engine failed or the engine died."""
+    error = startup_error if engine is None else engine.error
+    if error is not None:
+        return JSONResponse({"status": "failed", "error": error}, status_code=503)
+    return {"status": "ok"}
+
+@app.get("/ready")
+async def ready():
+    """Readiness: the model is loaded (and warmed up) and the engine is accepting requests."""
+    if engine is None or engine.error is not None:
+        status = "failed" if startup_error is not None or engine is not None else "loading"
+        return JSONResponse({"status": status, "startup_seconds": startup_timings}, status_code=503)
+    return {"status": "ready", "startup_seconds": startup_timings}
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
+    if startup_error is not None:
+        sys.exit(1)
@@ -2,10 +2,19 @@
 
 # Start the API server in the background
 python serve/api_server.py &
+SERVER_PID=$!
 
-# Wait for the API server to start (simple sleep or check)
-echo "Waiting for API server to start..."
-sleep 5
+# Wait until the model is loaded and warmed up (/ready), or the server has died
+# (it shuts itself down when loading fails)
+echo "Waiting for API server to become ready..."
+until python -c "import urllib.request; urllib.request.urlopen('http://localhost:8000/ready', timeout=2)" 2>/dev/null; do
+    if ! kill -0 "$SERVER_PID" 2>/dev/null; then
+        echo "API server exited during startup"
+        exit 1
+    fi
+    sleep 0.5
+done
+echo "API server is ready."
 
 # Start the Streamlit UI (listening on the port HF expects: 7860)
 echo "Starting Streamlit UI found at chat_ui.py..."
@@ -0,0 +1,74 @@
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+def _bytes_to_unicode():
+    # Byte-level alphabet used by GPT-2's BPE
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return dict(zip(bs, [chr(c) for c in cs]))
+
+
+@pytest.fixture(scope="session")
+def tiny_model_path(tmp_path_factory):
+    """
+    A tiny random-weight GPT-2 with a byte-level tokenizer, saved locally
+    so the engine can be exercised without downloading checkpoints.
+    """
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders
+    from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+    import torch
+
+    path = tmp_path_factory.mktemp("tiny-gpt2")
+    vocab = {c: i for i, c in enumerate(_bytes_to_unicode().values())}
+    vocab["<|endoftext|>"] = len(vocab)
+    eos_token_id = vocab["<|endoftext|>"]
+
+    bpe = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.decoder = decoders.ByteLevel()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=bpe,
+        eos_token="<|endoftext|>",
+        bos_token="<|endoftext|>",
+        unk_token="<|endoftext|>",
+    )
+    tokenizer.save_pretrained(path)
+
+    torch.manual_seed(0)
+    config = GPT2Config(
+        vocab_size=50257, n_positions=512, n_embd=32, n_layer=2, n_head=4,
+        bos_token_id=eos_token_id, eos_token_id=eos_token_id,
+    )
+    GPT2LMHeadModel(config).save_pretrained(path)
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def tiny_draft_model_path(tiny_model_path, tmp_path_factory):
+    """A smaller, differently seeded model sharing the tiny tokenizer, for speculative decoding."""
+    from transformers import AutoTokenizer, GPT2Config, GPT2LMHeadModel
+    import torch
+
+    path = tmp_path_factory.mktemp("tiny-gpt2-draft")
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_path)
+    tokenizer.save_pretrained(path)
+
+    torch.manual_seed(1)
+    config = GPT2Config(
+        vocab_size=50257, n_positions=512, n_embd=16, n_layer=1, n_head=2,
+        bos_token_id=tokenizer.eos_token_id, eos_token_id=tokenizer.eos_token_id,
+    )
+    GPT2LMHeadModel(config).save_pretrained(path)
+    return str(path)
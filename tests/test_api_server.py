@@ -0,0 +1,273 @@
+import asyncio
+import json
+import threading
+import time
+
+import httpx
+
+from engine.async_llm_engine import AsyncLLMEngine, RequestStream, TokenizerPool
+from engine.llm_engine import LLMEngine
+from engine.sampling_params import SamplingParams
+from serve import api_server
+
+
+def post_completions(engine, payloads):
+    """Runs the app in-process with its engine thread and posts each payload concurrently."""
+    async def run():
+        api_server.engine = AsyncLLMEngine(engine)
+        api_server.engine.start()
+        transport = httpx.ASGITransport(app=api_server.app)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await asyncio.gather(*[client.post("/v1/completions", json=p) for p in payloads])
+        finally:
+            api_server.engine.shutdown()
+
+    return asyncio.run(run())
+
+
+def parse_events(body):
+    events = [line[len("data: "):] for line in body.split("\n\n") if line.startswith("data: ")]
+    assert events[-1] == "[DONE]"
+    return [json.loads(e) for e in events[:-1]]
+
+
+def test_streaming_matches_non_streaming(tiny_model_path):
+    engine = LLMEngine(tiny_model_path, max_num_seqs=4)
+    payload = {"prompt": "Hello there", "max_tokens": 6, "temperature": 0.0, "logprobs": 2}
+
+    plain, streamed = post_completions(engine, [payload, {**payload, "stream": True}])
+
+    assert plain.status_code == streamed.status_code == 200
+    assert streamed.headers["content-type"].startswith("text/event-stream")
+    body = plain.json()
+    events = parse_events(streamed.text)
+    chunks, usage = events[:-1], events[-1]
+
+    assert "".join(c["choices"][0]["text"] for c in chunks) == body["choices"][0]["text"]
+    assert sum(len(c["choices"][0]["logprobs"]["tokens"]) for c in chunks) == 6
+    assert [c["choices"][0]["finish_reason"] for c in chunks] == [None] * (len(chunks) - 1) + ["length"]
+    assert body["choices"][0]["finish_reason"] == "length"
+    assert usage["choices"] == []
+    assert usage["usage"] == body["usage"] == {"prompt_tokens": 11, "completion_tokens": 6, "total_tokens": 17}
+
+
+def test_rejected_prompt_returns_400(tiny_model_path):
+    engine = LLMEngine(tiny_model_path, block_size=4, num_gpu_blocks=4)
+    response, = post_completions(engine, [{"prompt": "x" * 64}])
+    assert response.status_code == 400
+
+
+def test_event_loop_runs_while_engine_steps(tiny_model_path):
+    engine = LLMEngine(tiny_model_path, max_num_seqs=4)
+    step = engine.step
+    in_step = threading.Event()
+
+    def slow_step():
+        in_step.set()
+        time.sleep(0.02)
+        outputs = step()
+        in_step.clear()
+        return outputs
+    engine.step = slow_step
+
+    async def run():
+        async_engine = AsyncLLMEngine(engine)
+        async_engine.start()
+        try:
+            stream = await async_engine.add_request("Hello", SamplingParams(max_tokens=4))
+            # The loop keeps ticking while the engine thread is inside a step
+            ticks_during_step = 0
+            while engine.has_unfinished_requests():
+                await asyncio.sleep(0.001)
+                ticks_during_step += in_step.is_set()
+            chunks = [await stream.get()]
+            while not chunks[-1]["finished"]:
+                chunks.append(await stream.get())
+            return chunks, ticks_during_step
+        finally:
+            async_engine.shutdown()
+
+    chunks, ticks_during_step = asyncio.run(run())
+    assert ticks_during_step > 4
+    assert sum(len(c["token_ids"]) for c in chunks) == 4
+    assert not engine.has_unfinished_requests()
+
+
+def test_failed_step_fails_open_requests_and_health(tiny_model_path):
+    engine = LLMEngine(tiny_model_path, max_num_seqs=4)
+    step, add_request = engine.step, engine.add_request
+    request_ids = []
+
+    def failing_step():
+        # Fails once both requests are running
+        if len(request_ids) == 2:
+            raise RuntimeError("out of memory")
+        return step()
+
+    def counting_add_request(*args, **kwargs):
+        request_ids.append(add_request(*args, **kwargs))
+        return request_ids[-1]
+    engine.step, engine.add_request = failing_step, counting_add_request
+
+    async def run():
+        api_server.engine = AsyncLLMEngine(engine)
+        api_server.engine.start()
+        transport = httpx.ASGITransport(app=api_server.app)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                payload = {"prompt": "Hello", "max_tokens": 480, "ignore_eos": True}
+                plain, streamed = await asyncio.gather(client.post("/v1/completions", json=payload),
+                                                       client.post("/v1/completions", json={**payload, "stream": True}))
+                return plain, streamed, await client.get("/health"), await client.post("/v1/completions", json=payload)
+        finally:
+            api_server.engine.shutdown()
+            api_server.engine = None
+
+    plain, streamed, health, rejected = asyncio.run(run())
+    assert plain.status_code == 503
+    events = [json.loads(line[len("data: "):]) for line in streamed.text.split("\n\n") if line.startswith("data: ")]
+    assert "out of memory" in events[-1]["error"]["message"]
+    assert health.status_code == 503 and health.json()["status"] == "failed"
+    assert rejected.status_code == 503
+
+
+def test_request_past_its_timeout_ends_early(tiny_model_path):
+    engine = LLMEngine(tiny_model_path, max_num_seqs=4)
+    payload = {"prompt": "Hello", "max_tokens": 480, "ignore_eos": True, "timeout": 0.05}
+    plain, streamed = post_completions(engine, [payload, {**payload, "stream": True}])
+
+    body = plain.json()
+    assert body["choices"][0]["finish_reason"] == "timeout"
+    assert body["usage"]["completion_tokens"] < 480
+    events = parse_events(streamed.text)
+    assert events[-2]["choices"][0]["finish_reason"] == "timeout"
+    assert engine.block_manager.get_num_free_blocks() == engine.block_manager.allocator.num_blocks
+
+
+def test_request_stream_merges_outputs_when_full():
+    async def run():
+        stream = RequestStream(max_pending=2)
+        for i in range(5):
+            stream.put({"index": 0, "text": str(i), "token_id": i, "logprobs": None, "finished": i == 4,
+                        "finish_reason": "length" if i == 4 else None,
+                        "prompt_tokens": 3, "completion_tokens": i + 1, "spec_decode": None})
+        return [await stream.get(), await stream.get()]
+
+    first, rest = asyncio.run(run())
+    assert (first["text"], first["token_ids"]) == ("0", [0])
+    assert (rest["text"], rest["token_ids"], rest["finished"]) == ("1234", [1, 2, 3, 4], True)
+    assert rest["completion_tokens"] == 5
+
+
+def test_multiple_choices(tiny_model_path):
+    engine = LLMEngine(tiny_model_path, max_num_seqs=8)
+    payload = {"prompt": "Hello there", "max_tokens": 4, "n": 2, "seed": 0, "logprobs": 1, "ignore_eos": True}
+
+    plain, streamed, beam, beam_streamed = post_completions(engine, [
+        payload, {**payload, "stream": True},
+        {"prompt": "Hello", "max_tokens": 3, "temperature": 0.0, "n": 2, "use_beam_search": True, "best_of": 2,
+         "ignore_eos": True},
+        {"prompt": "Hello", "temperature": 0.0, "use_beam_search": True, "best_of": 2, "stream": True},
+    ])
+
+    body = plain.json()
+    assert [c["index"] for c in body["choices"]] == [0, 1]
+    assert all(len(c["logprobs"]["tokens"]) == 4 for c in body["choices"])
+    assert body["usage"]["completion_tokens"] == 8
+    chunks = parse_events(streamed.text)[:-1]
+    for index in (0, 1):
+        own = [c["choices"][0] for c in chunks if c["choices"][0]["index"] == index]
+        assert sum(len(c["logprobs"]["tokens"]) for c in own) == 4
+        assert own[-1]["finish_reason"] == "length"
+
+    assert [c["finish_reason"] for c in beam.json()["choices"]] == ["length", "length"]
+    assert beam_streamed.status_code == 400
+
+
+def test_prompt_token_ids_skip_tokenization(tiny_model_path):
+    engine = LLMEngine(tiny_model_path, max_num_seqs=4)
+    prompt_token_ids = engine.tokenizer.encode("Hello there")
+    payload = {"max_tokens": 5, "temperature": 0.0, "logprobs": 0}
+
+    text, ids, both, out_of_vocab = post_completions(engine, [
+        {**payload, "prompt": "Hello there"},
+        {**payload, "prompt_token_ids": prompt_token_ids},
+        {**payload, "prompt": "Hello there", "prompt_token_ids": prompt_token_ids},
+        {**payload, "prompt_token_ids": [1, 2, 10**6]},
+    ])
+
+    assert text.json()["choices"][0]["logprobs"] == ids.json()["choices"][0]["logprobs"]
+    assert text.json()["usage"] == ids.json()["usage"]
+    assert both.status_code == out_of_vocab.status_code == 400
+
+
+def test_tokenizer_pool_batches_and_caches(tiny_model_path):
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_path)
+    prompts = ["alpha", "beta", "alpha", "gamma delta", "beta"]
+
+    async def run():
+        pool = TokenizerPool(tokenizer, cache_size=2)
+        pool.start()
+        try:
+            first = await asyncio.gather(*[pool.encode(p) for p in prompts])
+            again = await pool.encode("gamma delta")
+            return pool, first, again
+        finally:
+            pool.shutdown()
+
+    pool, first, again = asyncio.run(run())
+    assert first == [tokenizer.encode(p) for p in prompts]
+    assert again == tokenizer.encode("gamma delta")
+    # Concurrent arrivals share batched calls; the repeat is a cache hit
+    assert pool.num_batches < len(prompts)
+    assert pool.num_cache_hits == 1
+    assert len(pool._cache) == 2
+
+
+def test_metrics_endpoint(tiny_model_path):
+    async def run():
+        api_server.engine = AsyncLLMEngine(LLMEngine(tiny_model_path, max_num_seqs=4))
+        api_server.engine.start()
+        transport = httpx.ASGITransport(app=api_server.app)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                await client.post("/v1/completions", json={"prompt": "Hi", "max_tokens": 3, "ignore_eos": True})
+                return await client.get("/metrics")
+        finally:
+            api_server.engine.shutdown()
+
+    response = asyncio.run(run())
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "minivllm_decode_tokens_total 3" in response.text
+    assert "# TYPE minivllm_e2e_request_latency_seconds histogram" in response.text
+
+
+def test_health_and_readiness_while_the_engine_loads(tiny_model_path):
+    async def run():
+        api_server.engine = None
+        transport = httpx.ASGITransport(app=api_server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            loading = await asyncio.gather(client.get("/health"), client.get("/ready"),
+                                           client.post("/v1/completions", json={"prompt": "Hi"}))
+            await api_server.load_engine({"model_name": tiny_model_path, "max_num_seqs": 4, "warmup": True})
+            try:
+                ready = await client.get("/ready")
+                completion = await client.post("/v1/completions", json={"prompt": "Hi", "max_tokens": 2})
+                return loading, ready, completion, api_server.engine.engine
+            finally:
+                api_server.engine.shutdown()
+                api_server.engine = None
+
+    (health, not_ready, rejected), ready, completion, engine = asyncio.run(run())
+
+    assert health.status_code == 200
+    assert not_ready.status_code == 503 and not_ready.json()["status"] == "loading"
+    assert rejected.status_code == 503
+    assert ready.status_code == 200
+    assert {"import_server", "import_engine", "load_engine", "total"} <= set(ready.json()["startup_seconds"])
+    assert completion.status_code == 200
+    # The warm-up request ran before readiness but is not in the metrics
+    assert "warmup" in engine.startup_timings and engine.metrics.num_decode_tokens == 2
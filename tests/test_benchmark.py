@@ -0,0 +1,69 @@
+import asyncio
+
+import httpx
+import pytest
+
+from engine.async_llm_engine import AsyncLLMEngine
+from engine.llm_engine import LLMEngine
+from scripts.benchmark import (RequestResult, RequestSpec, build_workload, run_engine, run_hf, run_http,
+                               sample_arrivals, summarize)
+from serve import api_server
+
+
+def test_workload_shapes_and_arrivals():
+    workload = build_workload(8, vocab_size=300, eos_token_id=256, request_rate=4.0,
+                              input_len=10, output_len=6, max_model_len=12, seed=1)
+
+    arrivals = [r.arrival_time for r in workload]
+    assert arrivals == sorted(arrivals) and arrivals[0] > 0
+    assert all(5 <= len(r.prompt_token_ids) <= 11 and 256 not in r.prompt_token_ids for r in workload)
+    assert all(1 <= r.output_len and len(r.prompt_token_ids) + r.output_len <= 12 for r in workload)
+    assert workload[3].prompt_token_ids == build_workload(8, 300, 256, request_rate=4.0, input_len=10,
+                                                          output_len=6, max_model_len=12, seed=1)[3].prompt_token_ids
+    assert sample_arrivals(None, "burst", 5, burst_size=2, burst_interval=1.5) == [0.0, 0.0, 1.5, 1.5, 3.0]
+
+
+def test_summary_percentiles_and_goodput():
+    results = []
+    for i, ttft in enumerate([0.1, 0.2, 0.3, 2.0]):
+        result = RequestResult(RequestSpec(float(i), [1, 2], 3))
+        result.token_times = [i + ttft, i + ttft + 0.05, i + ttft + 0.1]
+        result.num_output_tokens = 3
+        results.append(result)
+
+    summary = summarize(results, slo_ttft=0.5, slo_tpot=0.1)
+
+    assert summary["num_completed"] == 4 and summary["output_tokens"] == 12
+    assert summary["duration_s"] == pytest.approx(5.1)
+    assert summary["goodput"] == pytest.approx(3 / 5.1)
+    assert summary["slo_attainment"] == 0.75
+    assert summary["ttft_ms"]["p50"] == pytest.approx(200.0)
+    assert summary["ttft_ms"]["p99"] == pytest.approx(2000.0)
+    assert summary["tpot_ms"]["mean"] == pytest.approx(50.0)
+
+
+def test_backends_generate_the_whole_workload(tiny_model_path):
+    workload = build_workload(4, vocab_size=256, input_len=8, output_len=5, output_dist="fixed", seed=0)
+    engine = LLMEngine(tiny_model_path, max_num_seqs=4)
+
+    async def http():
+        api_server.engine = AsyncLLMEngine(engine)
+        api_server.engine.start()
+        try:
+            transport = httpx.ASGITransport(app=api_server.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await run_http("http://test", workload, client=client, max_concurrency=2)
+        finally:
+            api_server.engine.shutdown()
+
+    runs = [
+        run_engine(engine, workload),
+        asyncio.run(http()),
+        run_hf(engine.model_executor.model, workload, batch_size=2, pad_token_id=256),
+    ]
+
+    for results in runs:
+        assert [r.error for r in results] == [None] * 4
+        assert [r.num_output_tokens for r in results] == [5] * 4
+        summary = summarize(results)
+        assert summary["output_tokens"] == 20 and summary["output_throughput"] > 0
@@ -0,0 +1,74 @@
+import pytest
+
+from engine.block_manager import BlockManager
+
+
+def test_prefix_blocks_are_shared_and_evicted_lru():
+    block_manager = BlockManager(block_size=4, num_gpu_blocks=6, device="cpu", enable_prefix_caching=True)
+    prompt = list(range(10))  # 2 full blocks + 2 tokens
+
+    num_cached, _ = block_manager.allocate(0, prompt)
+    assert num_cached == 0
+    block_manager.mark_blocks_computed(0, prompt, len(prompt))
+
+    num_cached, copies = block_manager.allocate(1, prompt[:8] + [99, 98, 97])
+    assert num_cached == 8 and not copies
+    shared = block_manager.get_block_table(0).physical_block_indices[:2]
+    assert block_manager.get_block_table(1).physical_block_indices[:2] == shared
+    assert block_manager.allocator.blocks[shared[0]].ref_count == 2
+
+    # Freed cached blocks stay reusable until the pool needs them back
+    block_manager.free(0)
+    block_manager.free(1)
+    assert block_manager.get_num_free_blocks() == 6
+    assert len(block_manager.allocator.evictor) == 2
+
+    num_cached, _ = block_manager.allocate(2, prompt)
+    assert num_cached == 8
+    assert block_manager.get_prefix_cache_hit_rate() == 4 / 6
+
+    block_manager.free(2)
+    block_manager.allocate(3, list(range(100, 124)))  # needs all 6 blocks
+    assert not block_manager.allocator.cached_blocks
+
+
+def test_fully_cached_prompt_copies_last_block_on_write():
+    block_manager = BlockManager(block_size=4, num_gpu_blocks=6, device="cpu", enable_prefix_caching=True)
+    prompt = list(range(8))
+    block_manager.allocate(0, prompt)
+    block_manager.mark_blocks_computed(0, prompt, len(prompt))
+
+    num_cached, copies = block_manager.allocate(1, prompt)
+
+    # The last token is recomputed, so its (shared) block is copied first
+    assert num_cached == 7
+    src_table = block_manager.get_block_table(0).physical_block_indices
+    dst_table = block_manager.get_block_table(1).physical_block_indices
+    assert copies == [(src_table[1], dst_table[1])]
+    assert dst_table[0] == src_table[0] and dst_table[1] != src_table[1]
+    assert block_manager.allocator.blocks[src_table[1]].ref_count == 1
+
+
+def test_bulk_allocation_and_padded_block_tables():
+    block_manager = BlockManager(block_size=4, num_gpu_blocks=8, device="cpu")
+    allocator = block_manager.allocator
+    blocks = allocator.allocate_n(3)
+    assert blocks.tolist() == [7, 6, 5]
+    assert allocator.get_num_free_blocks() == 5
+    allocator.free_n(blocks)
+    assert allocator.get_num_free_blocks() == 8
+    with pytest.raises(ValueError):
+        allocator.free_n(blocks)
+
+    # Tables of any length come out as one zero-padded array; freed rows are reused
+    block_manager.allocate(0, list(range(9)))
+    block_manager.allocate(1, list(range(3)))
+    tables = block_manager.get_block_tables([1, 0])
+    assert tables.shape == (2, 3)
+    assert tables[0].tolist() == block_manager.get_block_table(1).physical_block_indices + [0, 0]
+    assert tables[1].tolist() == block_manager.get_block_table(0).physical_block_indices
+
+    block_manager.free(0)
+    block_manager.allocate(2, list(range(2)))
+    assert block_manager.get_block_tables([2]).shape == (1, 1)
+    assert block_manager.get_num_free_blocks() == 6
@@ -0,0 +1,79 @@
+import asyncio
+
+from engine.async_llm_engine import EngineDeadError
+from engine.data_parallel import DataParallelEngine, _split_cores
+from engine.llm_engine import LLMEngine
+from engine.sampling_params import SamplingParams
+from test_llm_engine import greedy_reference
+
+
+async def collect(stream):
+    token_ids = []
+    while True:
+        chunk = await stream.get()
+        token_ids += chunk["token_ids"]
+        if chunk["finished"]:
+            return token_ids, chunk["finish_reason"]
+
+
+def test_requests_are_spread_over_replicas(tiny_model_path):
+    prompts = ["The quick brown fox", "Hello", "Paged attention is", "Hi"]
+    params = SamplingParams(max_tokens=200, ignore_eos=True)
+
+    async def run():
+        engine = DataParallelEngine(2, {"model_name": tiny_model_path, "max_num_seqs": 4})
+        engine.start()
+        try:
+            streams = await asyncio.gather(*[engine.add_request(p, params) for p in prompts])
+            loads = engine.get_replica_loads()
+            results = await asyncio.gather(*[collect(s) for s in streams])
+            return loads, results, engine.get_replica_loads(), engine.render_metrics()
+        finally:
+            engine.shutdown()
+
+    loads, results, final_loads, metrics = asyncio.run(run())
+
+    assert loads == [2, 2]
+    assert final_loads == [0, 0]
+    # Idle replicas send their final metrics
+    assert 'minivllm_decode_tokens_total{replica="0"} 400' in metrics
+    assert 'minivllm_decode_tokens_total{replica="1"} 400' in metrics
+    reference = LLMEngine(tiny_model_path)
+    for prompt, (token_ids, finish_reason) in zip(prompts, results):
+        assert finish_reason == "length"
+        assert token_ids == greedy_reference(reference, reference.tokenizer.encode(prompt), 200)
+
+
+def test_dead_replica_fails_its_requests_and_gets_no_more(tiny_model_path):
+    params = SamplingParams(max_tokens=480, ignore_eos=True)
+
+    async def run():
+        engine = DataParallelEngine(2, {"model_name": tiny_model_path, "max_num_seqs": 4})
+        engine.start()
+        try:
+            streams = await asyncio.gather(*[engine.add_request(p, params) for p in ["Hello", "Hi"]])
+            replicas = [engine._replica_of[s.request_id] for s in streams]
+            engine._workers[0].kill()
+            results = await asyncio.gather(*[collect(s) for s in streams], return_exceptions=True)
+            # Routed to the live replica, so it completes
+            late = await collect(await engine.add_request("Hey", SamplingParams(max_tokens=4)))
+            return replicas, results, late, engine.get_replica_loads(), engine.error
+        finally:
+            engine.shutdown()
+
+    replicas, results, late, loads, error = asyncio.run(run())
+
+    assert sorted(replicas) == [0, 1]
+    for replica, result in zip(replicas, results):
+        if replica == 0:
+            assert isinstance(result, EngineDeadError)
+        else:
+            assert result[1] == "length"
+    assert late[1] == "length"
+    assert loads == [0, 0]
+    # One replica is still serving
+    assert error is None
+
+
+def test_split_cores():
+    assert _split_cores(list(range(8)), 3) == [[0, 1, 2], [3, 4, 5], [6, 7]]
@@ -0,0 +1,63 @@
+from transformers import AutoTokenizer
+
+from engine.detokenizer import Detokenizer
+from engine.sampling_params import SamplingParams
+from engine.scheduler import Sequence
+from engine.stop_checker import StopChecker
+
+
+def stream(tokenizer, prompt, text, sampling_params=None):
+    """Feeds text token by token, returning the emitted pieces and the finish reason."""
+    sampling_params = sampling_params or SamplingParams(max_tokens=1000)
+    detokenizer = Detokenizer(tokenizer)
+    stop_checker = StopChecker(tokenizer.eos_token_id, max_model_len=1024)
+    seq = Sequence(0, prompt, tokenizer.encode(prompt))
+    detokenizer.init_sequence(seq)
+
+    pieces = []
+    for token_id in tokenizer.encode(text):
+        seq.append_token_id(token_id)
+        detokenizer.decode_step([seq])
+        seq.finish_reason = stop_checker.check(seq, sampling_params)
+        pieces.append(stop_checker.get_new_text(seq, sampling_params))
+        if seq.finish_reason is not None:
+            break
+    return pieces, seq.finish_reason
+
+
+def test_multibyte_characters_are_emitted_whole(tiny_model_path):
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_path)
+    text = " héllo wörld ✓ 日本"
+
+    pieces, finish_reason = stream(tokenizer, "Say:", text)
+
+    assert finish_reason is None
+    assert "".join(pieces) == text
+    assert not any("�" in p for p in pieces)
+    # Every byte of a multi-byte character but the last produces no text
+    assert pieces.count("") == len(text.encode()) - len(text)
+
+
+def test_stop_string_is_never_streamed(tiny_model_path):
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_path)
+    params = SamplingParams(max_tokens=1000, stop=["END", "###"])
+
+    pieces, finish_reason = stream(tokenizer, "Q:", "answer is 42 ENDING ignored", params)
+
+    assert finish_reason == "stop"
+    assert "".join(pieces) == "answer is 42 "
+    assert not any("E" in p for p in pieces)
+
+    params.include_stop_str_in_output = True
+    pieces, _ = stream(tokenizer, "Q:", "answer is 42 ENDING ignored", params)
+    assert "".join(pieces) == "answer is 42 END"
+
+
+def test_partial_stop_match_is_released(tiny_model_path):
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_path)
+    params = SamplingParams(max_tokens=10, stop=["ENDS"])
+
+    pieces, finish_reason = stream(tokenizer, "Q:", "xENDxyzabcdef", params)
+
+    assert finish_reason == "length"
+    assert "".join(pieces) == "xENDxyzabc"
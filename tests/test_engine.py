@@ -22,15 +22,12 @@ def main():
     # 3. Run Loop
     print("\n--- Starting Inference Engine Loop ---")
     step = 0
-    active = True
     
-    while active:
+    while engine.has_unfinished_requests():
         step += 1
         outputs = engine.step()
-        
         if not outputs:
-            print("No more work to do.")
-            break
+            continue
             
         # Print stream (simplified)
         print(f"\n[Step {step}]")
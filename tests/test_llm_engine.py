@@ -0,0 +1,372 @@
+import time
+
+import pytest
+import torch
+
+from engine.llm_engine import LLMEngine
+from engine.sampling_params import SamplingParams
+
+
+def run_to_completion(engine):
+    outputs = {}
+    while engine.has_unfinished_requests():
+        for out in engine.step():
+            outputs.setdefault(out["req_id"], []).append(out)
+    return outputs
+
+
+def greedy_reference(engine, prompt_token_ids, num_tokens):
+    ids = list(prompt_token_ids)
+    model = engine.model_executor.model
+    for _ in range(num_tokens):
+        with torch.no_grad():
+            logits = model(input_ids=torch.tensor([ids])).logits[0, -1]
+        ids.append(int(torch.argmax(logits)))
+    return ids[len(prompt_token_ids):]
+
+
+def test_incremental_decoding_matches_recompute(tiny_model_path):
+    engine = LLMEngine(tiny_model_path, max_num_seqs=4)
+    prompts = ["The quick brown fox", "Hello", "Paged attention is"]
+    req_ids = [engine.add_request(p) for p in prompts]
+
+    outputs = run_to_completion(engine)
+
+    assert not engine.block_manager.block_tables
+    assert engine.block_manager.get_num_free_blocks() == engine.block_manager.allocator.num_blocks
+    for req_id, prompt in zip(req_ids, prompts):
+        prompt_ids = engine.tokenizer.encode(prompt)
+        assert outputs[req_id][-1]["finished"]
+        expected = greedy_reference(engine, prompt_ids, len(outputs[req_id]))
+        assert expected == [o["token_id"] for o in outputs[req_id]]
+
+
+@pytest.mark.parametrize("preemption_mode", ["recompute", "swap"])
+def test_preemption_under_memory_pressure(tiny_model_path, preemption_mode):
+    # 3 sequences growing by 40 tokens need over 30 blocks of 4; only 20 exist
+    engine = LLMEngine(
+        tiny_model_path, block_size=4, max_num_seqs=4,
+        num_gpu_blocks=20, num_cpu_blocks=40, preemption_mode=preemption_mode,
+    )
+    prompts = ["The quick brown fox", "Hello", "Paged attention is"]
+    params = SamplingParams(max_tokens=40, ignore_eos=True)
+    req_ids = [engine.add_request(p, params) for p in prompts]
+
+    outputs = run_to_completion(engine)
+
+    assert engine.scheduler.num_preemptions > 0
+    assert engine.block_manager.get_num_free_blocks() == 20
+    for req_id, prompt in zip(req_ids, prompts):
+        prompt_ids = engine.tokenizer.encode(prompt)
+        assert len(outputs[req_id]) == 40
+        expected = greedy_reference(engine, prompt_ids, len(outputs[req_id]))
+        assert expected == [o["token_id"] for o in outputs[req_id]]
+
+
+def test_swap_to_memory_mapped_disk_tier(tiny_model_path, tmp_path):
+    # No host swap: every preempted sequence goes to the swap file
+    block_nbytes = 2 * 2 * 4 * 32 * 4  # keys + values x layers x block_size x n_embd x fp32
+    engine = LLMEngine(
+        tiny_model_path, block_size=4, max_num_seqs=4, num_gpu_blocks=20, num_cpu_blocks=0,
+        preemption_mode="swap", disk_swap_space_gb=40 * block_nbytes / 2**30, swap_dir=str(tmp_path),
+    )
+    assert engine.num_disk_blocks == 40 and len(list(tmp_path.iterdir())) == 1
+    prompts = ["The quick brown fox", "Hello", "Paged attention is"]
+    params = SamplingParams(max_tokens=40, ignore_eos=True)
+    req_ids = [engine.add_request(p, params) for p in prompts]
+
+    outputs = run_to_completion(engine)
+
+    metrics = engine.metrics
+    assert engine.scheduler.num_preemptions > 0
+    assert metrics.swap_out_bytes > 0 and metrics.swap_in_bytes == metrics.swap_out_bytes
+    assert metrics.swap_bandwidth > 0
+    assert metrics.num_swapped_seqs == {"host": 0, "disk": 0}
+    for req_id, prompt in zip(req_ids, prompts):
+        expected = greedy_reference(engine, engine.tokenizer.encode(prompt), 40)
+        assert expected == [o["token_id"] for o in outputs[req_id]]
+
+
+def test_prompt_larger_than_cache_is_rejected(tiny_model_path):
+    engine = LLMEngine(tiny_model_path, block_size=4, num_gpu_blocks=4)
+    with pytest.raises(ValueError):
+        engine.add_request("x" * 64)
+
+
+@pytest.mark.parametrize("preemption_mode", ["recompute", "swap"])
+def test_sequence_that_outgrows_the_pool_is_finished(tiny_model_path, preemption_mode):
+    engine = LLMEngine(tiny_model_path, block_size=4, num_gpu_blocks=6, preemption_mode=preemption_mode,
+                       swap_space_gb=0.01)
+    long_id = engine.add_request(None, SamplingParams(max_tokens=40, ignore_eos=True), prompt_token_ids=[5] * 3)
+    short_id = engine.add_request(None, SamplingParams(max_tokens=12, ignore_eos=True), prompt_token_ids=[7] * 3)
+    outputs = {}
+    for _ in range(100):
+        for out in engine.step():
+            outputs.setdefault(out["req_id"], []).append(out)
+        if not engine.has_unfinished_requests():
+            break
+
+    assert not engine.has_unfinished_requests()
+    last = outputs[long_id][-1]
+    assert last["finished"] and last["finish_reason"] == "length"
+    # Stopped once it could no longer fit in the 24-token pool
+    assert 0 < last["completion_tokens"] < 40
+    assert outputs[short_id][-1]["completion_tokens"] == 12
+    assert engine.block_manager.get_num_free_blocks() == 6
+
+
+def test_more_samples_than_max_num_seqs_are_rejected(tiny_model_path):
+    engine = LLMEngine(tiny_model_path, max_num_seqs=4)
+    with pytest.raises(ValueError):
+        engine.add_request("Hello", SamplingParams(temperature=1.0, n=5))
+    assert not engine.has_unfinished_requests()
+
+
+@pytest.mark.parametrize("preemption_mode", ["recompute", "swap"])
+def test_samples_that_cannot_grow_together_are_rejected(tiny_model_path, preemption_mode):
+    engine = LLMEngine(tiny_model_path, block_size=4, num_gpu_blocks=12, preemption_mode=preemption_mode,
+                       swap_space_gb=0.01)
+    with pytest.raises(ValueError):
+        # 4 samples of 6 + 8 tokens need 16 blocks once they diverge
+        engine.add_request(None, SamplingParams(temperature=1.0, n=4, max_tokens=8), prompt_token_ids=[5] * 6)
+    req_id = engine.add_request(None, SamplingParams(max_tokens=8), prompt_token_ids=[7] * 3)
+    assert run_to_completion(engine)[req_id][-1]["finished"]
+
+
+def test_prefix_cache_reuses_shared_template(tiny_model_path):
+    engine = LLMEngine(tiny_model_path, block_size=4, max_num_seqs=4)
+    template = "You are a helpful assistant. Answer briefly. "
+    prompts = [template + "Hi", template + "Bye", template]
+
+    req_ids = [engine.add_request(prompts[0])]
+    outputs = run_to_completion(engine)
+    req_ids += [engine.add_request(p) for p in prompts[1:]]
+    outputs.update(run_to_completion(engine))
+
+    assert engine.get_prefix_cache_hit_rate() > 0.5
+    for req_id, prompt in zip(req_ids, prompts):
+        prompt_ids = engine.tokenizer.encode(prompt)
+        expected = greedy_reference(engine, prompt_ids, len(outputs[req_id]))
+        assert expected == [o["token_id"] for o in outputs[req_id]]
+
+
+def test_chunked_prefill_runs_alongside_decodes(tiny_model_path):
+    engine = LLMEngine(tiny_model_path, block_size=4, max_num_seqs=4, max_total_tokens=12,
+                       max_prefill_chunk_size=8, enable_prefix_caching=False)
+    short_id = engine.add_request("Hi")
+    engine.step()
+    long_prompt = "A much longer prompt that needs several chunks to prefill."
+    long_id = engine.add_request(long_prompt)
+
+    outputs = {}
+    while engine.has_unfinished_requests():
+        step_outputs = engine.step()
+        # The running stream keeps producing a token every step
+        if not outputs.get(short_id, [{}])[-1].get("finished"):
+            assert any(o["req_id"] == short_id for o in step_outputs)
+        for out in step_outputs:
+            outputs.setdefault(out["req_id"], []).append(out)
+
+    prompt_ids = engine.tokenizer.encode(long_prompt)
+    expected = greedy_reference(engine, prompt_ids, len(outputs[long_id]))
+    assert expected == [o["token_id"] for o in outputs[long_id]]
+
+
+def test_seeded_sampling_is_reproducible(tiny_model_path):
+    engine = LLMEngine(tiny_model_path, max_num_seqs=4)
+    params = SamplingParams(temperature=0.9, top_p=0.95, seed=1234)
+
+    first = engine.add_request("Once upon a time", params)
+    engine.add_request("Unrelated neighbour", SamplingParams(temperature=1.2))
+    outputs = run_to_completion(engine)
+    second = engine.add_request("Once upon a time", params)
+    outputs.update(run_to_completion(engine))
+
+    assert [o["token_id"] for o in outputs[first]] == [o["token_id"] for o in outputs[second]]
+
+
+def test_requests_stop_on_their_own_conditions(tiny_model_path):
+    engine = LLMEngine(tiny_model_path, max_num_seqs=4)
+    probe = engine.add_request("Hello", SamplingParams(max_tokens=1))
+    first_token = run_to_completion(engine)[probe][0]["token_id"]
+
+    short_id = engine.add_request("Hello", SamplingParams(max_tokens=3))
+    stop_id = engine.add_request("Hello", SamplingParams(max_tokens=20, stop_token_ids=[first_token]))
+    long_id = engine.add_request("Hello", SamplingParams(max_tokens=8))
+
+    finished_at = {}
+    step = 0
+    while engine.has_unfinished_requests():
+        step += 1
+        for out in engine.step():
+            if out["finished"]:
+                finished_at[out["req_id"]] = (step, out["finish_reason"])
+        # A finished request gives its blocks back immediately
+        running = {g.request_id for g in engine.scheduler.running}
+        assert not running & set(finished_at)
+
+    assert finished_at[stop_id] == (1, "stop")
+    assert finished_at[short_id] == (3, "length")
+    assert finished_at[long_id] == (8, "length")
+    assert engine.block_manager.get_num_free_blocks() == engine.block_manager.allocator.num_blocks
+
+
+def test_abort_frees_blocks_of_running_and_waiting_requests(tiny_model_path):
+    engine = LLMEngine(tiny_model_path, max_num_seqs=2)
+    params = SamplingParams(temperature=1.0, seed=0, max_tokens=50, ignore_eos=True, n=2)
+    running_id = engine.add_request("Hello there", params)
+    waiting_id = engine.add_request("Hello", SamplingParams(max_tokens=50))
+    engine.step()
+    engine.step()
+
+    outputs = engine.abort_request(running_id)
+    assert [(o["index"], o["finish_reason"], o["finished"]) for o in outputs] == [
+        (0, "abort", False), (1, "abort", True)]
+    assert outputs[-1]["completion_tokens"] == 4
+    assert [o["finish_reason"] for o in engine.abort_request(waiting_id, "timeout")] == ["timeout"]
+    assert engine.abort_request(waiting_id) == []
+
+    assert not engine.has_unfinished_requests()
+    assert engine.block_manager.get_num_free_blocks() == engine.block_manager.allocator.num_blocks
+    assert engine.metrics.num_finished_requests == {"abort": 1, "timeout": 1}
+    assert engine.metrics.num_running == 0
+
+
+def choices_by_index(outputs):
+    choices = {}
+    for out in outputs:
+        choices.setdefault(out["index"], []).append(out["token_id"])
+    return choices
+
+
+def test_parallel_samples_share_prompt_blocks(tiny_model_path):
+    engine = LLMEngine(tiny_model_path, block_size=4, max_num_seqs=4)
+    params = SamplingParams(temperature=1.0, seed=0, n=3, max_tokens=6, ignore_eos=True)
+    req_id = engine.add_request("The quick brown fox", params)
+
+    outputs = engine.step()
+    group = engine.scheduler.running[0]
+    tables = [engine.block_manager.get_block_table(seq.seq_id).physical_block_indices for seq in group.seqs]
+    assert len(tables) == 3 and tables[0] == tables[1] == tables[2]
+    assert all(engine.block_manager.allocator.blocks[b].ref_count == 3 for b in tables[0])
+
+    for out in run_to_completion(engine)[req_id]:
+        outputs.append(out)
+    choices = choices_by_index(outputs)
+    assert sorted(choices) == [0, 1, 2]
+    assert all(len(tokens) == 6 for tokens in choices.values())
+    assert len({tuple(tokens) for tokens in choices.values()}) > 1
+    assert outputs[-1]["finished"] and outputs[-1]["completion_tokens"] == 18
+    assert [o["finished"] for o in outputs].count(True) == 1
+    assert engine.block_manager.get_num_free_blocks() == engine.block_manager.allocator.num_blocks
+
+
+def test_best_of_returns_the_most_likely_samples(tiny_model_path):
+    engine = LLMEngine(tiny_model_path, max_num_seqs=4)
+    params = SamplingParams(temperature=1.0, seed=3, n=2, best_of=4, max_tokens=5, ignore_eos=True)
+    req_id = engine.add_request("Hello", params)
+    engine.step()
+    group = engine.scheduler.running[0]
+
+    outputs = run_to_completion(engine)[req_id]
+
+    # Nothing is returned before all samples are done
+    assert len(outputs) == 10 and all(o["logprobs"] is None for o in outputs)
+    ranked = sorted(group.seqs, key=lambda s: s.cumulative_logprob, reverse=True)
+    assert choices_by_index(outputs) == {0: ranked[0].output_token_ids.tolist(), 1: ranked[1].output_token_ids.tolist()}
+    assert engine.block_manager.get_num_free_blocks() == engine.block_manager.allocator.num_blocks
+
+
+def beam_search_reference(engine, prompt_ids, width, num_tokens):
+    model = engine.model_executor.model
+    beams = [([], 0.0)]
+    for _ in range(num_tokens):
+        candidates = []
+        for tokens, score in beams:
+            with torch.no_grad():
+                logits = model(input_ids=torch.tensor([prompt_ids + tokens])).logits[0, -1]
+            values, ids = torch.log_softmax(logits.float(), dim=-1).topk(2 * width)
+            candidates += [(tokens + [t], score + v) for v, t in zip(values.tolist(), ids.tolist())]
+        beams = sorted(candidates, key=lambda c: c[1], reverse=True)[:width]
+    return [tokens for tokens, _ in beams]
+
+
+@pytest.mark.parametrize("preemption_mode", ["recompute", "swap"])
+def test_beam_search_matches_reference(tiny_model_path, preemption_mode):
+    # 12 blocks: the 3 beams fit on their own even once they stop sharing the prompt
+    engine = LLMEngine(tiny_model_path, block_size=4, max_num_seqs=4, num_gpu_blocks=12,
+                       num_cpu_blocks=40, preemption_mode=preemption_mode)
+    params = SamplingParams(n=2, best_of=3, use_beam_search=True, max_tokens=6, ignore_eos=True)
+    req_id = engine.add_request("Beam me up", params)
+    # Competes for the small pool so the beams get preempted
+    engine.add_request("Scotty, now. " * 2, SamplingParams(max_tokens=12, ignore_eos=True))
+
+    outputs = run_to_completion(engine)[req_id]
+
+    assert engine.scheduler.num_preemptions > 0
+    expected = beam_search_reference(engine, engine.tokenizer.encode("Beam me up"), 3, 6)
+    assert choices_by_index(outputs) == {0: expected[0], 1: expected[1]}
+    assert engine.block_manager.get_num_free_blocks() == 12
+
+
+def test_metrics_track_tokens_and_latencies(tiny_model_path):
+    from engine.metrics import STEP_PHASES, render_metrics
+
+    engine = LLMEngine(tiny_model_path, max_num_seqs=4, enable_prefix_caching=False)
+    prompts = ["The quick brown fox", "Hello"]
+    for prompt in prompts:
+        engine.add_request(prompt, SamplingParams(max_tokens=5, ignore_eos=True))
+    outputs = run_to_completion(engine)
+
+    metrics = engine.metrics
+    assert metrics.num_prefill_tokens == sum(len(engine.tokenizer.encode(p)) for p in prompts)
+    assert metrics.num_decode_tokens == sum(len(o) for o in outputs.values()) == 10
+    assert metrics.time_to_first_token.count == metrics.e2e_request_latency.count == 2
+    assert metrics.inter_token_latency.count == 8
+    assert metrics.num_finished_requests == {"length": 2}
+    assert all(metrics.step_phase_time[phase].count == 5 for phase in STEP_PHASES)
+    assert metrics.kv_cache_usage == 0.0 and metrics.num_running == 0
+
+    # Snapshots for other threads share no mutable state with the engine's metrics
+    snapshot = engine.get_metrics_snapshot()
+    assert snapshot.num_finished_requests == metrics.num_finished_requests
+    assert snapshot.num_finished_requests is not metrics.num_finished_requests
+    assert snapshot.e2e_request_latency.counts is not metrics.e2e_request_latency.counts
+
+    text = render_metrics([({"replica": "0"}, metrics)])
+    assert 'minivllm_decode_tokens_total{replica="0"} 10' in text
+    assert 'minivllm_time_to_first_token_seconds_count{replica="0"} 2' in text
+    assert 'minivllm_step_phase_seconds_bucket{replica="0",phase="forward",le="+Inf"} 5' in text
+
+
+def test_throughput_falls_to_zero_when_idle():
+    from engine.metrics import THROUGHPUT_WINDOW, EngineMetrics, StepTimer
+
+    metrics = EngineMetrics()
+    timer = StepTimer()
+    timer.num_prefill_tokens, timer.num_decode_tokens = 30, 10
+    metrics.record_step(timer)
+    now = time.monotonic()
+
+    prefill, decode = metrics.get_throughput(now)
+    assert prefill > 0 and decode > 0
+    assert metrics.get_throughput(now + THROUGHPUT_WINDOW + 1) == (0.0, 0.0)
+
+
+def test_kv_cache_is_sized_from_memory(tiny_model_path):
+    from model.memory_profiler import GiB
+
+    block_nbytes = 2 * 2 * 16 * 32 * 4  # keys + values x layers x block_size x n_embd x fp32
+    engine = LLMEngine(tiny_model_path, max_num_seqs=4, kv_cache_memory_gb=40 * block_nbytes / GiB,
+                       swap_space_gb=8 * block_nbytes / GiB)
+    assert (engine.num_gpu_blocks, engine.num_cpu_blocks) == (40, 8)
+    assert engine.max_concurrency == 40 * 16 / 512
+    assert engine.block_manager.allocator.num_blocks == 40
+
+    # Profiled: the host has room for every block 4 full-length requests can use
+    engine = LLMEngine(tiny_model_path, max_num_seqs=4)
+    assert engine.num_gpu_blocks == 4 * 512 // 16 and engine.num_cpu_blocks == 0
+    assert engine.model_executor.kv_cache.num_blocks == engine.num_gpu_blocks
+
+    with pytest.raises(ValueError, match="No memory left"):
+        LLMEngine(tiny_model_path, kv_cache_memory_gb=block_nbytes / 2 / GiB)
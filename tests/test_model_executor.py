@@ -0,0 +1,134 @@
+import pytest
+import torch
+
+from engine.block_manager import BlockManager
+from model.model_executor import ModelExecutor
+
+
+def hf_last_logits(executor, ids):
+    with torch.no_grad():
+        return executor.model(input_ids=torch.tensor([ids])).logits[0, -1]
+
+
+def test_packed_forward_matches_unbatched_model(tiny_model_path):
+    executor = ModelExecutor(tiny_model_path, device="cpu")
+    prompts = [[5, 6, 7, 8, 9], [10, 11], [12]]
+
+    logits = executor.forward(prompts)
+
+    for i, ids in enumerate(prompts):
+        torch.testing.assert_close(logits[i], hf_last_logits(executor, ids), rtol=1e-4, atol=1e-4)
+
+
+def test_paged_decode_matches_full_context_forward(tiny_model_path):
+    executor = ModelExecutor(tiny_model_path, device="cpu")
+    executor.init_kv_cache(num_blocks=16, block_size=4)
+    block_manager = BlockManager(block_size=4, num_gpu_blocks=16, device="cpu")
+    prompts = [[5, 6, 7, 8, 9], [10, 11]]
+
+    for seq_id, prompt in enumerate(prompts):
+        block_manager.allocate(seq_id, prompt)
+    tables = [block_manager.get_block_table(i).physical_block_indices for i in range(2)]
+    logits = executor.execute_model(prompts, [0, 0], tables)
+
+    contexts = [list(p) for p in prompts]
+    for _ in range(6):
+        # Recomputing each context from scratch must give the same answer
+        for i, ctx in enumerate(contexts):
+            torch.testing.assert_close(logits[i], hf_last_logits(executor, ctx), rtol=1e-4, atol=1e-4)
+
+        next_tokens = torch.argmax(logits, dim=-1).tolist()
+        for seq_id, (ctx, tok) in enumerate(zip(contexts, next_tokens)):
+            ctx.append(tok)
+            block_manager.append_slot(seq_id, len(ctx), len(ctx) - 1)
+        tables = [block_manager.get_block_table(i).physical_block_indices for i in range(2)]
+        logits = executor.execute_model(
+            [[tok] for tok in next_tokens], [len(ctx) - 1 for ctx in contexts], tables
+        )
+
+    # 11 and 8 tokens with block_size=4 -> 3 + 2 blocks
+    assert block_manager.get_num_free_blocks() == 16 - 5
+
+
+def test_mixed_prefill_chunks_and_decodes_in_one_batch(tiny_model_path):
+    executor = ModelExecutor(tiny_model_path, device="cpu")
+    executor.init_kv_cache(num_blocks=16, block_size=4)
+    block_manager = BlockManager(block_size=4, num_gpu_blocks=16, device="cpu")
+    decode_ctx = [3, 4, 5, 6, 7, 8]
+    long_prompt = list(range(20, 33))
+
+    block_manager.allocate(0, decode_ctx)
+    block_manager.allocate(1, long_prompt)
+    table = lambda i: block_manager.get_block_table(i).physical_block_indices
+    executor.execute_model([decode_ctx[:-1]], [0], [table(0)])
+
+    # One decode token, the first chunk of a long prompt, then its second chunk
+    logits = executor.execute_model([decode_ctx[-1:], long_prompt[:7]], [5, 0], [table(0), table(1)])
+    torch.testing.assert_close(logits[0], hf_last_logits(executor, decode_ctx), rtol=1e-4, atol=1e-4)
+    logits = executor.execute_model([long_prompt[7:]], [7], [table(1)])
+    torch.testing.assert_close(logits[0], hf_last_logits(executor, long_prompt), rtol=1e-4, atol=1e-4)
+
+
+def test_compiled_decode_reuses_bucketed_graphs(tiny_model_path):
+    compiled_graphs = []
+
+    def counting_backend(graph_module, example_inputs):
+        compiled_graphs.append(graph_module)
+        return graph_module.forward
+
+    executors = [ModelExecutor(tiny_model_path, device="cpu") for _ in range(2)]
+    for executor in executors:
+        executor.init_kv_cache(num_blocks=16, block_size=4)
+    eager, compiled = executors
+    dynamo_config = dict(torch._dynamo.config.get_config_copy())
+    compiled.enable_compile(batch_buckets=[1, 2], block_buckets=[2, 8], backend=counting_backend)
+    compiled.warmup()
+    assert len(compiled_graphs) == 4
+    # The recompile limit is raised only while the compiled decode runs
+    assert dict(torch._dynamo.config.get_config_copy()) == dynamo_config
+
+    block_manager = BlockManager(block_size=4, num_gpu_blocks=16, device="cpu")
+    contexts = [[5, 6, 7, 8, 9], [10, 11], [12, 13, 14]]
+    for seq_id, prompt in enumerate(contexts):
+        block_manager.allocate(seq_id, prompt)
+    tables = [block_manager.get_block_table(i).physical_block_indices for i in range(3)]
+    for executor in executors:
+        executor.execute_model(contexts, [0, 0, 0], tables)
+
+    # 3 sequences, then 2 and 1 as they drop out; block tables are padded to 8 blocks
+    for num_seqs in [3, 3, 2, 2, 2, 1]:
+        for seq_id in range(num_seqs):
+            contexts[seq_id].append(7)
+            block_manager.append_slot(seq_id, len(contexts[seq_id]), len(contexts[seq_id]) - 1)
+        tables = [block_manager.get_block_table(i).physical_block_indices for i in range(num_seqs)]
+        args = ([[ctx[-1]] for ctx in contexts[:num_seqs]], [len(ctx) - 1 for ctx in contexts[:num_seqs]], tables)
+        torch.testing.assert_close(compiled.execute_model(*args), eager.execute_model(*args), rtol=1e-4, atol=1e-4)
+
+    # Batches of 3 fell back to eager; no step compiled a new graph
+    assert len(compiled_graphs) == 4
+
+
+@pytest.mark.parametrize("kv_cache_dtype", ["int8", "fp8"])
+def test_quantized_kv_cache_tracks_full_precision(tiny_model_path, kv_cache_dtype):
+    executors = [ModelExecutor(tiny_model_path, device="cpu") for _ in range(2)]
+    executors[0].init_kv_cache(num_blocks=16, block_size=4)
+    executors[1].init_kv_cache(num_blocks=16, block_size=4, num_cpu_blocks=4, kv_cache_dtype=kv_cache_dtype)
+    reference, quantized = executors
+    assert quantized.kv_cache.get_block_nbytes() < reference.kv_cache.get_block_nbytes() / 2
+
+    prompt = [5, 6, 7, 8, 9, 10, 11]
+    args = ([prompt], [0], [[0, 1]])
+    torch.testing.assert_close(quantized.execute_model(*args), reference.execute_model(*args), rtol=0, atol=0.05)
+
+    # Blocks and their scales survive a round trip through swap space
+    pool = quantized.kv_cache
+    before = [t[:2].clone() for t in pool.key_caches + pool.key_scales]
+    pool.swap_out([(0, 2), (1, 3)])
+    for t in pool.key_caches + pool.key_scales:
+        t[:2] = 0
+    pool.swap_in([(2, 0), (3, 1)])
+    for t, saved in zip(pool.key_caches + pool.key_scales, before):
+        assert torch.equal(t[:2], saved)
+
+    args = ([[12]], [len(prompt)], [[0, 1]])
+    torch.testing.assert_close(quantized.execute_model(*args), reference.execute_model(*args), rtol=0, atol=0.05)
@@ -0,0 +1,48 @@
+import pytest
+import torch
+
+from engine.llm_engine import LLMEngine
+from engine.sampling_params import SamplingParams
+from model.model_executor import ModelExecutor
+from model.quantization import Int4WeightOnlyLinear, get_weight_nbytes
+
+
+@pytest.mark.parametrize("mode,atol", [("bf16", 0.05), ("int8_dynamic", 0.05), ("int8", 0.05), ("int4", 0.25)])
+def test_quantized_weights_track_fp32(tiny_model_path, mode, atol):
+    reference = ModelExecutor(tiny_model_path, device="cpu")
+    executor = ModelExecutor(tiny_model_path, device="cpu", quantization=mode, group_size=32)
+    prompts = [[5, 6, 7, 8, 9], [10, 11]]
+
+    logits = executor.forward(prompts)
+
+    assert logits.dtype == torch.float32
+    torch.testing.assert_close(logits, reference.forward(prompts), rtol=0, atol=atol)
+    assert get_weight_nbytes(executor.model) < 0.6 * get_weight_nbytes(reference.model)
+
+
+def test_int4_pads_output_channels_to_the_kernel_tile():
+    torch.manual_seed(0)
+    weight, bias = torch.randn(50, 64), torch.randn(50)
+    layer = Int4WeightOnlyLinear(weight, bias, group_size=32)
+    x = torch.randn(2, 3, 64)
+
+    out = layer(x)
+
+    assert out.shape == (2, 3, 50)
+    reference = x @ weight.t() + bias
+    assert (out - reference).norm() / reference.norm() < 0.1
+    with pytest.raises(ValueError, match="group size"):
+        Int4WeightOnlyLinear(weight, bias, group_size=48)
+
+
+def test_engine_generates_with_quantized_weights(tiny_model_path):
+    engine = LLMEngine(tiny_model_path, max_num_seqs=4, num_gpu_blocks=32, quantization="bf16")
+    assert engine.model_executor.kv_cache.key_caches[0].dtype == torch.bfloat16
+
+    engine = LLMEngine(tiny_model_path, max_num_seqs=4, num_gpu_blocks=32, quantization="int4",
+                       quantization_group_size=32)
+    engine.add_request(None, SamplingParams(temperature=0.0, max_tokens=8, ignore_eos=True), prompt_token_ids=[1, 2, 3])
+    outputs = []
+    while engine.has_unfinished_requests():
+        outputs += engine.step()
+    assert len(outputs) == 8 and outputs[-1]["finish_reason"] == "length"
@@ -0,0 +1,62 @@
+import torch
+
+from engine.sampling_params import SamplingParams
+from model.sampler import Sampler
+
+
+def sample(logits, params, prompts=None, outputs=None, generators=None):
+    batch_size = logits.shape[0]
+    return Sampler()(
+        logits, params,
+        prompts or [[0]] * batch_size,
+        outputs or [[]] * batch_size,
+        generators or [None] * batch_size,
+    )
+
+
+def test_mixed_batch_applies_per_row_settings():
+    torch.manual_seed(0)
+    logits = torch.randn(4, 50)
+    params = [
+        SamplingParams(),                                  # greedy
+        SamplingParams(temperature=1.0, top_k=1),          # top-k 1 == greedy
+        SamplingParams(temperature=0.7, top_p=1e-6),       # nucleus of one token == greedy
+        SamplingParams(temperature=1.0, min_p=1.0),        # only the max survives
+    ]
+    tokens, logprobs = sample(logits, params)
+    assert tokens == logits.argmax(dim=-1).tolist()
+    assert logprobs == [None] * 4
+
+
+def test_penalties_match_reference_formula():
+    logits = torch.tensor([[2.0, -1.0, 0.5, 3.0]])
+    params = [SamplingParams(repetition_penalty=2.0, presence_penalty=0.5, frequency_penalty=0.25, logprobs=2)]
+    tokens, logprobs = sample(logits, params, prompts=[[0]], outputs=[[3, 3, 1]])
+
+    expected = torch.tensor([[2.0 / 2, -1.0 * 2 - 0.25 - 0.5, 0.5, 3.0 / 2 - 0.5 - 0.5]])
+    expected_logprobs = torch.log_softmax(expected, dim=-1)[0]
+    assert tokens == [0]
+    chosen, top = logprobs[0]
+    assert abs(chosen - expected_logprobs[0].item()) < 1e-5
+    assert list(top) == [0, 2]
+
+
+def test_seeded_rows_are_reproducible_regardless_of_batch():
+    torch.manual_seed(0)
+    logits = torch.randn(3, 100)
+    params = [SamplingParams(temperature=1.0, seed=7)] * 3
+
+    def run(batch_logits):
+        generators = [torch.Generator().manual_seed(7) for _ in range(len(batch_logits))]
+        return sample(batch_logits, params[:len(batch_logits)], generators=generators)[0]
+
+    assert run(logits)[1] == run(logits[1:2])[0]
+
+
+def test_sampling_follows_the_distribution():
+    torch.manual_seed(0)
+    probs = torch.tensor([0.6, 0.3, 0.1])
+    logits = probs.log().expand(4000, 3)
+    tokens, _ = sample(logits, [SamplingParams(temperature=1.0)] * 4000)
+    freqs = torch.bincount(torch.tensor(tokens), minlength=3) / 4000
+    torch.testing.assert_close(freqs, probs, atol=0.03, rtol=0)
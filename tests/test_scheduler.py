@@ -0,0 +1,252 @@
+import numpy as np
+
+from engine.block_manager import BlockManager, BlockTier
+from engine.policy import FairPolicy, PriorityPolicy, SJFPolicy
+from engine.sampling_params import SamplingParams
+from engine.scheduler import PreemptionMode, RequestStatus, Scheduler, Sequence
+
+
+def make_scheduler(num_gpu_blocks, num_cpu_blocks=0, preemption_mode=PreemptionMode.RECOMPUTE,
+                   max_num_seqs=8, policy=None, num_disk_blocks=0):
+    block_manager = BlockManager(block_size=4, num_gpu_blocks=num_gpu_blocks,
+                                 num_cpu_blocks=num_cpu_blocks, device="cpu", num_disk_blocks=num_disk_blocks)
+    return Scheduler(max_num_seqs=max_num_seqs, max_total_tokens=1024, block_manager=block_manager,
+                     preemption_mode=preemption_mode, policy=policy)
+
+
+def decode_one_token(scheduler):
+    for group in scheduler.running:
+        for seq in group.get_seqs():
+            seq.num_computed_tokens = seq.get_len()
+            seq.append_token_id(0)
+
+
+def test_sequence_outputs_are_a_view_of_its_token_buffer():
+    seq = Sequence(0, "", [1, 2, 3])
+    for token_id in range(100):
+        seq.append_token_id(token_id)
+    assert seq.output_token_ids.tolist() == list(range(100))
+    assert seq.get_token_ids().tolist() == [1, 2, 3] + list(range(100))
+    assert np.shares_memory(seq.output_token_ids, seq.get_token_ids())
+
+    child = seq.fork(1)
+    child.append_token_id(7)
+    assert seq.get_output_len() == 100
+    assert child.get_output_len() == 101 and child.output_token_ids[-1] == 7
+
+
+def test_admission_waits_for_free_blocks():
+    scheduler = make_scheduler(num_gpu_blocks=4)
+    for i in range(3):
+        scheduler.add_request(str(i), "", [1] * 7)  # 2 blocks each
+
+    outputs = scheduler.schedule()
+
+    assert [g.request_id for g in outputs.scheduled_groups] == ["0", "1"]
+    assert [g.request_id for g in scheduler.waiting] == ["2"]
+    assert scheduler.block_manager.get_num_free_blocks() == 0
+
+
+def test_finished_and_aborted_requests_leave_the_queues_in_one_pass():
+    scheduler = make_scheduler(num_gpu_blocks=4)
+    for i in range(3):
+        scheduler.add_request(str(i), "", [1] * 7)
+    scheduler.schedule()
+
+    scheduler.free_finished_request("0")
+    aborted = scheduler.abort_request("2")
+    assert aborted.request_id == "2" and scheduler.abort_request("2") is None
+    # Blocks are freed at once; the queues are only pruned on the next pass
+    assert scheduler.block_manager.get_num_free_blocks() == 2
+    assert list(scheduler.requests) == ["1"]
+
+    scheduler.remove_finished_groups()
+    assert [g.request_id for g in scheduler.running] == ["1"]
+    assert not scheduler.waiting
+
+
+def test_recompute_preempts_newest_and_requeues_it_first():
+    scheduler = make_scheduler(num_gpu_blocks=4)
+    scheduler.add_request("0", "", [1] * 7)
+    scheduler.add_request("1", "", [1] * 7)
+    scheduler.schedule()
+    scheduler.add_request("2", "", [1] * 3)
+
+    decode_one_token(scheduler)
+    decode_one_token(scheduler)  # 9 tokens: both sequences need a third block
+    outputs = scheduler.schedule()
+
+    assert outputs.num_preempted == 1
+    assert [g.request_id for g in outputs.scheduled_groups] == ["0"]
+    assert [g.request_id for g in scheduler.waiting] == ["1", "2"]
+    preempted = scheduler.waiting[0].get_seqs()[0]
+    assert preempted.status == RequestStatus.WAITING
+    assert preempted.num_computed_tokens == 0
+
+
+def test_swap_preemption_resumes_from_swap_space():
+    scheduler = make_scheduler(num_gpu_blocks=4, num_cpu_blocks=4, preemption_mode=PreemptionMode.SWAP)
+    scheduler.add_request("0", "", [1] * 7)
+    scheduler.add_request("1", "", [1] * 7)
+    scheduler.schedule()
+    decode_one_token(scheduler)
+    decode_one_token(scheduler)
+
+    outputs = scheduler.schedule()
+    assert len(outputs.blocks_to_swap_out) == 2
+    assert [g.request_id for g in scheduler.swapped] == ["1"]
+
+    scheduler.free_finished_request("0")
+    outputs = scheduler.schedule()
+    assert len(outputs.blocks_to_swap_in) == 2
+    assert [g.request_id for g in outputs.scheduled_groups] == ["1"]
+    assert scheduler.block_manager.cpu_allocator.get_num_free_blocks() == 4
+
+
+def test_forked_group_swaps_in_only_with_room_for_its_copies():
+    scheduler = make_scheduler(num_gpu_blocks=4, num_cpu_blocks=4, preemption_mode=PreemptionMode.SWAP)
+    group = scheduler.add_request("0", "", [1] * 6, SamplingParams(temperature=1.0, n=2))
+    scheduler.schedule()
+    parent = group.seqs[0]
+    parent.num_computed_tokens = parent.get_len()
+    scheduler.fork_seq(group, parent)
+    for seq in group.seqs:
+        seq.append_token_id(0)
+    # Both samples still share their partially written last block
+    scheduler._preempt(scheduler.running.pop(), [])
+    assert list(scheduler.swapped) == [group]
+
+    # Room for the group's 2 blocks, but not for the copy its next write needs
+    held = scheduler.block_manager.allocator.allocate_n(2)
+    outputs = scheduler.schedule()
+    assert not outputs.blocks_to_swap_in and list(scheduler.swapped) == [group]
+
+    scheduler.block_manager.allocator.free_n(held)
+    outputs = scheduler.schedule()
+    assert len(outputs.blocks_to_swap_in) == 2 and len(outputs.blocks_to_copy) == 1
+
+
+def test_abort_frees_swapped_request():
+    scheduler = make_scheduler(num_gpu_blocks=4, num_cpu_blocks=4, preemption_mode=PreemptionMode.SWAP)
+    scheduler.add_request("0", "", [1] * 7)
+    scheduler.add_request("1", "", [1] * 7)
+    scheduler.schedule()
+    decode_one_token(scheduler)
+    decode_one_token(scheduler)
+    scheduler.schedule()
+    assert [g.request_id for g in scheduler.swapped] == ["1"]
+
+    group = scheduler.abort_request("1")
+    assert group.request_id == "1" and group.is_finished()
+    assert not scheduler.swapped
+    assert scheduler.block_manager.cpu_allocator.get_num_free_blocks() == 4
+    assert scheduler.abort_request("1") is None
+
+
+def test_swap_overflows_from_host_to_disk_tier():
+    scheduler = make_scheduler(num_gpu_blocks=8, num_cpu_blocks=2, num_disk_blocks=4,
+                               preemption_mode=PreemptionMode.SWAP)
+    for i in range(4):
+        scheduler.add_request(str(i), "", [1] * 7)
+    scheduler.schedule()
+    decode_one_token(scheduler)
+    decode_one_token(scheduler)
+
+    # Two groups are preempted: the first fills host swap, the second spills to disk
+    outputs = scheduler.schedule()
+    block_manager = scheduler.block_manager
+    tiers = {g.request_id: block_manager.get_block_table(g.get_seqs()[0].seq_id).tier for g in scheduler.swapped}
+    assert tiers == {"3": BlockTier.HOST, "2": BlockTier.DISK}
+    # Disk blocks are addressed after the host swap slots
+    assert sorted(slot for _, slot in outputs.blocks_to_swap_out) == [0, 1, 4, 5]
+    assert block_manager.get_num_seqs(BlockTier.DISK) == 1
+
+    scheduler.free_finished_request("0")
+    outputs = scheduler.schedule()
+    assert [g.request_id for g in outputs.scheduled_groups] == ["1", "2"]
+    assert sorted(slot for slot, _ in outputs.blocks_to_swap_in) == [4, 5]
+    assert block_manager.disk_allocator.get_num_free_blocks() == 4
+
+
+def test_long_prompt_is_prefilled_in_chunks_within_budget():
+    block_manager = BlockManager(block_size=4, num_gpu_blocks=32, device="cpu")
+    scheduler = Scheduler(max_num_seqs=8, max_total_tokens=10, block_manager=block_manager,
+                          max_prefill_chunk_size=6)
+    scheduler.add_request("short", "", [1] * 3)
+    scheduler.schedule()
+    decode_one_token(scheduler)
+    scheduler.add_request("long", "", [2] * 20)
+
+    chunks = []
+    for _ in range(4):
+        outputs = scheduler.schedule()
+        sizes = dict(zip([g.request_id for g in outputs.scheduled_groups], outputs.token_chunk_sizes))
+        assert sum(sizes.values()) <= 10
+        assert sizes["short"] == 1
+        chunks.append(sizes["long"])
+        for group in outputs.scheduled_groups:
+            seq = group.get_seqs()[0]
+            seq.num_computed_tokens += sizes[group.request_id]
+            if seq.num_computed_tokens == seq.get_len():
+                seq.append_token_id(0)
+
+    assert chunks == [6, 6, 6, 2]
+
+
+def test_priority_class_preempts_lower_class():
+    scheduler = make_scheduler(num_gpu_blocks=16, max_num_seqs=2, policy=PriorityPolicy())
+    scheduler.add_request("bulk-0", "", [1] * 7, priority=1)
+    scheduler.add_request("bulk-1", "", [1] * 7, priority=1)
+    scheduler.schedule()
+    decode_one_token(scheduler)
+    scheduler.add_request("interactive", "", [1] * 3, priority=0)
+
+    outputs = scheduler.schedule()
+
+    assert outputs.num_preempted == 1
+    assert sorted(g.request_id for g in outputs.scheduled_groups) == ["bulk-0", "interactive"]
+    assert [g.request_id for g in scheduler.waiting] == ["bulk-1"]
+
+
+def test_priority_ages_waiting_requests():
+    policy = PriorityPolicy(aging_interval=10.0)
+    scheduler = make_scheduler(num_gpu_blocks=16, policy=policy)
+    old = scheduler.add_request("old", "", [1] * 3, priority=2)
+    new = scheduler.add_request("new", "", [1] * 3, priority=0)
+    now = new.arrival_time
+    old.arrival_time = now - 25.0
+
+    assert policy.sort_by_priority(now, [new, old]) == [old, new]
+    assert not policy.should_preempt(now, new, old)
+
+
+def test_sjf_runs_shortest_expected_job_first():
+    scheduler = make_scheduler(num_gpu_blocks=16, max_num_seqs=1, policy=SJFPolicy())
+    scheduler.add_request("long", "", [1] * 3, SamplingParams(max_tokens=200))
+    scheduler.add_request("long-prompt", "", [1] * 40, SamplingParams(max_tokens=4))
+    scheduler.add_request("short", "", [1] * 3, SamplingParams(max_tokens=4))
+
+    outputs = scheduler.schedule()
+
+    assert [g.request_id for g in outputs.scheduled_groups] == ["short"]
+    assert [g.request_id for g in scheduler.waiting] == ["long-prompt", "long"]
+
+
+def test_fair_policy_interleaves_tenants():
+    policy = FairPolicy(threshold=4)
+    scheduler = make_scheduler(num_gpu_blocks=32, max_num_seqs=2, policy=policy)
+    for i in range(4):
+        scheduler.add_request(f"bulk-{i}", "", [1] * 3, tenant="bulk")
+    scheduler.schedule()
+    scheduler.add_request("interactive", "", [1] * 3, tenant="interactive")
+
+    for _ in range(6):
+        decode_one_token(scheduler)
+        outputs = scheduler.schedule()
+        if any(g.request_id == "interactive" for g in outputs.scheduled_groups):
+            break
+
+    # The newcomer starts level with the bulk tenant and overtakes it as bulk keeps being served
+    assert any(g.request_id == "interactive" for g in outputs.scheduled_groups)
+    assert policy.virtual_time["bulk"] > policy.virtual_time["interactive"]
+    assert outputs.num_preempted == 1 and len(scheduler.running) == 2
@@ -0,0 +1,79 @@
+import pytest
+import torch
+
+from engine.llm_engine import LLMEngine
+from engine.metrics import render_metrics
+from engine.sampling_params import SamplingParams
+from engine.spec_decode import NgramProposer
+from model.rejection_sampler import RejectionSampler
+from test_llm_engine import greedy_reference, run_to_completion
+
+
+@pytest.mark.parametrize("draft", ["[ngram]", "draft", "self"])
+def test_greedy_speculation_matches_plain_decoding(tiny_model_path, tiny_draft_model_path, draft):
+    speculative_model = {"[ngram]": "[ngram]", "draft": tiny_draft_model_path, "self": tiny_model_path}[draft]
+    engine = LLMEngine(tiny_model_path, block_size=4, max_num_seqs=4, num_gpu_blocks=64,
+                       num_speculative_tokens=3, speculative_model=speculative_model)
+    prompts = ["The quick brown fox", "Hello", "Paged attention is"]
+    params = SamplingParams(max_tokens=20, ignore_eos=True)
+    req_ids = [engine.add_request(p, params) for p in prompts]
+
+    outputs = run_to_completion(engine)
+
+    assert engine.block_manager.get_num_free_blocks() == 64
+    for req_id, prompt in zip(req_ids, prompts):
+        token_ids = [o["token_id"] for o in outputs[req_id]]
+        assert token_ids == greedy_reference(engine, engine.tokenizer.encode(prompt), 20)
+        assert [o["finished"] for o in outputs[req_id]] == [False] * 19 + [True]
+
+    metrics = engine.get_spec_decode_metrics()
+    assert metrics["num_draft_tokens"] > 0
+    per_request = [outputs[req_id][-1]["spec_decode"] for req_id in req_ids]
+    assert all(o["spec_decode"] is None for req_id in req_ids for o in outputs[req_id][:-1])
+    assert sum(r["num_draft_tokens"] for r in per_request if r) == metrics["num_draft_tokens"]
+    assert sum(r["num_accepted_tokens"] for r in per_request if r) == metrics["num_accepted_tokens"]
+    assert f"minivllm_spec_decode_draft_tokens_total {metrics['num_draft_tokens']}" in render_metrics([({}, engine.metrics)])
+    if draft == "self":
+        # The target drafting for itself is always right
+        assert metrics["acceptance_rate"] == 1.0
+        assert metrics["tokens_per_step"] > 3
+        assert all(r["acceptance_rate"] == 1.0 and r["tokens_per_step"] > 3 for r in per_request)
+
+
+def test_ngram_proposer_uses_latest_match():
+    proposer = NgramProposer(max_ngram=2)
+    assert proposer._lookup([1, 2, 3, 9, 1, 2, 4, 5, 1, 2], 3) == [4, 5, 1]
+    assert proposer._lookup([7, 8, 9], 2) == []
+
+
+def test_rejection_sampling_preserves_target_distribution():
+    torch.manual_seed(0)
+    vocab, num_trials = 4, 20000
+    p = torch.tensor([0.1, 0.2, 0.3, 0.4])
+    q = torch.tensor([0.4, 0.3, 0.2, 0.1])
+    # Draft tokens sampled from q, one per trial; the target row after it is irrelevant
+    drafts = torch.multinomial(q, num_trials, replacement=True).tolist()
+    target_probs = torch.stack([p, p]).repeat(num_trials, 1)
+
+    tokens = RejectionSampler()(
+        target_probs, [[d] for d in drafts], [q[None]] * num_trials, [None] * num_trials,
+    )
+
+    first = torch.tensor([t[0] for t in tokens])
+    empirical = torch.bincount(first, minlength=vocab).float() / num_trials
+    assert torch.allclose(empirical, p, atol=0.015)
+
+
+def test_seeded_speculative_sampling_is_reproducible(tiny_model_path, tiny_draft_model_path):
+    engine = LLMEngine(tiny_model_path, max_num_seqs=4, num_speculative_tokens=2,
+                       speculative_model=tiny_draft_model_path)
+    params = SamplingParams(temperature=1.0, seed=7, max_tokens=12, logprobs=1)
+
+    first = engine.add_request("Once upon a time", params)
+    outputs = run_to_completion(engine)
+    second = engine.add_request("Once upon a time", params)
+    outputs.update(run_to_completion(engine))
+
+    assert len(outputs[first]) == 12
+    assert [o["token_id"] for o in outputs[first]] == [o["token_id"] for o in outputs[second]]
+    assert all(o["logprobs"] is not None for o in outputs[first])